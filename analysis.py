@@ -0,0 +1,480 @@
+import math
+import re
+from typing import List, Optional
+
+from costs import PlanArrays
+from preprocessing import ExecutionTree, ExecutionTreeNode
+
+
+# Estimates off by at least this factor are called out as misestimates
+MISESTIMATE_FACTOR = 2.0
+
+
+def estimate_error(estimated_rows: float, actual_rows: float) -> float:
+    """How many times the row estimate was off, in either direction (>= 1).
+
+    Both sides are per loop, like EXPLAIN reports them. Counts below one row
+    are treated as one row so empty results don't divide by zero.
+    """
+    estimated = max(float(estimated_rows), 1.0)
+    actual = max(float(actual_rows), 1.0)
+    return max(estimated / actual, actual / estimated)
+
+
+def estimate_direction(estimated_rows: float, actual_rows: float) -> str:
+    if actual_rows > estimated_rows:
+        return "under"
+    if actual_rows < estimated_rows:
+        return "over"
+    return "exact"
+
+
+def exclusive_time(node: ExecutionTreeNode) -> Optional[float]:
+    """Time spent in this node alone, over all loops, in ms.
+
+    EXPLAIN ANALYZE times are inclusive and per loop, so the children's
+    loop-scaled totals are subtracted from the node's own.
+    """
+    if node.actual_total_time is None:
+        return None
+    own = node.actual_total_time * node.actual_loops
+    for child in node.children:
+        if child.actual_total_time is not None:
+            own -= child.actual_total_time * child.actual_loops
+    return max(own, 0.0)
+
+
+def node_actuals(node: ExecutionTreeNode, execution_time: Optional[float] = None) -> dict:
+    factor = estimate_error(node.rows, node.actual_rows)
+    entry = {
+        "id": node.id,
+        "operation": node.operation,
+        "estimated_rows": node.rows,
+        "actual_rows": node.actual_rows,
+        "loops": node.actual_loops,
+        "error_factor": round(factor, 2),
+        "direction": estimate_direction(node.rows, node.actual_rows),
+        "exclusive_time_ms": None,
+        "time_share": None,
+        "shared_hit_blocks": node.shared_hit_blocks,
+        "shared_read_blocks": node.shared_read_blocks,
+    }
+    own = exclusive_time(node)
+    if own is not None:
+        entry["exclusive_time_ms"] = round(own, 3)
+        if execution_time:
+            entry["time_share"] = round(own / execution_time, 4)
+    return entry
+
+
+# EXPLAIN ANALYZE text lines that show work going to disk
+SORT_SPILL_RE = re.compile(r"Sort Method: external \w+\s+Disk: (\d+)kB")
+HASH_BATCHES_RE = re.compile(r"Batches: (\d+)")
+DISK_USAGE_RE = re.compile(r"Disk Usage: (\d+)kB")
+MEMORY_USED_RE = re.compile(r"Memory(?: Usage)?: (\d+)kB")
+
+
+def node_spill(node: ExecutionTreeNode) -> Optional[dict]:
+    """How an analyzed node spilled to disk, if it did.
+
+    Returns:
+        dict: "kind" ("sort", "hash" or "aggregate") and "disk_kb" (None
+            when the plan doesn't say), or None if it stayed in memory
+    """
+    plan = node.plan
+    if plan is not None:
+        if plan.get("Sort Space Type") == "Disk":
+            return {"kind": "sort", "disk_kb": plan.get("Sort Space Used")}
+        if plan.get("Hash Batches", 1) > 1:
+            return {"kind": "hash", "disk_kb": None}
+        if plan.get("HashAgg Batches", 1) > 1 or plan.get("Disk Usage"):
+            return {"kind": "aggregate", "disk_kb": plan.get("Disk Usage")}
+        return None
+    for condition in node.condition:
+        match = SORT_SPILL_RE.search(condition)
+        if match:
+            return {"kind": "sort", "disk_kb": int(match.group(1))}
+        batches = HASH_BATCHES_RE.search(condition)
+        disk = DISK_USAGE_RE.search(condition)
+        if "Aggregate" in node.operation and (disk or (batches and int(batches.group(1)) > 1)):
+            return {"kind": "aggregate", "disk_kb": int(disk.group(1)) if disk else None}
+        if batches and int(batches.group(1)) > 1:
+            return {"kind": "hash", "disk_kb": None}
+    return None
+
+
+def misestimation_report(tree: ExecutionTree, top_n: int = 10) -> dict:
+    """Rank the nodes of an analyzed plan by estimate error and by own time.
+
+    Args:
+        tree (ExecutionTree): Built from an EXPLAIN ANALYZE plan
+        top_n (int): Length of each ranking
+
+    Returns:
+        dict: "by_error" and "by_time" rankings plus the execution time
+    """
+    if not tree.analyzed:
+        raise ValueError("Misestimation report needs an EXPLAIN ANALYZE plan")
+    root = tree.root
+    execution_time = None
+    if root.actual_total_time is not None:
+        execution_time = root.actual_total_time * root.actual_loops
+    entries: List[dict] = [
+        node_actuals(node, execution_time) for node in tree.dfs() if node.analyzed
+    ]
+    by_error = sorted(entries, key=lambda e: e["error_factor"], reverse=True)
+    by_time = sorted(
+        (e for e in entries if e["exclusive_time_ms"] is not None),
+        key=lambda e: e["exclusive_time_ms"],
+        reverse=True,
+    )
+    return {
+        "execution_time_ms": execution_time,
+        "misestimated": sum(1 for e in entries if e["error_factor"] >= MISESTIMATE_FACTOR),
+        "by_error": by_error[:top_n],
+        "by_time": by_time[:top_n],
+    }
+
+
+# PostgreSQL's defaults, for plans whose session settings are unknown
+DEFAULT_WORK_MEM_KB = 4096
+DEFAULT_HASH_MEM_MULTIPLIER = 2.0
+MEMORY_SETTING_RE = re.compile(r"(\d+(?:\.\d+)?)\s*(B|kB|MB|GB|TB)?$")
+MEMORY_UNITS_KB = {None: 1, "B": 1 / 1024, "kB": 1, "MB": 1024, "GB": 1024 ** 2, "TB": 1024 ** 3}
+
+# Bytes each row takes on top of its width, the way the planner reckons it:
+# a heap tuple header in sorts and tuplestores; a minimal tuple, the hash
+# join's own header and a bucket pointer in hash tables; a minimal tuple,
+# the hash entry and one transition state in hash aggregates
+TUPLE_OVERHEAD = 24
+HASH_TUPLE_OVERHEAD = 16 + 16 + 8
+HASHAGG_ENTRY_OVERHEAD = 16 + 24 + 16
+# A spilling hash aggregate asks for half as much room again as its groups
+# need when it picks how many partitions to write (4 to 1024)
+HASHAGG_PARTITION_FACTOR = 1.5
+HASHAGG_MIN_PARTITIONS = 4
+HASHAGG_MAX_PARTITIONS = 1024
+
+# Node types that hold their input in work_mem (hash_mem for the hashes)
+MEMORY_KINDS = {
+    "Sort": "sort",
+    "Hash": "hash",
+    "HashAggregate": "aggregate",
+    "MixedAggregate": "aggregate",
+    "Materialize": "materialize",
+}
+
+SORT_METHOD_RE = re.compile(r"Sort Method: (.+?)\s+(?:Memory|Disk):")
+
+
+def memory_kb(value) -> Optional[float]:
+    # pg_settings has bare kB; SHOW and EXPLAIN (SETTINGS) say e.g. "64MB"
+    match = MEMORY_SETTING_RE.match(str(value).strip())
+    if match is None:
+        return None
+    return float(match.group(1)) * MEMORY_UNITS_KB[match.group(2)]
+
+
+def memory_settings(settings=None, qep: Optional[dict] = None) -> dict:
+    """The work_mem and hash_mem_multiplier a plan runs under.
+
+    `settings` are the (name, value) pairs PlanCache.planner_settings
+    fetches once per session. Without them, the non-default settings that
+    EXPLAIN (SETTINGS) leaves in `qep` are used, then PostgreSQL's
+    defaults. On MySQL, sort_buffer_size and join_buffer_size stand in for
+    work_mem and hash memory.
+
+    Returns:
+        dict: "work_mem_kb", "hash_mem_multiplier" and where they came from,
+            "source" ("session", "plan" or "default")
+    """
+    values, source = {}, "default"
+    if settings:
+        values, source = dict(settings), "session"
+    elif qep and qep.get("Settings"):
+        values, source = qep["Settings"], "plan"
+    if "sort_buffer_size" in values:
+        # MySQL's are in bytes
+        work_mem = float(values["sort_buffer_size"]) / 1024
+        join_buffer = float(values.get("join_buffer_size", values["sort_buffer_size"])) / 1024
+        multiplier = join_buffer / work_mem if work_mem else 1.0
+    else:
+        work_mem = memory_kb(values.get("work_mem", DEFAULT_WORK_MEM_KB)) or DEFAULT_WORK_MEM_KB
+        multiplier = float(values.get("hash_mem_multiplier", DEFAULT_HASH_MEM_MULTIPLIER))
+    return {"work_mem_kb": work_mem, "hash_mem_multiplier": multiplier, "source": source}
+
+
+def memory_kind(operation: str) -> Optional[str]:
+    # "Parallel Hash" and "Partial HashAggregate" count, "Hash Join" doesn't
+    words = operation.split(" on ")[0].split()
+    if not words or words[0] == "Incremental":
+        return None
+    return MEMORY_KINDS.get(words[-1])
+
+
+def _next_power_of_two(n: float) -> int:
+    return 1 << (max(math.ceil(n), 1) - 1).bit_length()
+
+
+def predict_spill(node: ExecutionTreeNode, memory: dict) -> Optional[dict]:
+    """Estimate a Sort, Hash, HashAggregate or Materialize node's memory.
+
+    The estimate is the planned rows (per loop) times the aligned width
+    plus a per-row overhead, against work_mem, or work_mem times
+    hash_mem_multiplier for hashes. A Sort under a Limit that only needs
+    the first rows keeps twice the limit in a top-N heap.
+
+    Returns:
+        dict: "kind", "estimated_kb", "limit_kb", "spill", the sort
+            "method" and, for hashes, the predicted "batches" (hash join
+            batches, hash aggregate partitions); None for other nodes
+    """
+    kind = memory_kind(node.operation)
+    if kind is None:
+        return None
+    width = (int(node.width) + 7) & ~7
+    limit_kb = memory["work_mem_kb"]
+    method = batches = None
+    if kind in ("sort", "materialize"):
+        rows = node.rows
+        tuple_bytes = width + TUPLE_OVERHEAD
+        parent = node.parent
+        if kind == "sort":
+            method = "quicksort"
+            if parent is not None and parent.operation == "Limit":
+                bound = 2 * max(parent.rows, 1.0)
+                if bound < rows and bound * tuple_bytes <= limit_kb * 1024:
+                    rows, method = bound, "top-N heapsort"
+        estimated = rows * tuple_bytes
+    else:
+        limit_kb *= memory["hash_mem_multiplier"]
+        overhead = HASH_TUPLE_OVERHEAD if kind == "hash" else HASHAGG_ENTRY_OVERHEAD
+        estimated = node.rows * (width + overhead)
+    spill = estimated > limit_kb * 1024
+    if kind == "sort" and spill:
+        method = "external merge"
+    elif kind == "hash":
+        batches = _next_power_of_two(estimated / (limit_kb * 1024))
+    elif kind == "aggregate":
+        batches = 1
+        if spill:
+            partitions = _next_power_of_two(HASHAGG_PARTITION_FACTOR * estimated / (limit_kb * 1024))
+            batches = min(max(partitions, HASHAGG_MIN_PARTITIONS), HASHAGG_MAX_PARTITIONS)
+    return {
+        "kind": kind,
+        "estimated_kb": round(estimated / 1024, 1),
+        "limit_kb": round(limit_kb, 1),
+        "spill": spill,
+        "method": method,
+        "batches": batches,
+    }
+
+
+def spill_actuals(node: ExecutionTreeNode) -> dict:
+    """What EXPLAIN ANALYZE says a memory-hungry node did.
+
+    Every value is None when the plan doesn't say, e.g. for a node that
+    never ran or a Materialize, which reports nothing about its storage.
+    """
+    method = batches = used_kb = None
+    plan = node.plan
+    if plan is not None:
+        method = plan.get("Sort Method")
+        batches = plan.get("Hash Batches", plan.get("HashAgg Batches"))
+        if plan.get("Sort Space Type") == "Memory":
+            used_kb = plan.get("Sort Space Used")
+        else:
+            used_kb = plan.get("Peak Memory Usage")
+    else:
+        for condition in node.condition:
+            match = SORT_METHOD_RE.search(condition)
+            if match:
+                method = match.group(1)
+            match = HASH_BATCHES_RE.search(condition)
+            if match:
+                batches = int(match.group(1))
+            match = MEMORY_USED_RE.search(condition)
+            if match:
+                used_kb = int(match.group(1))
+    known = node.analyzed and (method or batches or used_kb is not None)
+    spilled = node_spill(node) if known else None
+    return {
+        "actual_spill": None if not known else spilled is not None,
+        "actual_method": method,
+        "actual_batches": batches,
+        "actual_memory_kb": used_kb,
+        "actual_disk_kb": spilled["disk_kb"] if spilled else None,
+    }
+
+
+def spill_report(tree: ExecutionTree, memory: Optional[dict] = None) -> dict:
+    """Predict which nodes spill to disk and, after ANALYZE, check it.
+
+    Args:
+        tree (ExecutionTree): The plan
+        memory (dict): From memory_settings; PostgreSQL's defaults if None
+
+    Returns:
+        dict: the memory settings, "nodes" with every Sort, Hash,
+            HashAggregate and Materialize (see predict_spill and
+            spill_actuals, plus a "verdict": "correct", "missed" or "false
+            alarm" when the actuals are known), and counts of "predicted",
+            "spilled" and "missed" spills
+    """
+    memory = memory or memory_settings()
+    nodes = []
+    # Ids by position in pre-order, as finalize_id would number them
+    for id, node in enumerate(tree.dfs()):
+        prediction = predict_spill(node, memory)
+        if prediction is None:
+            continue
+        entry = {"id": id, "operation": node.operation, "rows": node.rows, "width": node.width}
+        entry.update(prediction)
+        entry.update(spill_actuals(node))
+        actual = entry["actual_spill"]
+        if actual is None:
+            entry["verdict"] = None
+        elif actual == entry["spill"]:
+            entry["verdict"] = "correct"
+        else:
+            entry["verdict"] = "missed" if actual else "false alarm"
+        nodes.append(entry)
+    return {
+        **memory,
+        "nodes": nodes,
+        "predicted": sum(1 for e in nodes if e["spill"]),
+        "spilled": sum(1 for e in nodes if e["actual_spill"]),
+        "missed": sum(1 for e in nodes if e["verdict"] == "missed"),
+    }
+
+
+# Operator classes PostgreSQL can run below a Gather; an expensive one that
+# runs serially is work a parallel plan could have split
+PARALLEL_CLASSES = ("scan", "join", "aggregate", "append", "sort", "hash")
+# ...except scans that only the leader can run
+SERIAL_ONLY_SCANS = ("CTE Scan", "WorkTable Scan")
+# parallel_setup_cost's default: cheaper plans never go parallel
+PARALLEL_MIN_COST = 1000.0
+# Serial nodes with less of the plan's cost than this aren't listed
+SERIAL_SHARE = 0.1
+
+
+def _subtree(node: ExecutionTreeNode) -> List[ExecutionTreeNode]:
+    # Pre-order, like ExecutionTree.dfs
+    result = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        result.append(node)
+        stack.extend(reversed(node.children))
+    return result
+
+
+def gather_stats(gather: ExecutionTreeNode) -> dict:
+    """Workers and, after EXPLAIN ANALYZE, how well one Gather used them.
+
+    The leader is counted as one more process, as it runs the plan too
+    unless parallel_leader_participation is off. "speedup" is the time
+    spent below the Gather by all processes over the Gather's own time,
+    "efficiency" that speedup per process. Rows per process come from the
+    first parallel-aware node below with per-worker actuals (VERBOSE), and
+    "row_skew" is the busiest process's rows over the mean.
+    """
+    planned = gather.workers_planned or 0
+    launched = gather.workers_launched
+    entry = {
+        "id": gather.id,
+        "operation": gather.operation,
+        "workers_planned": planned,
+        "workers_launched": launched,
+        "worker_shortfall": None if launched is None else planned - launched,
+        "processes": None,
+        "speedup": None,
+        "efficiency": None,
+        "process_rows": None,
+        "rows_from": None,
+        "row_skew": None,
+    }
+    child = next((child for child in gather.children
+                  if child.relationship not in ("InitPlan", "SubPlan")), None)
+    if launched is None or child is None or not child.analyzed:
+        return entry
+    processes = launched + 1
+    entry["processes"] = processes
+    if child.actual_total_time is not None and gather.actual_total_time:
+        # Per loop times; the child's loops are the processes that ran it
+        work = child.actual_total_time * child.actual_loops
+        speedup = work / (gather.actual_total_time * gather.actual_loops)
+        entry["speedup"] = round(speedup, 2)
+        entry["efficiency"] = round(speedup / processes, 3)
+    below = [node for node in _subtree(child) if node.workers and node.analyzed]
+    split = next((node for node in below if node.parallel_aware), below[0] if below else None)
+    if split is not None:
+        rows = {f"worker {worker['worker']}": worker["actual_rows"] * worker["actual_loops"]
+                for worker in split.workers}
+        if len(rows) == launched:
+            # Whatever the workers didn't return, the leader did
+            rows["leader"] = max(split.actual_rows * split.actual_loops - sum(rows.values()), 0.0)
+        entry["process_rows"] = rows
+        entry["rows_from"] = split.operation
+        mean = sum(rows.values()) / len(rows)
+        if mean:
+            entry["row_skew"] = round(max(rows.values()) / mean, 2)
+    return entry
+
+
+def parallel_report(tree: ExecutionTree, top_n: int = 10) -> dict:
+    """Gather efficiency and the serial operators that keep a plan from going parallel.
+
+    Nodes outside every Gather run in the leader alone. The expensive ones
+    that PostgreSQL could run in parallel (scans, joins, aggregates, sorts)
+    are listed as "serial", largest share of the plan's cost first, when
+    the plan costs enough for parallelism to be considered at all.
+
+    Returns:
+        dict: "gathers" (see gather_stats), "parallel_nodes" (parallel
+            aware), "serial_cost_share" and the "serial" ranking
+    """
+    arrays = PlanArrays(tree)
+    attributed = arrays.attributed_cost.tolist()
+    total = sum(attributed)
+    gathers, candidates = [], []
+    parallel_nodes = 0
+    serial_cost = 0.0
+    stack = [(tree.root, False)]
+    while stack:
+        node, below_gather = stack.pop()
+        is_gather = node.operation.startswith("Gather")
+        if is_gather:
+            gathers.append(gather_stats(node))
+        if node.parallel_aware:
+            parallel_nodes += 1
+        if not below_gather:
+            cost = attributed[node.id]
+            serial_cost += cost
+            share = cost / total if total else 0.0
+            if (arrays.operator_class[node.id] in PARALLEL_CLASSES and share >= SERIAL_SHARE
+                    and not node.operation.startswith(SERIAL_ONLY_SCANS)):
+                own_time = exclusive_time(node) if node.analyzed else None
+                candidates.append({
+                    "id": node.id,
+                    "operation": node.operation,
+                    "relation": node.relation,
+                    "attributed_cost": round(cost, 2),
+                    "share": round(share, 4),
+                    "exclusive_time_ms": None if own_time is None else round(own_time, 3),
+                })
+        stack.extend((child, below_gather or is_gather) for child in reversed(node.children))
+
+    serial = []
+    if tree.root.total_cost >= PARALLEL_MIN_COST:
+        reason = "outside any Gather" if gathers else "plan has no Gather"
+        for entry in sorted(candidates, key=lambda entry: entry["attributed_cost"], reverse=True)[:top_n]:
+            entry["reason"] = reason
+            serial.append(entry)
+    return {
+        "gathers": gathers,
+        "parallel_nodes": parallel_nodes,
+        "serial_cost_share": round(serial_cost / total, 4) if total else 0.0,
+        "serial": serial,
+    }
@@ -0,0 +1,276 @@
+import argparse
+import getpass
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing.util import Finalize
+from typing import Iterator, List, Optional, Tuple
+
+from analysis import memory_settings, misestimation_report, spill_report
+from dbsession import normalize_dbms
+from history import DEFAULT_REGRESSION_THRESHOLD, PlanHistory, plan_record
+from instrument import RECORDER, JSONLinesSink, PrometheusSink
+from pipesyntax import generate_pipe_syntax
+from plancache import PlanCache, split_statements
+from plansource import open_plan_source
+from preprocessing import build_tree_from_json, get_plan
+from reportserver import publish_remote
+
+
+# Per-worker state; shared by all threads, or set up once per process
+_worker = {}
+
+
+def iter_sql_files(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(".sql"):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def iter_queries(paths: List[str]) -> Iterator[Tuple[str, int, str]]:
+    """Yield (file, statement index, sql) one file at a time."""
+    for path in iter_sql_files(paths):
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        for index, sql in enumerate(split_statements(text)):
+            yield path, index, sql
+
+
+def init_worker(dbms: str, db_config: Optional[dict], pool_size: int, statement_timeout: Optional[float],
+                cache_dir: Optional[str], analyze: bool = False, record: Optional[str] = None,
+                replay: Optional[str] = None):
+    # A live session, or one recording into / replaying from a plan archive
+    _worker["session"] = open_plan_source(
+        dbms, db_config, record=record, replay=replay, pool_size=pool_size, statement_timeout=statement_timeout
+    )
+    _worker["cache"] = PlanCache(disk_dir=cache_dir)
+    _worker["analyze"] = analyze
+
+
+def init_process_worker(*args):
+    init_worker(*args)
+    # Worker processes end in os._exit, which skips atexit handlers;
+    # multiprocessing's own finalizers still run, and close the session
+    # (and flush a recording) before the process goes
+    Finalize(None, close_worker, exitpriority=10)
+
+
+def close_worker():
+    session = _worker.pop("session", None)
+    if session is not None:
+        session.close()
+    _worker.clear()
+
+
+def explain_query(path: str, index: int, sql: str, include_plan: bool = False,
+                  record: bool = False, label: Optional[str] = None, timings: bool = False) -> dict:
+    if not timings:
+        return _explain_query(path, index, sql, include_plan, record, label)
+    # Handed back with the result, so runs in worker processes reach the sinks too
+    with RECORDER.run(f"{path}:{index}", emit=False) as run:
+        result = _explain_query(path, index, sql, include_plan, record, label)
+    result["timings"] = run.to_json()
+    return result
+
+
+def _explain_query(path: str, index: int, sql: str, include_plan: bool = False,
+                   record: bool = False, label: Optional[str] = None) -> dict:
+    result = {"file": path, "index": index}
+    start = time.perf_counter()
+    try:
+        if _worker["analyze"]:
+            # Actual timings are never served from the cache
+            qep = get_plan(sql, _worker["session"], analyze=True, buffers=True)
+            tree = build_tree_from_json(qep)
+            pipe_syntax = generate_pipe_syntax(qep, show_cost=True)
+        else:
+            plan = _worker["cache"].explain(sql, _worker["session"])
+            qep, tree, pipe_syntax = plan.qep, plan.tree, plan.pipe_with_cost
+        result["pipe_syntax"] = pipe_syntax
+        result["cost"] = tree.get_cost()
+        # The expensive operators up front, without digging through the steps
+        result["hot_spots"] = result["cost"]["hot_spots"]
+        if tree.analyzed:
+            result["misestimation"] = misestimation_report(tree)
+        session = _worker["session"]
+        settings = _worker["cache"].planner_settings(session)
+        # Only the nodes predicted (or, with ANALYZE, seen) to spill
+        spills = spill_report(tree, memory_settings(settings, qep))
+        result["spills"] = [e for e in spills["nodes"] if e["spill"] or e["actual_spill"]]
+        if include_plan:
+            result["plan"] = qep
+        if record:
+            # Built here, written in bulk by the main process
+            result["history"] = plan_record(sql, qep, result["cost"], settings, session.dbms, label)
+        result["error"] = None
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return result
+
+
+def run_batch(queries: Iterator[Tuple[str, int, str]], executor, workers: int,
+              out, include_plan: bool = False, history: Optional[PlanHistory] = None,
+              label: Optional[str] = None, timings: bool = False,
+              publish: Optional[str] = None) -> Tuple[int, int]:
+    """Stream results to `out` as they complete.
+
+    At most `2 * workers` queries are in flight, so neither the pending
+    queries nor the finished results pile up in memory. With a `history`,
+    each group of finished plans is recorded in one transaction and every
+    line says whether its plan flipped or regressed. With `timings`, every
+    line carries its stage timings, which also go to RECORDER's sinks.
+    With `publish`, the URL of a report server, every plan is posted there
+    and its line carries the report's URL instead of a rendered report.
+    """
+    pending = set()
+    done_count = failed = 0
+    max_in_flight = 2 * workers
+
+    def drain(block_until):
+        nonlocal pending, done_count, failed
+        finished, pending = wait(pending, return_when=block_until)
+        results = [future.result() for future in finished]
+        recorded = [result for result in results if "history" in result]
+        if recorded:
+            flags = history.record_many(result.pop("history") for result in recorded)
+            for result, flag in zip(recorded, flags):
+                result["history"] = flag
+        for result in results:
+            if "timings" in result:
+                RECORDER.emit(result["timings"])
+            if publish and not result["error"]:
+                qep = result["plan"] if include_plan else result.pop("plan")
+                try:
+                    result["report_url"] = publish_remote(publish, qep, title=f"{result['file']}:{result['index']}")
+                except Exception as e:
+                    result["publish_error"] = f"{type(e).__name__}: {e}"
+            if result["error"]:
+                failed += 1
+            done_count += 1
+            out.write(json.dumps(result) + "\n")
+        out.flush()
+
+    for path, index, sql in queries:
+        # Published plans travel back with the result, then are dropped
+        pending.add(executor.submit(explain_query, path, index, sql, include_plan or bool(publish),
+                                    history is not None, label, timings))
+        if len(pending) >= max_in_flight:
+            drain(FIRST_COMPLETED)
+    while pending:
+        drain(FIRST_COMPLETED)
+    return done_count, failed
+
+
+def add_connection_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--dbms", default="postgresql", help="postgresql or mysql")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", default=None, help="Defaults to 5432, or 3306 for MySQL")
+    parser.add_argument("--user", default=None, help="Defaults to postgres, or root for MySQL")
+    parser.add_argument("--password", default=None,
+                        help="Defaults to $PGPASSWORD ($MYSQL_PWD for MySQL), prompts if neither is set")
+    parser.add_argument("--dbname", default="TPC-H")
+
+
+def db_config_from_args(args) -> dict:
+    mysql = normalize_dbms(args.dbms) == "mysql"
+    password = args.password
+    if password is None:
+        password = os.environ.get("MYSQL_PWD" if mysql else "PGPASSWORD")
+    if password is None:
+        password = getpass.getpass("Password: ")
+    return {
+        "host": args.host,
+        "port": args.port or ("3306" if mysql else "5432"),
+        "user": args.user or ("root" if mysql else "postgres"),
+        "password": password, "dbname": args.dbname,
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Explain SQL files and emit pipe syntax as JSON Lines")
+    parser.add_argument("paths", nargs="+", help=".sql files or directories of them")
+    add_connection_arguments(parser)
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Concurrent EXPLAINs, also the number of connections")
+    parser.add_argument("--processes", action="store_true",
+                        help="Use worker processes instead of threads (one connection each)")
+    parser.add_argument("--timeout", type=float, default=None, help="Statement timeout in seconds")
+    parser.add_argument("--cache-dir", default=None, help="Directory for the on-disk plan cache")
+    parser.add_argument("--analyze", action="store_true",
+                        help="Run EXPLAIN ANALYZE (executes each query, then rolls back)")
+    parser.add_argument("--include-plan", action="store_true", help="Add the JSON plan to each line")
+    parser.add_argument("--history", default=None, metavar="DB",
+                        help="Record every plan in this SQLite history and flag flips and regressions")
+    parser.add_argument("--label", default=None, help="Tag for the recorded plans, e.g. a release")
+    parser.add_argument("--regression-threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help="Relative cost increase flagged as a regression (0.2 = 20%%)")
+    parser.add_argument("--timings", action="store_true", help="Add per-stage timings to each line")
+    parser.add_argument("--metrics-log", default=None, metavar="FILE",
+                        help="Append each query's timings to this JSON Lines file (implies --timings)")
+    parser.add_argument("--prometheus", default=None, metavar="FILE",
+                        help="Keep stage totals in this Prometheus text file (implies --timings)")
+    parser.add_argument("--record", default=None, metavar="DIR",
+                        help="Also write every plan to this plan archive, for --replay later")
+    parser.add_argument("--replay", default=None, metavar="DIR",
+                        help="Serve plans from this plan archive instead of a database")
+    parser.add_argument("--publish", default=None, metavar="URL",
+                        help="Post every plan to the report server at URL, e.g. http://127.0.0.1:8765")
+    parser.add_argument("-o", "--output", default="-", help="Output file, - for stdout")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.workers < 1:
+        print("--workers must be at least 1", file=sys.stderr)
+        return 2
+    if args.record and args.replay:
+        print("--record and --replay can't be combined", file=sys.stderr)
+        return 2
+    # Replays need no database, nor its password
+    db_config = None if args.replay else db_config_from_args(args)
+    sources = (args.record, args.replay)
+    worker_args = (args.dbms, db_config, args.workers, args.timeout, args.cache_dir, args.analyze, *sources)
+    if args.processes:
+        worker_args = (args.dbms, db_config, 1, args.timeout, args.cache_dir, args.analyze, *sources)
+        executor = ProcessPoolExecutor(args.workers, initializer=init_process_worker, initargs=worker_args)
+    else:
+        init_worker(*worker_args)
+        executor = ThreadPoolExecutor(args.workers)
+
+    if args.metrics_log:
+        RECORDER.sinks.append(JSONLinesSink(args.metrics_log))
+    if args.prometheus:
+        RECORDER.sinks.append(PrometheusSink(args.prometheus))
+    timings = args.timings or bool(RECORDER.sinks)
+
+    history = PlanHistory(args.history, args.regression_threshold) if args.history else None
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    start = time.perf_counter()
+    try:
+        with executor:
+            done_count, failed = run_batch(
+                iter_queries(args.paths), executor, args.workers, out, args.include_plan,
+                history, args.label, timings, args.publish,
+            )
+    finally:
+        # The thread pool's session; worker processes close their own
+        close_worker()
+        if history is not None:
+            history.close()
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    print(f"Explained {done_count} queries ({failed} failed) in {elapsed:.2f}s", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,413 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pipesyntax import build_pipeline, render_html, render_text
+from plandiff import diff_plans
+from preprocessing import (
+    Visualizer, build_tree_from_json, json_conditions, json_operation,
+    parse_query_explanation_to_tree,
+)
+
+
+# Timings only compare on the machine that made them, so every checkout
+# keeps its own baseline and none is committed
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# Relative weights of the operators the generator picks from
+DEFAULT_NODE_MIX = {
+    "scan": {"Seq Scan": 4, "Index Scan": 2, "Index Only Scan": 1, "Bitmap Heap Scan": 1},
+    "unary": {"Sort": 3, "Aggregate": 3, "Materialize": 1, "Limit": 1, "Gather Merge": 1, "Unique": 1},
+    "join": {"Hash Join": 4, "Nested Loop": 2, "Merge Join": 2},
+}
+
+# Scenarios run when none is given on the command line: name -> generator arguments
+DEFAULT_SCENARIOS = {
+    "small": {"depth": 4, "fanout": 2, "max_nodes": 50},
+    "medium": {"depth": 12, "fanout": 3, "max_nodes": 1000},
+    "large": {"depth": 18, "fanout": 4, "max_nodes": 10000},
+    "deep": {"depth": 5000, "fanout": 1, "max_nodes": 5000},
+}
+
+TPCH_TABLES = ["lineitem", "orders", "customer", "part", "partsupp", "supplier", "nation", "region"]
+
+
+def _pick(rng: random.Random, weights: Dict[str, int]) -> str:
+    names = [name for name, weight in weights.items() if weight > 0]
+    return rng.choices(names, weights=[weights[name] for name in names])[0]
+
+
+def _scan_node(rng: random.Random, node_type: str) -> dict:
+    table = rng.choice(TPCH_TABLES)
+    column = f"{table[0]}_key{rng.randint(1, 9)}"
+    plan = {"Node Type": node_type, "Relation Name": table, "Alias": table}
+    if "Index" in node_type:
+        plan["Index Name"] = f"{table}_pkey"
+        plan["Index Cond"] = f"({column} = {rng.randint(1, 1000)})"
+    if rng.random() < 0.5:
+        plan["Filter"] = f"({column} > {rng.randint(1, 1000)})"
+    return plan
+
+
+def _inner_node(rng: random.Random, node_type: str) -> dict:
+    plan = {"Node Type": node_type}
+    key = f"k{rng.randint(1, 99)}"
+    if node_type in ("Hash Join", "Nested Loop", "Merge Join"):
+        plan["Join Type"] = rng.choice(["Inner", "Inner", "Left", "Semi"])
+        cond = f"(a.{key} = b.{key})"
+        if node_type == "Hash Join":
+            plan["Hash Cond"] = cond
+        elif node_type == "Merge Join":
+            plan["Merge Cond"] = cond
+        else:
+            plan["Join Filter"] = cond
+    elif node_type == "Sort":
+        plan["Sort Key"] = [key]
+    elif node_type == "Aggregate":
+        plan["Strategy"] = rng.choice(["Hashed", "Sorted", "Plain"])
+        if plan["Strategy"] != "Plain":
+            plan["Group Key"] = [key]
+    return plan
+
+
+def generate_plan(depth: int = 6, fanout: int = 2, max_nodes: int = 1000,
+                  node_mix: Optional[dict] = None, seed: int = 0) -> dict:
+    """Generate a synthetic `EXPLAIN (FORMAT JSON)` plan.
+
+    Inner nodes get between 1 and `fanout` children: one child makes a unary
+    operator, two a join (Hash Joins get a Hash on their inner side), more an
+    Append. Leaves are scans. Costs and rows grow towards the root like a
+    real plan's. The same arguments always produce the same plan.
+
+    Args:
+        depth (int): Maximum number of levels
+        fanout (int): Maximum children per node
+        max_nodes (int): Stop growing once this many nodes exist
+        node_mix (dict): Operator weights, see DEFAULT_NODE_MIX
+        seed (int): Random seed
+    """
+    rng = random.Random(seed)
+    mix = node_mix or DEFAULT_NODE_MIX
+    count = 1
+    root = {"Plans": []}
+    # Breadth-first growth so max_nodes cuts the tree evenly, not one branch
+    frontier = [(root, 1)]
+    plans = []
+    while frontier:
+        next_frontier = []
+        for plan, level in frontier:
+            plans.append(plan)
+            budget = max_nodes - count
+            if level >= depth or budget <= 0:
+                plan.update(_scan_node(rng, _pick(rng, mix["scan"])))
+                plan.pop("Plans")
+                continue
+            children = min(rng.randint(1, max(fanout, 1)), budget)
+            if fanout == 1:
+                children = 1
+            if children == 1:
+                node_type = _pick(rng, mix["unary"])
+            elif children == 2:
+                node_type = _pick(rng, mix["join"])
+            else:
+                node_type = "Append"
+            plan.update(_inner_node(rng, node_type))
+            for index in range(children):
+                child = {"Plans": []}
+                if node_type == "Hash Join" and index == 1 and count + 2 <= max_nodes:
+                    # The inner side of a hash join is always a Hash node
+                    child = {"Node Type": "Hash", "Plans": [{"Plans": []}]}
+                    plan["Plans"].append(child)
+                    next_frontier.append((child["Plans"][0], level + 2))
+                    plans.append(child)
+                    count += 2
+                    continue
+                plan["Plans"].append(child)
+                next_frontier.append((child, level + 1))
+                count += 1
+        frontier = next_frontier
+
+    # Fill in estimates bottom-up (children were appended after parents)
+    for plan in reversed(plans):
+        sub = plan.get("Plans", [])
+        rows = float(rng.randint(1, 100000)) if not sub else max(1.0, sum(p["Plan Rows"] for p in sub) * rng.uniform(0.1, 1.0))
+        child_cost = sum(p["Total Cost"] for p in sub)
+        if plan.get("Node Type") == "Nested Loop":
+            # The inner side runs once per outer row
+            outer, inner = sub
+            child_cost = outer["Total Cost"] + max(outer["Plan Rows"], 1) * inner["Total Cost"]
+        startup = max((p["Startup Cost"] for p in sub), default=0.0)
+        plan["Startup Cost"] = round(startup + rng.uniform(0, 10), 2)
+        plan["Total Cost"] = round(plan["Startup Cost"] + child_cost + rows * 0.01, 2)
+        plan["Plan Rows"] = int(rows)
+        plan["Plan Width"] = rng.randint(4, 200)
+        plan["Parallel Aware"] = False
+        if not sub:
+            plan.pop("Plans", None)
+    return {"Plan": root}
+
+
+def plan_to_text(qep: dict) -> List[str]:
+    """Render a JSON plan the way text-format EXPLAIN prints it."""
+    lines = []
+    stack = [(qep["Plan"], 0)]
+    while stack:
+        plan, level = stack.pop()
+        info = (f"(cost={plan['Startup Cost']:.2f}..{plan['Total Cost']:.2f} "
+                f"rows={plan['Plan Rows']} width={plan['Plan Width']})")
+        if level == 0:
+            lines.append(f"{json_operation(plan)}  {info}")
+            indent = 2
+        else:
+            lines.append(f"{' ' * (6 * level - 4)}->  {json_operation(plan)}  {info}")
+            indent = 6 * level + 2
+        for condition in json_conditions(plan):
+            lines.append(f"{' ' * indent}{condition}")
+        for sub in reversed(plan.get("Plans", [])):
+            stack.append((sub, level + 1))
+    return lines
+
+
+def perturb_plan(qep: dict, fraction: float = 0.05, seed: int = 0) -> dict:
+    """Copy of `qep` as if re-planned: some costs move, some Append inputs go away."""
+    rng = random.Random(seed)
+    # Copied level by level; deep plans are too deep for copy.deepcopy or json
+    changed = {"Plan": dict(qep["Plan"])}
+    stack = [changed["Plan"]]
+    while stack:
+        plan = stack.pop()
+        if "Plans" in plan:
+            plan["Plans"] = [dict(sub) for sub in plan["Plans"]]
+        if rng.random() < fraction:
+            plan["Total Cost"] = round(plan["Total Cost"] * rng.uniform(0.5, 2.0), 2)
+        if plan.get("Node Type") == "Append" and len(plan["Plans"]) > 2 and rng.random() < fraction:
+            plan["Plans"].pop(rng.randrange(len(plan["Plans"])))
+        stack.extend(plan.get("Plans", []))
+    return changed
+
+
+def count_nodes(qep: dict) -> int:
+    count = 0
+    stack = [qep["Plan"]]
+    while stack:
+        plan = stack.pop()
+        count += 1
+        stack.extend(plan.get("Plans", []))
+    return count
+
+
+def pipeline_stages(qep: dict, text_plan: List[str]) -> Dict[str, Tuple[Callable[[], object], Optional[Callable[[], None]]]]:
+    """The pipeline's stages, each prepared with the output of the one before.
+
+    Every stage comes with the setup to run before each repetition, outside
+    the timing, or None. Stages that hit the Visualizer's shape caches are
+    timed twice: cold, with the caches emptied first, and "_hit", warm.
+    """
+    tree = build_tree_from_json(qep)
+    changed_tree = build_tree_from_json(perturb_plan(qep))
+    viz = Visualizer()
+    fig = viz.visualize(tree)
+
+    def pipe_syntax():
+        # What the report needs: one pipeline, rendered every way it is shown
+        pipeline = build_pipeline(tree)
+        return render_text(pipeline, True), render_text(pipeline, False), render_html(pipeline)
+
+    def cold_layout():
+        Visualizer._layout_cache.clear()
+
+    def cold_figure():
+        Visualizer._layout_cache.clear()
+        Visualizer._figure_cache.clear()
+
+    return {
+        "parse_text": (lambda: parse_query_explanation_to_tree(text_plan), None),
+        "build_json_tree": (lambda: build_tree_from_json(qep), None),
+        "get_cost": (tree.get_cost, None),
+        # The igraph layout itself
+        "calc_layout": (lambda: viz.calc_layout(tree), cold_layout),
+        "calc_layout_hit": (lambda: viz.calc_layout(tree), None),
+        "visualize": (lambda: viz.visualize(tree), cold_layout),
+        "visualize_hit": (lambda: viz.visualize(tree), None),
+        # A shape seen for the first time, then the memoized skeleton
+        "report_figure": (lambda: viz.report_figure(tree), cold_figure),
+        "report_figure_hit": (lambda: viz.report_figure(tree), None),
+        "to_html": (lambda: viz.to_html(fig), None),
+        "pipe_syntax": (pipe_syntax, None),
+        "plan_diff": (lambda: diff_plans(tree, changed_tree), None),
+    }
+
+
+def measure(stage: Callable[[], object], repeat: int, setup: Optional[Callable[[], None]] = None) -> dict:
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        stage()
+        times.append(time.perf_counter() - start)
+    # Memory in its own run: tracemalloc slows allocation-heavy code down a lot
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    stage()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "median_ms": round(statistics.median(times) * 1000, 3),
+        "min_ms": round(min(times) * 1000, 3),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def run_scenario(name: str, params: dict, repeat: int, stages: Optional[List[str]] = None) -> dict:
+    qep = generate_plan(**params)
+    nodes = count_nodes(qep)
+    text_plan = plan_to_text(qep)
+    results = {}
+    for stage_name, (stage, setup) in pipeline_stages(qep, text_plan).items():
+        if stages and stage_name not in stages:
+            continue
+        result = measure(stage, repeat, setup)
+        median_s = result["median_ms"] / 1000
+        result["nodes_per_s"] = round(nodes / median_s) if median_s > 0 else None
+        results[stage_name] = result
+    return {"params": params, "nodes": nodes, "stages": results}
+
+
+def run_replay(path: str, repeat: int, stages: Optional[List[str]] = None) -> dict:
+    """Every stage over each JSON plan in a plan archive, times summed over the plans."""
+    from plansource import PlanArchive
+
+    with PlanArchive(path) as archive:
+        # Text EXPLAIN output is archived as rows, not as a plan dict
+        qeps = [record["result"] for record in archive.records("explain") if isinstance(record["result"], dict)]
+    results = {}
+    for qep in qeps:
+        for stage_name, (stage, setup) in pipeline_stages(qep, plan_to_text(qep)).items():
+            if stages and stage_name not in stages:
+                continue
+            result = measure(stage, repeat, setup)
+            total = results.setdefault(stage_name, {"median_ms": 0.0, "min_ms": 0.0, "peak_kb": 0.0})
+            total["median_ms"] = round(total["median_ms"] + result["median_ms"], 3)
+            total["min_ms"] = round(total["min_ms"] + result["min_ms"], 3)
+            total["peak_kb"] = max(total["peak_kb"], result["peak_kb"])
+    nodes = sum(count_nodes(qep) for qep in qeps)
+    for result in results.values():
+        median_s = result["median_ms"] / 1000
+        result["nodes_per_s"] = round(nodes / median_s) if median_s > 0 else None
+    params = {"archive": os.path.basename(os.path.normpath(path)), "plans": len(qeps)}
+    return {"params": params, "nodes": nodes, "stages": results}
+
+
+def machine_info() -> dict:
+    # What a baseline's timings are only valid for
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Stages whose median time grew more than `tolerance` over the baseline."""
+    regressions = []
+    for scenario, result in results.items():
+        base = baseline.get("scenarios", {}).get(scenario)
+        if base is None or base["params"] != result["params"]:
+            continue
+        for stage, timing in result["stages"].items():
+            base_timing = base["stages"].get(stage)
+            if base_timing is None:
+                continue
+            limit = base_timing["median_ms"] * (1 + tolerance)
+            # Sub-millisecond stages are too noisy to fail a run on
+            if timing["median_ms"] > limit and timing["median_ms"] - base_timing["median_ms"] > 1.0:
+                regressions.append(
+                    f"{scenario}/{stage}: {timing['median_ms']}ms vs baseline "
+                    f"{base_timing['median_ms']}ms (+{tolerance:.0%} allowed)"
+                )
+    return regressions
+
+
+def print_table(results: dict, out=sys.stderr):
+    for scenario, result in results.items():
+        print(f"{scenario} ({result['nodes']} nodes)", file=out)
+        for stage, timing in result["stages"].items():
+            print(f"  {stage:<16} {timing['median_ms']:>10.3f} ms  {timing['nodes_per_s'] or 0:>12} nodes/s"
+                  f"  {timing['peak_kb']:>10.1f} KB peak", file=out)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on synthetic (or archived) plans, offline")
+    parser.add_argument("--scenario", action="append", choices=sorted(DEFAULT_SCENARIOS),
+                        help="Run only these scenarios (repeatable)")
+    parser.add_argument("--depth", type=int, help="Custom scenario: maximum plan depth")
+    parser.add_argument("--fanout", type=int, default=2, help="Custom scenario: maximum children per node")
+    parser.add_argument("--nodes", type=int, default=1000, help="Custom scenario: maximum node count")
+    parser.add_argument("--mix", default=None, help="JSON file with operator weights, see DEFAULT_NODE_MIX")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", default=None, metavar="DIR",
+                        help="Also run every stage over the JSON plans in this plan archive")
+    parser.add_argument("--stage", action="append", help="Run only these stages (repeatable)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Allowed slowdown over the baseline before failing (0.5 = 50%%)")
+    parser.add_argument("-o", "--output", default=None, help="Write the results as JSON here")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.depth is not None:
+        node_mix = None
+        if args.mix:
+            with open(args.mix, "r", encoding="utf-8") as f:
+                node_mix = json.load(f)
+        scenarios = {"custom": {"depth": args.depth, "fanout": args.fanout, "max_nodes": args.nodes,
+                                "node_mix": node_mix, "seed": args.seed}}
+    else:
+        names = args.scenario or list(DEFAULT_SCENARIOS)
+        scenarios = {name: dict(DEFAULT_SCENARIOS[name], seed=args.seed) for name in names}
+
+    results = {name: run_scenario(name, params, args.repeat, args.stage) for name, params in scenarios.items()}
+    if args.replay:
+        results["replay"] = run_replay(args.replay, args.repeat, args.stage)
+    print_table(results)
+    report = dict(machine_info(), scenarios=results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}", file=sys.stderr)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against, run with --save-baseline first", file=sys.stderr)
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if {name: baseline.get(name) for name in machine_info()} != machine_info():
+        print(f"{args.baseline} was made on another machine or Python, not comparing; "
+              "run with --save-baseline to replace it", file=sys.stderr)
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+from typing import Dict, List
+
+import numpy as np
+
+from instrument import timed
+
+
+# Operator class of a node, by the first marker found in its node type
+OPERATOR_CLASSES = [
+    ("join", ("Join", "Nested Loop")),
+    ("scan", ("Scan",)),
+    ("aggregate", ("Aggregate", "Group")),
+    ("sort", ("Sort",)),
+    ("hash", ("Hash",)),
+    ("materialize", ("Materialize", "Memoize")),
+    ("gather", ("Gather",)),
+    ("append", ("Append",)),
+    ("limit", ("Limit",)),
+    ("window", ("WindowAgg",)),
+]
+
+# Inner sides of a Nested Loop that are built once and only re-read afterwards
+RESCANNED_ONCE = ("Materialize", "Memoize")
+
+_class_cache: Dict[str, str] = {}
+
+
+def operator_class(operation: str) -> str:
+    # Operations repeat a lot (and are interned), so remember the answer
+    found = _class_cache.get(operation)
+    if found is None:
+        node_type = operation.split(" on ")[0]
+        found = next((name for name, markers in OPERATOR_CLASSES
+                      if any(marker in node_type for marker in markers)), "other")
+        _class_cache[operation] = found
+    return found
+
+
+def _is_regular(node) -> bool:
+    return node.relationship not in ("InitPlan", "SubPlan")
+
+
+def executions_per_parent(node, parent, regular_children: list) -> float:
+    """How often `node` runs for one execution of `parent`, by the estimates.
+
+    The inner side of a Nested Loop runs once per outer row, a correlated
+    SubPlan once per row its parent processes; everything else, InitPlans
+    and hashed SubPlans included, runs once.
+    """
+    if node.relationship == "InitPlan":
+        return 1.0
+    if node.relationship == "SubPlan":
+        if (node.subplan_name or "").startswith("hashed"):
+            return 1.0
+        # Evaluated per input row; a scan's input size isn't in the plan,
+        # so its output rows are the best (low) guess
+        return max(regular_children[0].rows if regular_children else parent.rows, 1.0)
+    if (parent.operation.startswith("Nested Loop") and len(regular_children) > 1
+            and node is regular_children[1] and not node.operation.startswith(RESCANNED_ONCE)):
+        return max(regular_children[0].rows, 1.0)
+    return 1.0
+
+
+class PlanArrays:
+    """One tree's node data as parallel arrays, indexed by node id.
+
+    Ids are (re)numbered in pre-order first, so parents always come before
+    their children. Nodes that already have their pre-order id are left
+    alone, so reading a finalized tree never writes to it.
+
+    Attributes:
+        nodes (list): Nodes in id order
+        operator_class (list): Operator class per node
+        parent (np.ndarray): Parent id per node, -1 for the root
+        total_cost, startup_cost, rows (np.ndarray): Per execution estimates
+        loops (np.ndarray): Estimated executions over the whole query
+        exclusive_cost (np.ndarray): Cost of the node alone, per execution
+        attributed_cost (np.ndarray): exclusive_cost times loops
+    """
+
+    def __init__(self, tree):
+        # Same numbering as tree.finalize_id(), in the same walk
+        nodes = []
+        stack = [tree.root]
+        while stack:
+            node = stack.pop()
+            if node.id != len(nodes):
+                node.id = len(nodes)
+            nodes.append(node)
+            stack.extend(reversed(node.children))
+        n = len(nodes)
+        parent = [-1] * n
+        per_parent = [1.0] * n
+        loops = [1.0] * n
+        for node in nodes:
+            if not node.children:
+                continue
+            regular = [child for child in node.children if _is_regular(child)]
+            for child in node.children:
+                parent[child.id] = node.id
+                per_parent[child.id] = executions_per_parent(child, node, regular)
+                # Pre-order: the parent's loops are already known
+                loops[child.id] = loops[node.id] * per_parent[child.id]
+
+        self.nodes = nodes
+        self.parent = np.array(parent, dtype=np.int64)
+        self.total_cost = np.array([node.total_cost for node in nodes], dtype=float)
+        self.startup_cost = np.array([node.startup_cost for node in nodes], dtype=float)
+        self.rows = np.array([node.rows for node in nodes], dtype=float)
+        self.loops = np.array(loops, dtype=float)
+        self.operator_class = [operator_class(node.operation) for node in nodes]
+
+        # Each child's cost is part of its parent's, once per time the parent runs it
+        children = slice(1, None)
+        charged = np.bincount(
+            self.parent[children],
+            weights=self.total_cost[children] * np.array(per_parent[1:], dtype=float),
+            minlength=n,
+        )
+        # Rescans can be cheaper than the child's full cost, never below zero
+        self.exclusive_cost = np.maximum(self.total_cost - charged, 0.0)
+        self.attributed_cost = self.exclusive_cost * self.loops
+
+    def group_costs(self, keys: List[str]) -> List[dict]:
+        """Attributed cost summed per key (None keys are skipped), largest first."""
+        names = sorted({key for key in keys if key is not None})
+        if not names:
+            return []
+        codes = {name: i for i, name in enumerate(names)}
+        # Nodes without a key go to an extra bucket that is dropped
+        index = np.array([codes.get(key, len(names)) for key in keys], dtype=np.int64)
+        sums = np.bincount(index, weights=self.attributed_cost, minlength=len(names) + 1)[:-1]
+        total = float(self.attributed_cost.sum())
+        groups = [
+            {"name": name, "cost": round(cost, 2), "share": round(cost / total, 4) if total else 0.0}
+            for name, cost in zip(names, sums.tolist())
+        ]
+        groups.sort(key=lambda group: group["cost"], reverse=True)
+        return groups
+
+
+@timed("cost_breakdown")
+def attribute_costs(tree, top_n: int = 10) -> dict:
+    """Break a plan's estimated cost down per node, relation and operator.
+
+    Returns:
+        dict: The plan's own "total_cost" and "startup_cost" (the root's),
+            "steps" in post-order, the "top_n" most expensive steps as
+            "hot_spots", and the cost "by_relation" and "by_operator"
+    """
+    arrays = PlanArrays(tree)
+    total = float(arrays.attributed_cost.sum())
+    share = arrays.attributed_cost / total if total else np.zeros(len(arrays.nodes))
+    # Rounded as whole arrays, rounding field by field dominated the runtime
+    startup = np.round(arrays.startup_cost, 2).tolist()
+    total_cost = np.round(arrays.total_cost, 2).tolist()
+    exclusive = np.round(arrays.exclusive_cost, 2).tolist()
+    attributed = np.round(arrays.attributed_cost, 2).tolist()
+    loops = np.round(arrays.loops, 2).tolist()
+    share = np.round(share, 4).tolist()
+    classes = arrays.operator_class
+
+    steps = []
+    for node in tree.traversal():
+        i = node.id
+        steps.append({
+            "id": i,
+            "operation": node.operation,
+            "operator_class": classes[i],
+            "relation": node.relation,
+            "startup_cost": startup[i],
+            "total_cost": total_cost[i],
+            "net_cost": exclusive[i],
+            "loops": loops[i],
+            "attributed_cost": attributed[i],
+            "share": share[i],
+            "condition": node.condition,
+        })
+    hot_spots = sorted(steps, key=lambda step: step["attributed_cost"], reverse=True)[:top_n]
+    return {
+        "total_cost": round(tree.root.total_cost, 2),
+        "startup_cost": round(tree.root.startup_cost, 2),
+        "attributed_cost": round(total, 2),
+        "steps": steps,
+        "hot_spots": hot_spots,
+        "by_relation": arrays.group_costs([node.relation for node in arrays.nodes]),
+        "by_operator": arrays.group_costs(arrays.operator_class),
+    }
+
+
+def exclusive_costs(tree) -> List[float]:
+    """Per execution cost of each node alone, by node id."""
+    return PlanArrays(tree).exclusive_cost.tolist()
@@ -0,0 +1,322 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+from instrument import count, span
+
+
+SUPPORTED_DBMS = ("postgresql", "mysql")
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def normalize_dbms(dbms: str) -> str:
+    name = (dbms or "").strip().lower()
+    if name in ("postgres", "postgresql"):
+        return "postgresql"
+    if name == "mysql":
+        return "mysql"
+    raise ValueError(f"Unsupported database: {dbms}")
+
+
+def _connect_postgresql(db_config: dict, connect_timeout: int):
+    import psycopg2
+
+    config = dict(db_config)
+    config.setdefault("connect_timeout", connect_timeout)
+    return psycopg2.connect(**config)
+
+
+def _connect_mysql(db_config: dict, connect_timeout: int):
+    import mysql.connector
+
+    config = dict(db_config)
+    # The login form uses the psycopg2 name for the database
+    if "dbname" in config:
+        config["database"] = config.pop("dbname")
+    if "port" in config:
+        config["port"] = int(config["port"])
+    config.setdefault("connection_timeout", connect_timeout)
+    return mysql.connector.connect(**config)
+
+
+def _is_closed(dbms: str, conn) -> bool:
+    if dbms == "postgresql":
+        return bool(conn.closed)
+    # is_connected() would ping the server; the connection id is only
+    # known while the connection is open, and costs no round trip
+    return conn.connection_id is None
+
+
+class ConnectionPool:
+    """A small blocking pool of DB-API connections.
+
+    At most `size` connections exist at once; `acquire` waits for a free slot
+    instead of failing, which keeps concurrent callers bounded against the
+    server's `max_connections`.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], object],
+        size: int = 4,
+        is_alive: Optional[Callable[[object, float], bool]] = None,
+        close: Optional[Callable[[object], None]] = None,
+    ):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.size = size
+        self._connect = connect
+        self._is_alive = is_alive or (lambda conn, idle: True)
+        self._close = close or (lambda conn: conn.close())
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # Idle connections with the time they were returned, most recent last
+        self._idle: List[tuple] = []
+        self._in_use = set()
+        self._closed = False
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, timeout: Optional[float] = None):
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        if not self._slots.acquire(timeout=timeout if timeout is not None else -1):
+            raise PoolTimeout(f"No free connection after {timeout}s")
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use.add(conn)
+        return conn
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                item = self._idle.pop() if self._idle else None
+            if item is None:
+                with span("connect"):
+                    conn = self._connect()
+                self.created += 1
+                count("connections.created")
+                return conn
+            conn, returned_at = item
+            if self._is_alive(conn, time.monotonic() - returned_at):
+                self.reused += 1
+                count("connections.reused")
+                return conn
+            # Stale connection (server restart, idle timeout...), drop it
+            self._discard(conn)
+
+    def release(self, conn, broken: bool = False):
+        with self._lock:
+            self._in_use.discard(conn)
+            keep = not (broken or self._closed)
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+        if not keep:
+            self._discard(conn)
+        self._slots.release()
+
+    def in_use(self) -> list:
+        with self._lock:
+            return list(self._in_use)
+
+    def _discard(self, conn):
+        try:
+            self._close(conn)
+        except Exception:
+            pass
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+class DBSession:
+    """Pooled connections to one database, created once at login.
+
+    Every EXPLAIN goes through `cursor()`, which checks a connection out of
+    the pool, applies the statement timeout and always rolls back, so nothing
+    an EXPLAIN does (e.g. ANALYZE) is ever committed.
+
+    Args:
+        dbms (str): "postgresql" (or "postgres") or "mysql"
+        db_config (dict): Keyword arguments for the driver's connect()
+        pool_size (int): Maximum number of open connections
+        statement_timeout (float): Default per-statement timeout in seconds,
+            None to use the server default
+        health_check_interval (float): Idle connections older than this
+            are pinged before being handed out again
+    """
+
+    def __init__(
+        self,
+        dbms: str,
+        db_config: dict,
+        pool_size: int = 4,
+        statement_timeout: Optional[float] = None,
+        health_check_interval: float = 30.0,
+        connect_timeout: int = 10,
+    ):
+        self.dbms = normalize_dbms(dbms)
+        self.db_config = dict(db_config)
+        self.statement_timeout = statement_timeout
+        self.health_check_interval = health_check_interval
+        connect = _connect_postgresql if self.dbms == "postgresql" else _connect_mysql
+        self._connect = lambda: connect(self.db_config, connect_timeout)
+        self.pool = ConnectionPool(self._connect, size=pool_size, is_alive=self._is_alive)
+        # Connection each thread is currently running statements on, for cancel()
+        self._active = {}
+        self._active_lock = threading.Lock()
+
+    @property
+    def pool_size(self) -> int:
+        return self.pool.size
+
+    def _is_alive(self, conn, idle_seconds: float) -> bool:
+        if _is_closed(self.dbms, conn):
+            return False
+        if idle_seconds < self.health_check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchall()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _set_timeout(self, cur, timeout: Optional[float]):
+        if timeout is None:
+            return
+        ms = int(timeout * 1000)
+        if self.dbms == "postgresql":
+            # SET LOCAL only lasts until the rollback at the end of cursor()
+            cur.execute(f"SET LOCAL statement_timeout = {ms}")
+        else:
+            # A session variable outlives the rollback: _reset_timeout puts
+            # it back before the connection returns to the pool
+            cur.execute(f"SET SESSION max_execution_time = {ms}")
+
+    def _reset_timeout(self, conn, cur):
+        try:
+            cur.execute("SET SESSION max_execution_time = DEFAULT")
+        except Exception:
+            # Don't pool a connection that may still carry the timeout,
+            # connection() discards it once it's closed
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        """Check a healthy connection out of the pool for the block."""
+        conn = self.pool.acquire(timeout=timeout)
+        thread_id = threading.get_ident()
+        with self._active_lock:
+            self._active[thread_id] = conn
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = _is_closed(self.dbms, conn)
+            raise
+        finally:
+            with self._active_lock:
+                self._active.pop(thread_id, None)
+            broken = broken or _is_closed(self.dbms, conn)
+            if not broken:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            self.pool.release(conn, broken=broken)
+
+    @contextmanager
+    def cursor(self, timeout: Optional[float] = None, dictionary: bool = False):
+        """Cursor on a pooled connection with the statement timeout applied.
+
+        Args:
+            timeout (float): Overrides the session's statement_timeout
+            dictionary (bool): MySQL only, return rows as dicts
+        """
+        if timeout is None:
+            timeout = self.statement_timeout
+        with self.connection() as conn:
+            if self.dbms == "mysql" and dictionary:
+                cur = conn.cursor(dictionary=True)
+            else:
+                cur = conn.cursor()
+            try:
+                self._set_timeout(cur, timeout)
+                yield cur
+            finally:
+                if self.dbms == "mysql" and timeout is not None:
+                    self._reset_timeout(conn, cur)
+                cur.close()
+
+    def cancel(self, thread_id: Optional[int] = None) -> int:
+        """Cancel the statement running on `thread_id`'s connection.
+
+        With no thread given, every in-flight statement of the session is
+        cancelled. The interrupted call raises in its own thread (e.g.
+        QueryCanceled) and its connection goes back to the pool.
+
+        Returns:
+            int: Number of statements a cancel request was sent for
+        """
+        with self._active_lock:
+            if thread_id is None:
+                targets = list(self._active.values())
+            else:
+                targets = [self._active[thread_id]] if thread_id in self._active else []
+        for conn in targets:
+            if self.dbms == "postgresql":
+                # Same as pg_cancel_backend() on this connection's backend
+                conn.cancel()
+            else:
+                killer = self._connect()
+                try:
+                    cur = killer.cursor()
+                    cur.execute(f"KILL QUERY {int(conn.connection_id)}")
+                    cur.close()
+                finally:
+                    killer.close()
+        return len(targets)
+
+    def ping(self) -> bool:
+        with self.cursor() as cur:
+            cur.execute("SELECT 1")
+            return cur.fetchone()[0] == 1
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_session(dbms: str, db_config: dict, **kwargs) -> DBSession:
+    """Create a session and make sure the database is reachable."""
+    session = DBSession(dbms, db_config, **kwargs)
+    try:
+        session.ping()
+    except Exception:
+        session.close()
+        raise
+    return session
@@ -0,0 +1,1849 @@
+import argparse
+import csv
+import gzip
+import itertools
+import json
+import os
+import re
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from analysis import MISESTIMATE_FACTOR, estimate_direction, estimate_error
+from instrument import timed
+from pipesyntax import Pipeline, build_pipeline, text_plan
+
+
+# Rows per batch read from a data file; every streaming operator works batch by batch
+BATCH_ROWS = 65536
+# Result rows kept for display; the rest are only counted
+KEEP_ROWS = 20
+
+# dbgen's .tbl files have no header, so their columns come from here
+TPCH_SCHEMA = {
+    "region": [("r_regionkey", "int"), ("r_name", "str"), ("r_comment", "str")],
+    "nation": [("n_nationkey", "int"), ("n_name", "str"), ("n_regionkey", "int"), ("n_comment", "str")],
+    "part": [("p_partkey", "int"), ("p_name", "str"), ("p_mfgr", "str"), ("p_brand", "str"),
+             ("p_type", "str"), ("p_size", "int"), ("p_container", "str"), ("p_retailprice", "float"),
+             ("p_comment", "str")],
+    "supplier": [("s_suppkey", "int"), ("s_name", "str"), ("s_address", "str"), ("s_nationkey", "int"),
+                 ("s_phone", "str"), ("s_acctbal", "float"), ("s_comment", "str")],
+    "partsupp": [("ps_partkey", "int"), ("ps_suppkey", "int"), ("ps_availqty", "int"),
+                 ("ps_supplycost", "float"), ("ps_comment", "str")],
+    "customer": [("c_custkey", "int"), ("c_name", "str"), ("c_address", "str"), ("c_nationkey", "int"),
+                 ("c_phone", "str"), ("c_acctbal", "float"), ("c_mktsegment", "str"), ("c_comment", "str")],
+    "orders": [("o_orderkey", "int"), ("o_custkey", "int"), ("o_orderstatus", "str"),
+               ("o_totalprice", "float"), ("o_orderdate", "date"), ("o_orderpriority", "str"),
+               ("o_clerk", "str"), ("o_shippriority", "int"), ("o_comment", "str")],
+    "lineitem": [("l_orderkey", "int"), ("l_partkey", "int"), ("l_suppkey", "int"), ("l_linenumber", "int"),
+                 ("l_quantity", "float"), ("l_extendedprice", "float"), ("l_discount", "float"),
+                 ("l_tax", "float"), ("l_returnflag", "str"), ("l_linestatus", "str"), ("l_shipdate", "date"),
+                 ("l_commitdate", "date"), ("l_receiptdate", "date"), ("l_shipinstruct", "str"),
+                 ("l_shipmode", "str"), ("l_comment", "str")],
+}
+DTYPES = {"int": np.int64, "float": np.float64, "date": "datetime64[D]", "str": np.str_}
+
+DATA_SUFFIXES = (".tbl", ".csv", ".tbl.gz", ".csv.gz")
+# Plan keys holding expressions; list-valued ones hold one expression per entry
+EXPRESSION_KEYS = ("Filter", "Index Cond", "Recheck Cond", "Hash Cond", "Merge Cond", "Join Filter",
+                   "Sort Key", "Group Key", "Output")
+SCAN_NODES = {"Seq Scan", "Index Scan", "Index Only Scan", "Bitmap Heap Scan", "Tid Scan"}
+# Nodes that hand their input on unchanged, as far as rows go
+PASS_THROUGH = {"Hash", "Materialize", "Memoize", "Gather", "Gather Merge", "Result"}
+JOIN_NODES = {"Hash Join", "Merge Join", "Nested Loop"}
+SORT_NODES = {"Sort", "Incremental Sort"}
+# Children that feed an expression rather than the node's rows
+SIDE_RELATIONSHIPS = {"InitPlan", "SubPlan"}
+AGGREGATES = {"count", "sum", "avg", "min", "max"}
+# The partial states an aggregate is computed from; Partial aggregates emit
+# them, Finalize aggregates merge them
+AGGREGATE_STATES = {"count": ("count",), "sum": ("sum",), "avg": ("sum", "count"),
+                    "min": ("min",), "max": ("max",)}
+
+
+class UnsupportedPlan(ValueError):
+    pass
+
+
+class UnsupportedExpression(ValueError):
+    pass
+
+
+# Expressions
+#
+# Plans print expressions in PostgreSQL's own deparsed form, e.g.
+# ((l_shipdate <= '1998-09-02'::date) AND (l_discount >= 0.05)). They are
+# parsed into tuples ("col", name), ("const", value), ("op", op, a, b), ...
+# and evaluated a whole batch at a time.
+
+TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<num>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+  | (?P<str>'(?:[^']|'')*')
+  | (?P<qid>"(?:[^"]|"")*")
+  | (?P<id>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<param>\$\d+)
+  | (?P<op>::|<=|>=|<>|!=|!~~\*|!~~|~~\*|~~|\|\||[-+*/%=<>(),.\[\]])
+)""", re.X)
+COMPARISONS = {"=", "<>", "!=", "<", ">", "<=", ">=", "~~", "!~~", "~~*", "!~~*"}
+# Words that continue a type name: "timestamp without time zone", "double precision"
+TYPE_WORDS = {"without", "with", "time", "zone", "precision", "varying"}
+SORT_SUFFIX_RE = re.compile(r"\s+(?:(ASC|DESC)|NULLS (?:FIRST|LAST)|USING \S+)\s*$", re.I)
+
+
+def tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = TOKEN_RE.match(text, pos)
+        if match is None or match.end() == pos:
+            raise UnsupportedExpression(f"Cannot parse {text[pos:pos + 20]!r}")
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, text: str):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self, offset: int = 0) -> Tuple[str, str]:
+        index = self.pos + offset
+        return self.tokens[index] if index < len(self.tokens) else ("end", "")
+
+    def take(self) -> Tuple[str, str]:
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, text: str):
+        kind, value = self.take()
+        if value != text:
+            raise UnsupportedExpression(f"Expected {text!r}")
+
+    def keyword(self, *words: str) -> bool:
+        kind, value = self.peek()
+        return kind == "id" and value.upper() in words
+
+    def parse(self):
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise UnsupportedExpression(f"Unexpected {self.peek()[1]!r}")
+        return node
+
+    def parse_or(self):
+        items = [self.parse_and()]
+        while self.keyword("OR"):
+            self.take()
+            items.append(self.parse_and())
+        return items[0] if len(items) == 1 else ("or", items)
+
+    def parse_and(self):
+        items = [self.parse_not()]
+        while self.keyword("AND"):
+            self.take()
+            items.append(self.parse_not())
+        return items[0] if len(items) == 1 else ("and", items)
+
+    def parse_not(self):
+        if self.keyword("NOT"):
+            self.take()
+            return ("not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_additive()
+        kind, value = self.peek()
+        if kind == "op" and value in COMPARISONS:
+            self.take()
+            if self.keyword("ANY", "SOME", "ALL"):
+                quantifier = self.take()[1].upper()
+                self.expect("(")
+                values = self.parse_or()
+                self.expect(")")
+                return ("any", value, left, values, quantifier == "ALL")
+            return ("op", value, left, self.parse_additive())
+        if self.keyword("IS"):
+            self.take()
+            negated = self.keyword("NOT")
+            if negated:
+                self.take()
+            if not self.keyword("NULL"):
+                raise UnsupportedExpression("Unsupported IS test")
+            self.take()
+            return ("isnull", left, negated)
+        # MySQL's converted plans keep SQL's own LIKE
+        negated = self.keyword("NOT") and self.peek(1)[1].upper() == "LIKE"
+        if negated or self.keyword("LIKE"):
+            self.pos += 2 if negated else 1
+            return ("op", "!~~" if negated else "~~", left, self.parse_additive())
+        return left
+
+    def parse_additive(self):
+        node = self.parse_multiplicative()
+        while self.peek()[1] in ("+", "-", "||"):
+            op = self.take()[1]
+            node = ("op", op, node, self.parse_multiplicative())
+        return node
+
+    def parse_multiplicative(self):
+        node = self.parse_unary()
+        while self.peek()[1] in ("*", "/", "%"):
+            op = self.take()[1]
+            node = ("op", op, node, self.parse_unary())
+        return node
+
+    def parse_unary(self):
+        if self.peek()[1] == "-":
+            self.take()
+            return ("neg", self.parse_unary())
+        node = self.parse_primary()
+        while self.peek()[1] == "::":
+            self.take()
+            node = ("cast", node, self.parse_type())
+        return node
+
+    def parse_type(self) -> str:
+        kind, value = self.take()
+        if kind not in ("id", "qid"):
+            raise UnsupportedExpression("Expected a type")
+        words = [value.strip('"')]
+        while self.peek()[0] == "id" and self.peek()[1].lower() in TYPE_WORDS:
+            words.append(self.take()[1])
+        if self.peek()[1] == "(":
+            # character(25), numeric(15,2): the modifiers don't matter here
+            while self.take()[1] != ")":
+                pass
+        type_name = " ".join(words).lower()
+        if self.peek()[1] == "[":
+            self.take()
+            self.expect("]")
+            type_name += "[]"
+        return type_name
+
+    def parse_primary(self):
+        kind, value = self.take()
+        if value == "(":
+            node = self.parse_or()
+            self.expect(")")
+            return node
+        if kind == "num":
+            return ("const", float(value) if any(c in value for c in ".eE") else int(value))
+        if kind == "str":
+            return ("const", value[1:-1].replace("''", "'"))
+        if kind == "param":
+            raise UnsupportedExpression(f"Parameter {value} comes from a subplan")
+        if kind not in ("id", "qid"):
+            raise UnsupportedExpression(f"Unexpected {value!r}")
+        word = value.upper() if kind == "id" else None
+        if word == "NULL":
+            return ("const", None)
+        if word in ("TRUE", "FALSE"):
+            return ("const", word == "TRUE")
+        if word == "CASE":
+            return self.parse_case()
+        if word == "PARTIAL":
+            return ("partial", self.parse_unary())
+        if word in ("SUBPLAN", "INITPLAN", "HASHED"):
+            raise UnsupportedExpression("Subplans aren't executed")
+        name = value.strip('"')
+        while self.peek()[1] == ".":
+            self.take()
+            name += "." + self.take()[1].strip('"')
+        if self.peek()[1] == "(":
+            return self.parse_call(name.lower())
+        return ("col", name)
+
+    def parse_call(self, name: str):
+        self.expect("(")
+        args, distinct = [], False
+        if self.peek()[1] == "*":
+            self.take()
+            self.expect(")")
+            return ("call", name, [], False)
+        if self.keyword("DISTINCT"):
+            self.take()
+            distinct = True
+        while self.peek()[1] != ")":
+            args.append(self.parse_or())
+            # EXTRACT(year FROM x), SUBSTRING(x FROM 1 FOR 2)
+            if self.peek()[1] == "," or self.keyword("FROM", "FOR"):
+                self.take()
+            elif self.peek()[1] != ")":
+                raise UnsupportedExpression("Unsupported call syntax")
+        self.take()
+        return ("call", name, args, distinct)
+
+    def parse_case(self):
+        branches, default = [], None
+        while self.keyword("WHEN"):
+            self.take()
+            condition = self.parse_or()
+            if not self.keyword("THEN"):
+                raise UnsupportedExpression("Expected THEN")
+            self.take()
+            branches.append((condition, self.parse_or()))
+        if self.keyword("ELSE"):
+            self.take()
+            default = self.parse_or()
+        if not self.keyword("END"):
+            raise UnsupportedExpression("Unsupported CASE")
+        self.take()
+        return ("case", branches, default)
+
+
+def parse_expression(text: str):
+    return _Parser(text).parse()
+
+
+def split_list(value) -> List[str]:
+    """A plan list ("Sort Key", "Output") as one string per expression.
+
+    Text EXPLAIN prints the list on one line, so entries are also split at
+    commas outside parentheses and quotes.
+    """
+    if value is None:
+        return []
+    items = []
+    for entry in ([value] if isinstance(value, str) else value):
+        depth, start, quoted = 0, 0, False
+        for i, char in enumerate(entry):
+            if char == "'":
+                quoted = not quoted
+            elif quoted:
+                continue
+            elif char in "([":
+                depth += 1
+            elif char in ")]":
+                depth -= 1
+            elif char == "," and depth == 0:
+                items.append(entry[start:i].strip())
+                start = i + 1
+        items.append(entry[start:].strip())
+    return [item for item in items if item]
+
+
+def split_and(text: str) -> List[str]:
+    """A condition's top-level AND terms, as text, so one unsupported term
+    (a SubPlan, say) doesn't take the others down with it."""
+    text = text.strip()
+    while text.startswith("(") and _closing_paren(text, 0) == len(text) - 1:
+        text = text[1:-1].strip()
+    terms, depth, start, quoted = [], 0, 0, False
+    for i, char in enumerate(text):
+        if char == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif depth == 0 and text.startswith(" AND ", i):
+            terms.append(text[start:i])
+            start = i + len(" AND ")
+    terms.append(text[start:])
+    return [term.strip() for term in terms] if len(terms) > 1 else [text]
+
+
+def _closing_paren(text: str, start: int) -> int:
+    depth, quoted = 0, False
+    for i in range(start, len(text)):
+        char = text[i]
+        if char == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    return -1
+
+
+def conjuncts(node) -> list:
+    return node[1] if node[0] == "and" else [node]
+
+
+def column_refs(node, found: Optional[set] = None) -> set:
+    """Every column name the expression reads, as written (maybe qualified)."""
+    found = set() if found is None else found
+    kind = node[0]
+    if kind == "col":
+        found.add(node[1])
+    elif kind in ("op", "any"):
+        column_refs(node[2], found)
+        column_refs(node[3], found)
+    elif kind in ("and", "or"):
+        for item in node[1]:
+            column_refs(item, found)
+    elif kind in ("not", "neg", "partial", "isnull", "cast"):
+        column_refs(node[1], found)
+    elif kind == "call":
+        for arg in node[2]:
+            column_refs(arg, found)
+    elif kind == "case":
+        for condition, value in node[1]:
+            column_refs(condition, found)
+            column_refs(value, found)
+        if node[2] is not None:
+            column_refs(node[2], found)
+    return found
+
+
+def aggregate_calls(node, found: Optional[dict] = None) -> dict:
+    """The aggregate calls in an expression, by canonical text."""
+    found = {} if found is None else found
+    kind = node[0]
+    if kind == "call" and node[1] in AGGREGATES or kind == "partial":
+        found.setdefault(canonical(node), node)
+        return found
+    if kind in ("op", "any"):
+        aggregate_calls(node[2], found)
+        aggregate_calls(node[3], found)
+    elif kind in ("and", "or"):
+        for item in node[1]:
+            aggregate_calls(item, found)
+    elif kind in ("not", "neg", "isnull", "cast"):
+        aggregate_calls(node[1], found)
+    elif kind == "call":
+        for arg in node[2]:
+            aggregate_calls(arg, found)
+    elif kind == "case":
+        for condition, value in node[1]:
+            aggregate_calls(condition, found)
+            aggregate_calls(value, found)
+        if node[2] is not None:
+            aggregate_calls(node[2], found)
+    return found
+
+
+def canonical(node) -> str:
+    """The name a computed column goes by, whether or not the plan qualified its columns."""
+    kind = node[0]
+    if kind == "col":
+        return node[1].rsplit(".", 1)[-1]
+    if kind == "const":
+        value = node[1]
+        if value is None:
+            return "NULL"
+        return f"'{value}'" if isinstance(value, str) else repr(value)
+    if kind == "cast":
+        return f"{canonical(node[1])}::{node[2]}"
+    if kind == "op":
+        return f"({canonical(node[2])} {node[1]} {canonical(node[3])})"
+    if kind == "neg":
+        return f"(-{canonical(node[1])})"
+    if kind in ("and", "or"):
+        return "(" + f" {kind.upper()} ".join(canonical(item) for item in node[1]) + ")"
+    if kind == "not":
+        return f"(NOT {canonical(node[1])})"
+    if kind == "any":
+        return f"({canonical(node[2])} {node[1]} {'ALL' if node[4] else 'ANY'} ({canonical(node[3])}))"
+    if kind == "isnull":
+        return f"({canonical(node[1])} IS {'NOT ' if node[2] else ''}NULL)"
+    if kind == "call":
+        args = ", ".join(canonical(arg) for arg in node[2]) or "*"
+        return f"{node[1]}({'DISTINCT ' if node[3] else ''}{args})"
+    if kind == "partial":
+        return canonical(node[1])
+    if kind == "case":
+        parts = [f"WHEN {canonical(c)} THEN {canonical(v)}" for c, v in node[1]]
+        if node[2] is not None:
+            parts.append(f"ELSE {canonical(node[2])}")
+        return "CASE " + " ".join(parts) + " END"
+    raise UnsupportedExpression(f"Unknown expression {kind}")
+
+
+def resolve(name: str, columns, strict: bool = False) -> Optional[str]:
+    """The batch column `name` refers to: exact, else the only one with that column name.
+
+    With `strict`, a qualified name only matches itself, so l1.l_orderkey
+    isn't taken for l2.l_orderkey in a self-join.
+    """
+    if name in columns:
+        return name
+    if strict and "." in name:
+        return None
+    suffix = "." + name.rsplit(".", 1)[-1]
+    matches = [column for column in columns if column.endswith(suffix)]
+    if len(matches) == 1:
+        return matches[0]
+    return None
+
+
+def null_mask(values: np.ndarray) -> np.ndarray:
+    # Outer joins fill missing floats with NaN, dates with NaT and strings with ""
+    kind = values.dtype.kind
+    if kind == "f":
+        return np.isnan(values)
+    if kind == "M":
+        return np.isnat(values)
+    if kind == "U":
+        return values == ""
+    if kind == "O":
+        return np.equal(values, None)
+    return np.zeros(len(values), dtype=bool)
+
+
+def nulls(like: np.ndarray, n: int) -> np.ndarray:
+    kind = like.dtype.kind
+    if kind == "M":
+        return np.full(n, np.datetime64("NaT"), dtype=like.dtype)
+    if kind == "U":
+        return np.full(n, "", dtype=like.dtype)
+    if kind in "iufb":
+        return np.full(n, np.nan)
+    return np.full(n, None, dtype=object)
+
+
+def like_regex(pattern: str, ignore_case: bool = False):
+    parts = []
+    for char in pattern:
+        parts.append(".*" if char == "%" else "." if char == "_" else re.escape(char))
+    return re.compile("".join(parts), re.S | (re.I if ignore_case else 0))
+
+
+def cast_constant(value, type_name: str):
+    if value is None:
+        return None
+    base = type_name[:-2] if type_name.endswith("[]") else type_name
+    if type_name.endswith("[]"):
+        # '{49,14,23}'::integer[]
+        items = next(csv.reader([value.strip("{}")], skipinitialspace=True)) if value.strip("{}") else []
+        return [cast_constant(item, base) for item in items]
+    if base == "date":
+        return np.datetime64(str(value)[:10], "D")
+    if base.startswith("timestamp"):
+        text = str(value).replace(" ", "T")
+        return np.datetime64(text[:10], "D") if text.endswith("T00:00:00") else np.datetime64(text[:19], "s")
+    if base in ("integer", "bigint", "smallint", "int", "int4", "int8", "int2"):
+        return int(value)
+    if base in ("numeric", "double precision", "real", "float8", "float4", "decimal"):
+        return float(value)
+    if base in ("text", "bpchar", "character", "character varying", "varchar", "name", "char"):
+        return str(value)
+    raise UnsupportedExpression(f"Constants of type {type_name} aren't supported")
+
+
+def cast_array(values, type_name: str):
+    if type_name == "date" and isinstance(values, np.ndarray):
+        return values.astype("datetime64[D]")
+    if type_name.startswith("timestamp") and isinstance(values, np.ndarray):
+        return values.astype("datetime64[s]")
+    if type_name in ("numeric", "double precision", "real") and isinstance(values, np.ndarray):
+        return values.astype(np.float64)
+    if type_name in ("text", "bpchar", "character", "character varying", "varchar") and isinstance(values, np.ndarray):
+        return values if values.dtype.kind == "U" else values.astype(np.str_)
+    # Other casts don't change how values compare here
+    return values
+
+
+def _compare(op: str, a, b):
+    if op == "=":
+        return a == b
+    if op in ("<>", "!="):
+        return a != b
+    if op == "<":
+        return a < b
+    if op == ">":
+        return a > b
+    if op == "<=":
+        return a <= b
+    if op == ">=":
+        return a >= b
+    # LIKE patterns are constants in every plan worth running
+    if not isinstance(b, str):
+        raise UnsupportedExpression("LIKE with a non-constant pattern")
+    ignore_case = op.endswith("*")
+    negated = op.startswith("!")
+    values = np.asarray(a).astype(np.str_)
+    if ignore_case:
+        values, b = np.char.lower(values), b.lower()
+    inner = b.strip("%")
+    if "_" not in b and "%" not in inner:
+        # The common shapes get NumPy's string kernels instead of a regex per row
+        if b.startswith("%") and b.endswith("%") and len(b) > 1:
+            result = np.char.find(values, inner) >= 0
+        elif b.endswith("%"):
+            result = np.char.startswith(values, inner)
+        elif b.startswith("%"):
+            result = np.char.endswith(values, inner)
+        else:
+            result = values == b
+    else:
+        regex = like_regex(b)
+        result = np.fromiter((regex.fullmatch(value) is not None for value in values), dtype=bool,
+                             count=len(values))
+    return ~result if negated else result
+
+
+def _arithmetic(op: str, a, b):
+    if op == "+":
+        return a + b
+    if op == "-":
+        return a - b
+    if op == "*":
+        return a * b
+    if op == "/":
+        a_int = np.issubdtype(np.asarray(a).dtype, np.integer)
+        b_int = np.issubdtype(np.asarray(b).dtype, np.integer)
+        # Integer division truncates in SQL
+        return np.floor_divide(a, b) if a_int and b_int else np.true_divide(a, b)
+    if op == "%":
+        return np.mod(a, b)
+    if op == "||":
+        return np.char.add(np.asarray(a).astype(np.str_), np.asarray(b).astype(np.str_))
+    raise UnsupportedExpression(f"Operator {op}")
+
+
+def _call(node, batch: "Batch"):
+    name, args = node[1], node[2]
+    if name in AGGREGATES:
+        raise UnsupportedExpression(f"{canonical(node)} isn't computed below this node")
+    if name in ("extract", "date_part"):
+        field = args[0][1] if args[0][0] in ("col", "const") else None
+        values = evaluate(args[1], batch)
+        field = str(field).lower()
+        if field == "year":
+            return values.astype("datetime64[Y]").astype(np.int64) + 1970
+        if field == "month":
+            return values.astype("datetime64[M]").astype(np.int64) % 12 + 1
+        if field == "day":
+            return (values - values.astype("datetime64[M]")).astype(np.int64) + 1
+        raise UnsupportedExpression(f"{name}({field})")
+    values = [evaluate(arg, batch) for arg in args]
+    if name in ("lower", "upper"):
+        return getattr(np.char, name)(np.asarray(values[0]).astype(np.str_))
+    if name == "abs":
+        return np.abs(values[0])
+    if name == "round":
+        return np.round(values[0], int(values[1]) if len(values) > 1 else 0)
+    if name in ("substring", "substr"):
+        start = int(values[1]) - 1
+        stop = start + int(values[2]) if len(values) > 2 else None
+        strings = np.asarray(values[0]).astype(np.str_)
+        return np.array([value[start:stop] for value in strings], dtype=np.str_)
+    if name == "coalesce":
+        result = np.array(values[0], copy=True)
+        for value in values[1:]:
+            missing = null_mask(result)
+            result[missing] = np.broadcast_to(value, result.shape)[missing]
+        return result
+    raise UnsupportedExpression(f"Function {name}() isn't supported")
+
+
+def evaluate(node, batch: "Batch"):
+    """Evaluate an expression over a batch: an array of batch.length values, or a constant."""
+    kind = node[0]
+    if kind == "col":
+        return batch.column(node[1])
+    if kind == "const":
+        return node[1]
+    if kind != "partial":
+        # Computed below, e.g. an aggregate a Sort or HAVING refers to
+        name = canonical(node)
+        if name in batch.columns:
+            return batch.columns[name]
+    if kind == "cast":
+        inner = node[1]
+        if inner[0] == "const":
+            return cast_constant(inner[1], node[2])
+        return cast_array(evaluate(inner, batch), node[2])
+    if kind == "op":
+        a, b = evaluate(node[2], batch), evaluate(node[3], batch)
+        if node[1] in COMPARISONS:
+            return _compare(node[1], a, b)
+        return _arithmetic(node[1], a, b)
+    if kind == "and":
+        result = evaluate(node[1][0], batch)
+        for item in node[1][1:]:
+            result = np.logical_and(result, evaluate(item, batch))
+        return result
+    if kind == "or":
+        result = evaluate(node[1][0], batch)
+        for item in node[1][1:]:
+            result = np.logical_or(result, evaluate(item, batch))
+        return result
+    if kind == "not":
+        return np.logical_not(evaluate(node[1], batch))
+    if kind == "neg":
+        return -evaluate(node[1], batch)
+    if kind == "any":
+        values = evaluate(node[2], batch)
+        options = evaluate(node[3], batch)
+        if not isinstance(options, list):
+            raise UnsupportedExpression("ANY over a non-constant array")
+        if node[1] == "=" and not node[4]:
+            return np.isin(values, np.array(options))
+        if node[1] in ("<>", "!=") and node[4]:
+            return ~np.isin(values, np.array(options))
+        results = [_compare(node[1], values, option) for option in options]
+        if not results:
+            return np.full(batch.length, node[4])
+        combine = np.logical_and if node[4] else np.logical_or
+        result = results[0]
+        for item in results[1:]:
+            result = combine(result, item)
+        return result
+    if kind == "isnull":
+        values = evaluate(node[1], batch)
+        if not isinstance(values, np.ndarray):
+            return np.full(batch.length, (values is None) != node[2])
+        mask = null_mask(values)
+        return ~mask if node[2] else mask
+    if kind == "call":
+        return _call(node, batch)
+    if kind == "case":
+        conditions = [np.broadcast_to(evaluate(c, batch), (batch.length,)) for c, _ in node[1]]
+        values = [np.broadcast_to(evaluate(v, batch), (batch.length,)) for _, v in node[1]]
+        if node[2] is not None:
+            default = np.broadcast_to(evaluate(node[2], batch), (batch.length,))
+        else:
+            default = nulls(values[0], batch.length) if values else np.full(batch.length, np.nan)
+        return np.select(conditions, values, default)
+    if kind == "partial":
+        raise UnsupportedExpression("PARTIAL outside an aggregate")
+    raise UnsupportedExpression(f"Unknown expression {kind}")
+
+
+def evaluate_mask(node, batch: "Batch") -> np.ndarray:
+    result = evaluate(node, batch)
+    if not isinstance(result, np.ndarray):
+        return np.full(batch.length, bool(result))
+    return result.astype(bool, copy=False)
+
+
+# Batches
+
+class Batch:
+    """Columns of equal length, keyed "alias.column" for scanned columns
+    and by canonical text for computed ones."""
+
+    __slots__ = ("columns", "length")
+
+    def __init__(self, columns: Dict[str, np.ndarray], length: Optional[int] = None):
+        self.columns = columns
+        if length is None:
+            length = len(next(iter(columns.values()))) if columns else 0
+        self.length = length
+
+    def column(self, name: str) -> np.ndarray:
+        key = resolve(name, self.columns)
+        if key is None:
+            raise KeyError(name)
+        return self.columns[key]
+
+    def take(self, index: np.ndarray) -> "Batch":
+        columns = {name: values[index] for name, values in self.columns.items()}
+        length = int(index.sum()) if index.dtype == bool else len(index)
+        return Batch(columns, length)
+
+    def slice(self, start: int, stop: int) -> "Batch":
+        stop = min(stop, self.length)
+        return Batch({name: values[start:stop] for name, values in self.columns.items()}, stop - start)
+
+
+def concat_batches(batches: List[Batch], columns: List[str]) -> Batch:
+    if not batches:
+        return Batch({name: np.empty(0) for name in columns}, 0)
+    if len(batches) == 1:
+        return batches[0]
+    return Batch({name: np.concatenate([batch.columns[name] for batch in batches])
+                  for name in batches[0].columns}, sum(batch.length for batch in batches))
+
+
+def split_batch(batch: Batch, batch_rows: int) -> Iterator[Batch]:
+    if batch.length <= batch_rows:
+        if batch.length:
+            yield batch
+        return
+    for start in range(0, batch.length, batch_rows):
+        yield batch.slice(start, start + batch_rows)
+
+
+# Keys: sorted lookup tables stand in for hash tables, which NumPy doesn't
+# have. Each key column becomes dense codes via its sorted distinct values,
+# and multi-column keys are folded into one code column by column.
+
+class KeyIndex:
+    """Lookup table over the build side's join keys."""
+
+    def __init__(self, keys: List[np.ndarray]):
+        self.dictionaries = []
+        codes = None
+        for values in keys:
+            distinct, inverse = np.unique(values, return_inverse=True)
+            if codes is None:
+                codes = inverse.astype(np.int64)
+                self.dictionaries.append((distinct, None))
+            else:
+                # Re-compacted after every column so codes can't overflow
+                combined, codes = np.unique(codes * len(distinct) + inverse, return_inverse=True)
+                self.dictionaries.append((distinct, combined))
+        self.order = np.argsort(codes, kind="stable")
+        self.sorted_codes = codes[self.order]
+        self.length = len(codes)
+
+    def lookup(self, keys: List[np.ndarray]) -> np.ndarray:
+        """Codes of the probe side's keys; -1 where the build side has no match."""
+        codes = None
+        for values, (distinct, combined) in zip(keys, self.dictionaries):
+            position = np.searchsorted(distinct, values)
+            clipped = np.minimum(position, len(distinct) - 1)
+            found = (position < len(distinct)) & (distinct[clipped] == values) if len(distinct) else \
+                np.zeros(len(values), dtype=bool)
+            inverse = np.where(found, clipped, -1)
+            if codes is None:
+                codes = inverse
+                continue
+            key = codes * len(distinct) + inverse
+            position = np.searchsorted(combined, key)
+            clipped = np.minimum(position, len(combined) - 1)
+            valid = (codes >= 0) & (inverse >= 0) & (position < len(combined)) & (combined[clipped] == key)
+            codes = np.where(valid, clipped, -1)
+        return codes
+
+    def matches(self, codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(probe row, build row) pairs with equal keys."""
+        lo = np.searchsorted(self.sorted_codes, codes, "left")
+        hi = np.searchsorted(self.sorted_codes, codes, "right")
+        counts = np.where(codes >= 0, hi - lo, 0)
+        total = int(counts.sum())
+        probe = np.repeat(np.arange(len(codes)), counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        build = self.order[np.repeat(lo, counts) + offsets]
+        return probe, build
+
+
+def group_codes(keys: List[np.ndarray], length: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(group of each row, first row of each group) for a batch."""
+    if not keys:
+        if not length:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.zeros(length, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    codes = None
+    for values in keys:
+        distinct, inverse = np.unique(values, return_inverse=True)
+        codes = inverse.astype(np.int64) if codes is None else codes * len(distinct) + inverse
+        if len(keys) > 1:
+            _, codes = np.unique(codes, return_inverse=True)
+    _, first, codes = np.unique(codes, return_index=True, return_inverse=True)
+    return codes, first
+
+
+def group_extreme(values: np.ndarray, codes: np.ndarray, groups: int, largest: bool) -> np.ndarray:
+    result = nulls(values, groups)
+    if not len(values):
+        return result
+    order = np.lexsort((values, codes))
+    sorted_codes = codes[order]
+    if largest:
+        last = np.flatnonzero(np.append(sorted_codes[1:] != sorted_codes[:-1], True))
+    else:
+        last = np.flatnonzero(np.insert(sorted_codes[1:] != sorted_codes[:-1], 0, True))
+    result[sorted_codes[last]] = values[order[last]]
+    return result
+
+
+# Operators
+
+class Operator:
+    """One plan node, run as a generator of batches.
+
+    Attributes:
+        node_id (int): The node's pre-order id, as in the Pipeline's steps
+        columns (list): The columns its batches carry, known before running
+        rows (int): Rows produced so far
+        rows_in (int): Rows consumed (read from the file, for scans)
+        seconds (float): Time spent producing batches, children included
+        held_rows (int): Most rows held at once (build sides, sort input, groups)
+        skipped (list): Expressions that couldn't be evaluated and were ignored
+    """
+
+    def __init__(self, node_id: int, plan: dict, inputs: List["Operator"], batch_rows: int):
+        self.node_id = node_id
+        self.plan = plan
+        self.inputs = inputs
+        self.batch_rows = batch_rows
+        self.node_type = plan.get("Node Type", "UNKNOWN")
+        self.columns: List[str] = list(inputs[0].columns) if inputs else []
+        self.rows = 0
+        self.rows_in = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self.held_rows = 0
+        self.skipped: List[str] = []
+        self.notes: List[str] = []
+
+    def run(self) -> Iterator[Batch]:
+        batches = self._run()
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                self.seconds += time.perf_counter() - start
+                return
+            self.seconds += time.perf_counter() - start
+            self.rows += batch.length
+            self.batches += 1
+            yield batch
+
+    def _run(self) -> Iterator[Batch]:
+        for batch in self.inputs[0].run():
+            self.rows_in += batch.length
+            yield batch
+
+    def own_seconds(self) -> float:
+        return max(self.seconds - sum(child.seconds for child in self.inputs), 0.0)
+
+    def hold(self, rows: int):
+        self.held_rows = max(self.held_rows, rows)
+
+    def skip(self, text: str, error: Exception):
+        self.skipped.append(f"{text} ({error})")
+
+    def parse_all(self, key: str) -> List[tuple]:
+        """(text, expression) for every expression under `key`; unparsable ones are skipped."""
+        parsed = []
+        value = self.plan.get(key)
+        texts = split_list(value) if key in ("Sort Key", "Group Key", "Output") else split_and(value) if value else []
+        for text in texts:
+            try:
+                parsed.append((text, parse_expression(text)))
+            except UnsupportedExpression as e:
+                self.skip(text, e)
+        return parsed
+
+    def evaluable(self, conditions: List[tuple], columns: List[str]) -> List[tuple]:
+        """The conditions that can be evaluated over batches of `columns`; the rest are skipped.
+
+        Each is tried on an empty batch, so a condition is applied to every
+        batch or to none, instead of being dropped part way through a run.
+        """
+        empty = Batch({name: np.empty(0, dtype=object) for name in columns}, 0)
+        usable = []
+        for text, node in conditions:
+            try:
+                evaluate_mask(node, empty)
+            except (UnsupportedExpression, KeyError, TypeError, ValueError) as e:
+                self.skip(text, e)
+                continue
+            usable.append((text, node))
+        return usable
+
+    def filter(self, conditions: List[tuple], batch: Batch) -> Batch:
+        """Apply every condition that can be evaluated; drop, and record, the ones that can't."""
+        mask = None
+        for entry in list(conditions):
+            text, node = entry
+            try:
+                result = evaluate_mask(node, batch)
+            except (UnsupportedExpression, KeyError, TypeError, ValueError) as e:
+                conditions.remove(entry)
+                self.skip(text, e)
+                continue
+            mask = result if mask is None else mask & result
+        return batch if mask is None else batch.take(mask)
+
+
+def open_data(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+
+def table_columns(path: str, relation: str) -> List[Tuple[str, str]]:
+    """(name, type) of a data file's columns: TPC-H's for .tbl, the header's for .csv."""
+    if ".csv" not in os.path.basename(path):
+        if relation not in TPCH_SCHEMA:
+            raise UnsupportedPlan(f"No schema for {relation}; give it as a .csv file with a header")
+        return TPCH_SCHEMA[relation]
+    with open_data(path) as f:
+        header = next(csv.reader(f), [])
+    known = dict(TPCH_SCHEMA.get(relation, []))
+    # Columns outside TPC-H get their type from the first batch
+    return [(name.strip(), known.get(name.strip(), "")) for name in header]
+
+
+def convert(values: List[str], type_name: str) -> Tuple[np.ndarray, str]:
+    if type_name:
+        return np.array(values, dtype=DTYPES[type_name]) if type_name != "str" else np.array(values), type_name
+    for candidate in ("int", "float", "date"):
+        try:
+            return np.array(values, dtype=DTYPES[candidate]), candidate
+        except ValueError:
+            continue
+    return np.array(values), "str"
+
+
+def split_tbl(lines: List[str], width: int) -> Optional[List[str]]:
+    """All fields of a block of dbgen lines, row after row; None if a line
+    doesn't have `width` fields (then the csv module sorts it out).
+
+    Twice as fast as csv.reader: .tbl files have no quoting, so one split
+    of the whole block does.
+    """
+    if not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    block = "".join(lines)
+    # dbgen ends every line with the delimiter; other tools don't
+    block = block.replace("|\n", "|") if lines[0].endswith("|\n") else block.replace("\n", "|")
+    fields = block.split("|")
+    if len(fields) != len(lines) * width + 1:
+        return None
+    fields.pop()
+    return fields
+
+
+class Scan(Operator):
+    """Streams a relation's data file batch by batch, reading only the
+    columns the plan refers to, and applies the node's conditions.
+
+    Conditions on another relation's columns (the parameters of a nested
+    loop's inner index scan) become join keys of the nested loop instead.
+    """
+
+    def __init__(self, node_id, plan, inputs, batch_rows, path: str, alias: str, referenced: set):
+        super().__init__(node_id, plan, inputs, batch_rows)
+        self.path = path
+        self.alias = alias
+        self.relation = plan.get("Relation Name")
+        self.table = table_columns(path, self.relation)
+        names = [name for name, _ in self.table]
+        wanted = [i for i, name in enumerate(names) if name in referenced]
+        # Even a plan that reads no column needs one to count rows with
+        self.wanted = wanted or [0]
+        self.columns = [f"{alias}.{names[i]}" for i in self.wanted]
+        self.bytes_read = 0
+        self.conditions: List[tuple] = []
+        self.parameterized: List[tuple] = []
+        own = {f"{alias}.{name}" for name in names}
+        # Bitmap heap scans recheck their index scans' conditions
+        for key in ("Index Cond", "Recheck Cond", "Filter", "TID Cond"):
+            for text, node in self.parse_all(key):
+                for part in conjuncts(node):
+                    refs = column_refs(part)
+                    if all(resolve(ref, own, strict=True) is not None for ref in refs):
+                        self.conditions.append((canonical(part), part))
+                    else:
+                        self.parameterized.append((canonical(part), part))
+
+    def _run(self):
+        types = [self.table[i][1] for i in self.wanted]
+        csv_file = ".csv" in os.path.basename(self.path)
+        delimiter = "," if csv_file else "|"
+        with open_data(self.path) as f:
+            if csv_file:
+                next(f, None)
+            while True:
+                lines = list(itertools.islice(f, self.batch_rows))
+                if not lines:
+                    return
+                self.bytes_read += sum(map(len, lines))
+                self.rows_in += len(lines)
+                fields = None if csv_file else split_tbl(lines, len(self.table))
+                if fields is None:
+                    rows = list(csv.reader(lines, delimiter=delimiter,
+                                           quoting=csv.QUOTE_MINIMAL if csv_file else csv.QUOTE_NONE))
+                    fields = [[row[index] for row in rows] for index in self.wanted]
+                else:
+                    fields = [fields[index::len(self.table)] for index in self.wanted]
+                columns = {}
+                for slot, (values, name) in enumerate(zip(fields, self.columns)):
+                    columns[name], types[slot] = convert(values, types[slot])
+                batch = self.filter(self.conditions, Batch(columns, len(lines)))
+                if batch.length:
+                    yield batch
+
+
+class Join(Operator):
+    """Hash, merge and nested loop joins, all as a build/probe equi-join.
+
+    The inner (second) input is the build side and is held whole; the outer
+    input streams through batch by batch. Equality conditions between the
+    two sides are the keys, anything else filters the matched pairs.
+    """
+
+    def __init__(self, node_id, plan, inputs, batch_rows):
+        super().__init__(node_id, plan, inputs, batch_rows)
+        self.join_type = plan.get("Join Type", "Inner")
+        outer, inner = inputs
+        self.columns = list(outer.columns) + [c for c in inner.columns if c not in outer.columns]
+        if self.join_type in ("Semi", "Anti"):
+            self.columns = list(outer.columns)
+        elif self.join_type in ("Right Semi", "Right Anti"):
+            self.columns = list(inner.columns)
+        conditions = []
+        for key in ("Hash Cond", "Merge Cond", "Join Filter"):
+            for text, node in self.parse_all(key):
+                conditions.extend(conjuncts(node))
+        # A parameterized inner scan's conditions are this join's
+        for scan in parameterized_scans(inner):
+            conditions.extend(node for _, node in scan.parameterized)
+            scan.notes.append(f"scanned once for node {node_id}, not once per outer row")
+        self.keys: List[tuple] = []
+        residual = []
+        for node in conditions:
+            pair = self._key_pair(node, outer.columns, inner.columns)
+            if pair is not None:
+                self.keys.append(pair)
+            else:
+                residual.append((canonical(node), node))
+        # Matched pairs carry both sides' columns
+        self.residual = self.evaluable(residual, list(outer.columns) + list(inner.columns))
+        if not self.keys:
+            self.notes.append("no equality keys: cross product, then filter")
+        self.filter_conditions = [(canonical(node), node) for _, node in self.parse_all("Filter")]
+
+    @staticmethod
+    def _key_pair(node, left: List[str], right: List[str]):
+        if node[0] != "op" or node[1] != "=":
+            return None
+        a_refs, b_refs = column_refs(node[2]), column_refs(node[3])
+        if not a_refs or not b_refs:
+            return None
+
+        def within(refs, columns):
+            return all(resolve(ref, columns, strict=True) is not None for ref in refs)
+
+        if within(a_refs, left) and within(b_refs, right):
+            return node[2], node[3]
+        if within(b_refs, left) and within(a_refs, right):
+            return node[3], node[2]
+        return None
+
+    def _run(self):
+        outer, inner = self.inputs
+        build = concat_batches(list(inner.run()), inner.columns)
+        self.hold(build.length)
+        index = KeyIndex([np.asarray(evaluate(b, build)) for _, b in self.keys]) if self.keys else None
+        build_matched = np.zeros(build.length, dtype=bool)
+        last_outer = None
+        for batch in outer.run():
+            self.rows_in += batch.length
+            last_outer = batch
+            yield from self._probe(batch, build, index, build_matched)
+        self.rows_in += build.length
+        if self.join_type in ("Right", "Full"):
+            unmatched = build.take(~build_matched)
+            if unmatched.length:
+                left = last_outer.columns if last_outer is not None else {}
+                columns = {name: nulls(left[name], unmatched.length) if name in left
+                           else np.full(unmatched.length, np.nan) for name in outer.columns}
+                columns.update(unmatched.columns)
+                yield from split_batch(Batch(columns, unmatched.length), self.batch_rows)
+        elif self.join_type in ("Right Semi", "Right Anti"):
+            keep = build_matched if self.join_type == "Right Semi" else ~build_matched
+            yield from split_batch(build.take(keep), self.batch_rows)
+
+    def _pairs(self, batch: Batch, build: Batch, index: Optional[KeyIndex]):
+        """(probe, build) row pairs of one outer batch, in chunks of about batch_rows."""
+        if index is not None:
+            codes = index.lookup([np.asarray(evaluate(a, batch)) for a, _ in self.keys])
+            probe, matched = index.matches(codes)
+            for start in range(0, max(len(probe), 1), self.batch_rows):
+                yield probe[start:start + self.batch_rows], matched[start:start + self.batch_rows]
+            return
+        # Cross product, a few outer rows at a time
+        step = max(1, self.batch_rows // max(build.length, 1))
+        for start in range(0, batch.length, step):
+            rows = np.arange(start, min(start + step, batch.length))
+            yield np.repeat(rows, build.length), np.tile(np.arange(build.length), len(rows))
+
+    def _probe(self, batch: Batch, build: Batch, index: Optional[KeyIndex], build_matched: np.ndarray):
+        outer_matched = np.zeros(batch.length, dtype=bool)
+        emit_pairs = self.join_type in ("Inner", "Left", "Right", "Full")
+        for probe, matched in self._pairs(batch, build, index):
+            if not len(probe):
+                continue
+            joined = Batch({**batch.take(probe).columns, **build.take(matched).columns}, len(probe))
+            if self.residual:
+                mask = np.ones(joined.length, dtype=bool)
+                for _, node in self.residual:
+                    mask &= evaluate_mask(node, joined)
+                joined, probe, matched = joined.take(mask), probe[mask], matched[mask]
+            outer_matched[probe] = True
+            build_matched[matched] = True
+            if emit_pairs and joined.length:
+                result = self.filter(self.filter_conditions, joined)
+                if result.length:
+                    yield result
+        if self.join_type in ("Left", "Full"):
+            unmatched = batch.take(~outer_matched)
+            if unmatched.length:
+                columns = dict(unmatched.columns)
+                for name in self.columns:
+                    if name not in columns:
+                        like = build.columns.get(name)
+                        columns[name] = nulls(like, unmatched.length) if like is not None \
+                            else np.full(unmatched.length, np.nan)
+                result = self.filter(self.filter_conditions, Batch(columns, unmatched.length))
+                if result.length:
+                    yield result
+        elif self.join_type in ("Semi", "Anti"):
+            keep = outer_matched if self.join_type == "Semi" else ~outer_matched
+            result = self.filter(self.filter_conditions, batch.take(keep))
+            if result.length:
+                yield result
+
+
+def parameterized_scans(op: Operator) -> List[Scan]:
+    # The scans under a nested loop's inner side whose conditions need the outer row
+    found, stack = [], [op]
+    while stack:
+        op = stack.pop()
+        if isinstance(op, Scan) and op.parameterized:
+            found.append(op)
+        elif op.node_type in PASS_THROUGH or isinstance(op, Scan) or op.node_type == "Append":
+            stack.extend(op.inputs)
+    return found
+
+
+class Aggregate(Operator):
+    """Hash aggregation, whatever the plan's strategy, with bounded state.
+
+    Each batch is reduced to per-group partial states (sums, counts,
+    extremes), which are merged into the running totals whenever they
+    outgrow them, so memory follows the number of groups, not rows. Partial
+    aggregates emit those states and Finalize aggregates merge them, as in
+    a parallel plan.
+
+    Without VERBOSE, a plan doesn't say which aggregates a node computes;
+    then only the ones its parents refer to are computed.
+    """
+
+    def __init__(self, node_id, plan, inputs, batch_rows, wanted_aggregates: dict):
+        super().__init__(node_id, plan, inputs, batch_rows)
+        child_columns = inputs[0].columns
+        self.partial = plan.get("Partial Mode") == "Partial"
+        self.group_keys = []
+        for text, node in self.parse_all("Group Key"):
+            # Plain columns keep their name, so parents find them as before
+            name = resolve(node[1], child_columns) if node[0] == "col" else None
+            self.group_keys.append((name or canonical(node), node))
+        self.outputs = self.parse_all("Output")
+        self.filter_conditions = [(canonical(node), node) for _, node in self.parse_all("Filter")]
+        calls = {}
+        for _, node in self.outputs + self.filter_conditions:
+            aggregate_calls(node, calls)
+        if not self.outputs:
+            for name, node in wanted_aggregates.items():
+                calls.setdefault(name, node)
+        self.specs = []
+        for name, node in calls.items():
+            call = node[1] if node[0] == "partial" else node
+            func, args, distinct = call[1], call[2], call[3]
+            if func not in AGGREGATE_STATES or distinct or len(args) > 1:
+                self.skip(name, UnsupportedExpression(f"aggregate {func} isn't supported"))
+                continue
+            from_state = all(f"{name}#{part}" in child_columns for part in AGGREGATE_STATES[func])
+            refs = set() if from_state or not args else column_refs(args[0])
+            if any(resolve(ref, child_columns) is None for ref in refs):
+                # Refers to columns of another part of the plan (a parent's aggregate)
+                continue
+            self.specs.append((name, func, args[0] if args else None, from_state))
+        self.columns = [name for name, _ in self.group_keys]
+        for name, func, _, _ in self.specs:
+            if self.partial:
+                self.columns += [f"{name}#{part}" for part in AGGREGATE_STATES[func]]
+            else:
+                self.columns.append(name)
+
+    def _reduce(self, batch: Batch) -> tuple:
+        """(group keys, states, groups) of one batch."""
+        keys = [np.asarray(evaluate(node, batch)) for _, node in self.group_keys]
+        codes, first = group_codes(keys, batch.length)
+        groups = len(first)
+        states = []
+        for name, func, arg, from_state in self.specs:
+            if from_state:
+                states.append(self._merge_states(func, {part: batch.columns[f"{name}#{part}"]
+                                                        for part in AGGREGATE_STATES[func]}, codes, groups))
+                continue
+            if arg is None:
+                states.append({"count": np.bincount(codes, minlength=groups).astype(np.float64)})
+                continue
+            values = np.broadcast_to(evaluate(arg, batch), (batch.length,))
+            present = ~null_mask(values) if isinstance(values, np.ndarray) else np.ones(batch.length, bool)
+            state = {}
+            for part in AGGREGATE_STATES[func]:
+                if part == "count":
+                    state[part] = np.bincount(codes[present], minlength=groups).astype(np.float64)
+                elif part == "sum":
+                    state[part] = np.bincount(codes[present], weights=values[present].astype(np.float64),
+                                              minlength=groups)
+                else:
+                    state[part] = group_extreme(values[present], codes[present], groups, part == "max")
+            states.append(state)
+        return [values[first] for values in keys], states, groups
+
+    @staticmethod
+    def _merge_states(func: str, state: dict, codes: np.ndarray, groups: int) -> dict:
+        merged = {}
+        for part, values in state.items():
+            if part in ("count", "sum"):
+                merged[part] = np.bincount(codes, weights=values.astype(np.float64), minlength=groups)
+            else:
+                present = ~null_mask(values)
+                merged[part] = group_extreme(values[present], codes[present], groups, part == "max")
+        return merged
+
+    def _compact(self, partials: list) -> tuple:
+        keys = [np.concatenate([partial[0][i] for partial in partials]) for i in range(len(self.group_keys))]
+        codes, first = group_codes(keys, sum(partial[2] for partial in partials))
+        groups = len(first)
+        states = []
+        for i, (_, func, _, _) in enumerate(self.specs):
+            state = {part: np.concatenate([partial[1][i][part] for partial in partials])
+                     for part in AGGREGATE_STATES[func]}
+            states.append(self._merge_states(func, state, codes, groups))
+        return [values[first] for values in keys], states, groups
+
+    def _run(self):
+        state = None
+        pending, pending_rows = [], 0
+        for batch in self.inputs[0].run():
+            self.rows_in += batch.length
+            try:
+                partial = self._reduce(batch)
+            except (UnsupportedExpression, KeyError, TypeError) as e:
+                raise UnsupportedPlan(f"Node {self.node_id} ({self.node_type}): {e}") from e
+            pending.append(partial)
+            pending_rows += partial[2]
+            state_rows = state[2] if state else 0
+            self.hold(state_rows + pending_rows)
+            # Merge once the partials outgrow the totals: memory stays within
+            # a few times the number of groups, and merging stays linear overall
+            if pending_rows > max(state_rows, self.batch_rows):
+                state = self._compact(([state] if state else []) + pending)
+                pending, pending_rows = [], 0
+        if pending or state:
+            keys, states, groups = self._compact(([state] if state else []) + pending)
+        elif self.group_keys:
+            return
+        else:
+            # An aggregate without GROUP BY returns one row, even over no rows
+            keys, groups = [], 1
+            states = [{part: np.zeros(1) if part == "count" else np.full(1, np.nan)
+                       for part in AGGREGATE_STATES[func]} for _, func, _, _ in self.specs]
+        columns = {name: values for (name, _), values in zip(self.group_keys, keys)}
+        for (name, func, _, _), state in zip(self.specs, states):
+            if self.partial:
+                columns.update({f"{name}#{part}": values for part, values in state.items()})
+            elif func == "count":
+                columns[name] = state["count"].astype(np.int64)
+            elif func == "avg":
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    columns[name] = state["sum"] / state["count"]
+            else:
+                columns[name] = state[func]
+        result = Batch(columns, groups)
+        if not self.partial:
+            # Output expressions over the aggregates, e.g. sum(a) / sum(b)
+            for text, node in self.outputs:
+                name = canonical(node)
+                if name in result.columns or node[0] == "col":
+                    continue
+                try:
+                    result.columns[name] = np.broadcast_to(evaluate(node, result), (groups,))
+                except (UnsupportedExpression, KeyError, TypeError, ValueError) as e:
+                    self.skip(text, e)
+        result = self.filter(self.filter_conditions, result)
+        yield from split_batch(result, self.batch_rows)
+
+
+class Sort(Operator):
+    """Sorts its whole input; under a Limit, keeps only the top rows (top-N)."""
+
+    def __init__(self, node_id, plan, inputs, batch_rows, limit: Optional[int] = None):
+        super().__init__(node_id, plan, inputs, batch_rows)
+        self.limit = limit
+        self.keys = []
+        for text in split_list(plan.get("Sort Key")):
+            match = SORT_SUFFIX_RE.search(text)
+            descending = False
+            while match:
+                descending = descending or (match.group(1) or "").upper() == "DESC"
+                text = text[:match.start()]
+                match = SORT_SUFFIX_RE.search(text)
+            try:
+                self.keys.append((text, parse_expression(text), descending))
+            except UnsupportedExpression as e:
+                self.skip(text, e)
+
+    def _order(self, batch: Batch) -> np.ndarray:
+        sort_keys = []
+        for entry in list(self.keys):
+            text, node, descending = entry
+            try:
+                values = np.asarray(np.broadcast_to(evaluate(node, batch), (batch.length,)))
+            except (UnsupportedExpression, KeyError, TypeError, ValueError) as e:
+                self.keys.remove(entry)
+                self.skip(text, e)
+                continue
+            if descending:
+                # Ranks negate whatever the type; NaN and NaT sort last either way
+                values = -np.unique(values, return_inverse=True)[1]
+            sort_keys.append(values)
+        if not sort_keys:
+            return np.arange(batch.length)
+        return np.lexsort(sort_keys[::-1])
+
+    def _run(self):
+        if self.limit is not None:
+            top = None
+            for batch in self.inputs[0].run():
+                self.rows_in += batch.length
+                top = batch if top is None else concat_batches([top, batch], self.columns)
+                if top.length > self.limit:
+                    top = top.take(self._order(top)[:self.limit])
+                self.hold(top.length + batch.length)
+            if top is not None:
+                yield from split_batch(top.take(self._order(top)), self.batch_rows)
+            return
+        batches = []
+        for batch in self.inputs[0].run():
+            self.rows_in += batch.length
+            batches.append(batch)
+        whole = concat_batches(batches, self.columns)
+        self.hold(whole.length)
+        yield from split_batch(whole.take(self._order(whole)), self.batch_rows)
+
+
+class Limit(Operator):
+    """Stops after the first rows.
+
+    Plans don't record the LIMIT count, so the node's row estimate stands
+    in for it; the planner's estimate for a Limit is the smaller of the
+    count and its input's estimate.
+    """
+
+    def __init__(self, node_id, plan, inputs, batch_rows):
+        super().__init__(node_id, plan, inputs, batch_rows)
+        self.limit = max(int(plan.get("Plan Rows", 0)), 0)
+        self.notes.append(f"limit {self.limit} taken from the plan's row estimate")
+
+    def _run(self):
+        remaining = self.limit
+        if remaining <= 0:
+            return
+        batches = self.inputs[0].run()
+        for batch in batches:
+            self.rows_in += batch.length
+            if batch.length > remaining:
+                batch = batch.slice(0, remaining)
+            remaining -= batch.length
+            yield batch
+            if remaining <= 0:
+                break
+        # Stops the scans below instead of reading on
+        batches.close()
+
+
+class Unique(Operator):
+    """Drops duplicate rows, keeping the first of each."""
+
+    def _run(self):
+        seen = None
+        for batch in self.inputs[0].run():
+            self.rows_in += batch.length
+            candidate = batch if seen is None else concat_batches([seen, batch], self.columns)
+            keys = [candidate.columns[name] for name in self.columns]
+            _, first = group_codes(keys, candidate.length)
+            first.sort()
+            offset = 0 if seen is None else seen.length
+            fresh = first[first >= offset]
+            seen = candidate.take(first)
+            self.hold(seen.length)
+            if len(fresh):
+                yield candidate.take(fresh)
+
+
+class Append(Operator):
+    def __init__(self, node_id, plan, inputs, batch_rows):
+        super().__init__(node_id, plan, inputs, batch_rows)
+        if any(child.columns != inputs[0].columns for child in inputs[1:]):
+            raise UnsupportedPlan(f"Node {node_id}: Append over differently named columns")
+
+    def _run(self):
+        for child in self.inputs:
+            for batch in child.run():
+                self.rows_in += batch.length
+                yield batch
+
+
+class Filter(Operator):
+    """Pass-through nodes (Hash, Gather, Materialize, ...) and their Filter, if any."""
+
+    def __init__(self, node_id, plan, inputs, batch_rows):
+        super().__init__(node_id, plan, inputs, batch_rows)
+        self.conditions = [(canonical(node), node) for _, node in self.parse_all("Filter")]
+
+    def _run(self):
+        for batch in self.inputs[0].run():
+            self.rows_in += batch.length
+            if self.conditions:
+                batch = self.filter(self.conditions, batch)
+            if batch.length:
+                yield batch
+
+
+class Rename(Filter):
+    """Subquery Scan: the subquery's output columns under the scan's names."""
+
+    def __init__(self, node_id, plan, inputs, batch_rows):
+        super().__init__(node_id, plan, inputs, batch_rows)
+        child_outputs = split_list(inputs[0].plan.get("Output"))
+        outputs = split_list(plan.get("Output"))
+        self.mapping = None
+        if outputs and len(outputs) == len(child_outputs):
+            try:
+                self.mapping = [(name, parse_expression(text)) for name, text in zip(outputs, child_outputs)]
+            except UnsupportedExpression as e:
+                self.skip(plan.get("Alias", "subquery"), e)
+        if self.mapping:
+            self.columns = [name for name, _ in self.mapping]
+
+    def _run(self):
+        for batch in self.inputs[0].run():
+            self.rows_in += batch.length
+            if self.mapping:
+                batch = Batch({name: np.broadcast_to(evaluate(node, batch), (batch.length,))
+                               for name, node in self.mapping}, batch.length)
+            if self.conditions:
+                batch = self.filter(self.conditions, batch)
+            if batch.length:
+                yield batch
+
+
+# Compiling
+
+def plan_nodes(pipeline: Pipeline) -> List[tuple]:
+    """(node_id, plan, node, child ids) in pre-order, the ids PipeSteps carry."""
+    entries = []
+    root = pipeline.tree.root if pipeline.tree is not None else pipeline.qep["Plan"]
+    stack = [(root, None)]
+    while stack:
+        item, parent = stack.pop()
+        node_id = len(entries)
+        if pipeline.tree is not None:
+            node = item
+            plan = node.plan if node.plan is not None else text_plan(node)
+            children = node.children
+        else:
+            node, plan = None, item
+            children = plan.get("Plans", ())
+        entries.append((node_id, plan, node, []))
+        if parent is not None:
+            entries[parent][3].append(node_id)
+        stack.extend((child, node_id) for child in reversed(children))
+    return entries
+
+
+def scan_alias(plan: dict, node) -> str:
+    if plan.get("Alias"):
+        return plan["Alias"]
+    if node is not None and plan.get("Relation Name"):
+        # Text EXPLAIN: "Seq Scan on nation n1"
+        words = node.operation.split(" on ", 1)[-1].split()
+        if len(words) > 1 and words[0] == plan["Relation Name"]:
+            return words[1]
+    return plan.get("Relation Name", "")
+
+
+def referenced_names(entries: List[tuple]) -> Tuple[set, dict]:
+    """Every column name the plan mentions, and every aggregate call it uses."""
+    names, calls = set(), {}
+    for _, plan, _, _ in entries:
+        for key in EXPRESSION_KEYS:
+            for text in split_list(plan.get(key)):
+                text = SORT_SUFFIX_RE.sub("", text) if key == "Sort Key" else text
+                try:
+                    node = parse_expression(text)
+                except UnsupportedExpression:
+                    # Still read the columns it names, in case they're needed
+                    names.update(word.rsplit(".", 1)[-1] for word in re.findall(r"[A-Za-z_][\w.]*", text))
+                    continue
+                for ref in column_refs(node):
+                    names.add(ref.rsplit(".", 1)[-1])
+                aggregate_calls(node, calls)
+    return names, calls
+
+
+def compile_plan(pipeline: Pipeline, tables: Dict[str, str], batch_rows: int = BATCH_ROWS):
+    """Operators for a pipeline's plan: (root operator, operators by node id, nodes not run)."""
+    entries = plan_nodes(pipeline)
+    names, wanted_aggregates = referenced_names(entries)
+    operators: Dict[int, Operator] = {}
+    not_run: Dict[int, str] = {}
+
+    def build(node_id: int, limit: Optional[int] = None) -> Operator:
+        _, plan, node, child_ids = entries[node_id]
+        node_type = plan.get("Node Type", "UNKNOWN")
+        inputs_ids = []
+        for child_id in child_ids:
+            child_plan = entries[child_id][1]
+            if child_plan.get("Parent Relationship") in SIDE_RELATIONSHIPS:
+                mark_not_run(child_id, "subplans aren't executed")
+            else:
+                inputs_ids.append(child_id)
+        if node_type in SCAN_NODES:
+            for child_id in inputs_ids:
+                # Bitmap Index Scans: the heap scan rechecks their conditions
+                mark_not_run(child_id, "folded into the heap scan above")
+            relation = plan.get("Relation Name")
+            path = tables.get(relation) or tables.get((relation or "").lower())
+            if path is None:
+                raise UnsupportedPlan(f"No data file for relation {relation}")
+            op = Scan(node_id, plan, [], batch_rows, path, scan_alias(plan, node), names)
+        elif node_type == "Limit":
+            child = build(inputs_ids[0], int(plan.get("Plan Rows", 0)))
+            op = Limit(node_id, plan, [child], batch_rows)
+        else:
+            top_n = limit if node_type in SORT_NODES else None
+            inputs = [build(child_id) for child_id in inputs_ids]
+            if not inputs:
+                raise UnsupportedPlan(f"Node {node_id}: {node_type} isn't supported")
+            if node_type in JOIN_NODES:
+                op = Join(node_id, plan, inputs, batch_rows)
+            elif node_type == "Aggregate":
+                op = Aggregate(node_id, plan, inputs, batch_rows, wanted_aggregates)
+            elif node_type in SORT_NODES:
+                op = Sort(node_id, plan, inputs, batch_rows, top_n)
+            elif node_type == "Unique":
+                op = Unique(node_id, plan, inputs, batch_rows)
+            elif node_type in ("Append", "Merge Append"):
+                op = Append(node_id, plan, inputs, batch_rows)
+            elif node_type == "Subquery Scan":
+                op = Rename(node_id, plan, inputs, batch_rows)
+            elif node_type in PASS_THROUGH:
+                op = Filter(node_id, plan, inputs, batch_rows)
+            else:
+                raise UnsupportedPlan(f"Node {node_id}: {node_type} isn't supported")
+        operators[node_id] = op
+        return op
+
+    def mark_not_run(node_id: int, reason: str):
+        not_run[node_id] = reason
+        for child_id in entries[node_id][3]:
+            mark_not_run(child_id, reason)
+
+    root = build(0)
+    return root, operators, not_run
+
+
+# Running
+
+class ExecutionResult:
+    """What running a pipeline produced: row counts and timings per operator."""
+
+    def __init__(self, pipeline: Pipeline, operators: Dict[int, Operator], not_run: Dict[int, str],
+                 rows: int, sample: Optional[Batch], seconds: float, batch_rows: int):
+        self.pipeline = pipeline
+        self.operators = operators
+        self.not_run = not_run
+        self.rows = rows
+        self.sample = sample
+        self.seconds = seconds
+        self.batch_rows = batch_rows
+
+    def operator_report(self) -> List[dict]:
+        """One entry per plan node, in the pipeline's step order."""
+        entries, seen = [], set()
+        parallel = parallel_nodes(self.pipeline)
+        per_loop = per_loop_nodes(self.operators)
+        for step in self.pipeline.steps:
+            if step.node_id in seen:
+                continue
+            seen.add(step.node_id)
+            entry = {
+                "node_id": step.node_id,
+                "node_type": step.node_type,
+                "step": step.text,
+                "estimated_rows": step.rows,
+                "rows": None,
+            }
+            op = self.operators.get(step.node_id)
+            if op is None:
+                entry["not_run"] = self.not_run.get(step.node_id, "not executed")
+                entries.append(entry)
+                continue
+            own = op.own_seconds()
+            factor = estimate_error(step.rows, op.rows)
+            entry.update({
+                "rows": op.rows,
+                "rows_in": op.rows_in,
+                "batches": op.batches,
+                "ms": round(own * 1000, 3),
+                "rows_per_s": round(max(op.rows_in, op.rows) / own) if own > 0 else None,
+                "held_rows": op.held_rows,
+                "error_factor": round(factor, 2),
+                "direction": estimate_direction(step.rows, op.rows),
+                # Parallel-aware estimates are per process, inner-side ones per loop
+                "per_process_estimate": step.node_id in parallel,
+                "per_loop_estimate": step.node_id in per_loop,
+                "skipped": op.skipped,
+                "notes": op.notes,
+            })
+            if isinstance(op, Scan):
+                entry["mb_per_s"] = round(op.bytes_read / own / 1e6, 2) if own > 0 else None
+            entries.append(entry)
+        return entries
+
+    def to_json(self, sample_rows: bool = True) -> dict:
+        operators = self.operator_report()
+        misestimates = [entry for entry in operators
+                        if entry["rows"] is not None and entry["error_factor"] >= MISESTIMATE_FACTOR
+                        and not entry["per_process_estimate"] and not entry["per_loop_estimate"]]
+        report = {
+            "rows": self.rows,
+            "elapsed_ms": round(self.seconds * 1000, 3),
+            "batch_rows": self.batch_rows,
+            # Some condition couldn't be evaluated, so some counts are too high
+            "approximate": any(entry.get("skipped") for entry in operators),
+            "operators": operators,
+            "misestimates": sorted(misestimates, key=lambda entry: entry["error_factor"], reverse=True),
+        }
+        if sample_rows and self.sample is not None:
+            report["sample"] = sample_records(self.sample)
+        return report
+
+
+def parallel_nodes(pipeline: Pipeline) -> set:
+    return {step.node_id for step in pipeline.steps if step.plan.get("Parallel Aware")}
+
+
+def per_loop_nodes(operators: Dict[int, Operator]) -> set:
+    # Inner sides of nested loops: the plan's estimate is per outer row
+    found = set()
+    for op in operators.values():
+        if op.node_type == "Nested Loop" and len(op.inputs) == 2:
+            stack = [op.inputs[1]]
+            while stack:
+                child = stack.pop()
+                found.add(child.node_id)
+                stack.extend(child.inputs)
+    return found
+
+
+def sample_records(batch: Batch) -> List[dict]:
+    records = []
+    for i in range(batch.length):
+        record = {}
+        for name, values in batch.columns.items():
+            value = values[i]
+            if isinstance(value, np.datetime64):
+                value = str(value)
+            elif isinstance(value, np.generic):
+                value = value.item()
+            record[name] = value
+        records.append(record)
+    return records
+
+
+@timed("execute")
+def execute_pipeline(pipeline: Pipeline, tables: Dict[str, str], batch_rows: int = BATCH_ROWS,
+                     keep_rows: int = KEEP_ROWS) -> ExecutionResult:
+    """Run a pipeline's plan over local data files, batch by batch.
+
+    Args:
+        pipeline: From build_pipeline; JSON and text EXPLAIN plans both work,
+            VERBOSE ones best (their Output lists say what each node computes)
+        tables: Relation name -> .tbl or .csv file (optionally .gz)
+        batch_rows: Rows per batch
+        keep_rows: Result rows kept as a sample; the rest are only counted
+
+    Raises:
+        UnsupportedPlan: A node type or relation this executor can't run
+    """
+    start = time.perf_counter()
+    root, operators, not_run = compile_plan(pipeline, tables, batch_rows)
+    rows, kept = 0, []
+    for batch in root.run():
+        if rows < keep_rows:
+            kept.append(batch.slice(0, keep_rows - rows))
+        rows += batch.length
+    sample = concat_batches(kept, root.columns) if kept else None
+    return ExecutionResult(pipeline, operators, not_run, rows, sample, time.perf_counter() - start, batch_rows)
+
+
+def find_tables(data_dir: str) -> Dict[str, str]:
+    """Relation name -> data file, for every .tbl/.csv (or .gz) file in a directory."""
+    tables = {}
+    for name in sorted(os.listdir(data_dir)):
+        for suffix in DATA_SUFFIXES:
+            if name.lower().endswith(suffix):
+                tables[name[:-len(suffix)].lower()] = os.path.join(data_dir, name)
+                break
+    return tables
+
+
+def format_report(report: dict) -> str:
+    lines = [f"{report['rows']} rows in {report['elapsed_ms']:.1f} ms"
+             + (" (approximate: some conditions were skipped)" if report["approximate"] else "")]
+    lines.append(f"{'step':<56}{'est rows':>12}{'rows':>12}{'error':>8}{'ms':>10}{'rows/s':>13}")
+    for entry in report["operators"]:
+        step = entry["step"] if len(entry["step"]) <= 54 else entry["step"][:51] + "..."
+        if entry["rows"] is None:
+            lines.append(f"{step:<56}{entry['estimated_rows']:>12,.0f}{'-':>12}  ({entry['not_run']})")
+            continue
+        flag = "*" if entry["per_process_estimate"] or entry["per_loop_estimate"] else ""
+        rate = f"{entry['rows_per_s']:,}" if entry["rows_per_s"] is not None else "-"
+        lines.append(f"{step:<56}{entry['estimated_rows']:>12,.0f}{entry['rows']:>12,}"
+                     f"{'x' + format(entry['error_factor'], '.1f') + flag:>8}{entry['ms']:>10.1f}{rate:>13}")
+        for skipped in entry["skipped"]:
+            lines.append(f"    skipped: {skipped}")
+    if any(entry.get("per_process_estimate") or entry.get("per_loop_estimate") for entry in report["operators"]):
+        lines.append("* estimate is per process or per loop, the count is for the whole run")
+    return "\n".join(lines)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Run a saved plan's pipeline over local TPC-H data files")
+    parser.add_argument("plan", help="Saved plan, JSON or text EXPLAIN (VERBOSE works best)")
+    parser.add_argument("--data", default=".", help="Directory of <relation>.tbl or .csv files (optionally .gz)")
+    parser.add_argument("--table", action="append", default=[], metavar="NAME=FILE",
+                        help="Data file for one relation, overriding --data")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="Rows per batch")
+    parser.add_argument("--show", type=int, default=10, help="Result rows to print")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON instead of a table")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from plandiff import load_plan_file
+
+    args = build_parser().parse_args(argv)
+    if args.batch_rows < 1:
+        print("--batch-rows must be at least 1", file=sys.stderr)
+        return 2
+    tables = find_tables(args.data) if os.path.isdir(args.data) else {}
+    for entry in args.table:
+        name, _, path = entry.partition("=")
+        tables[name.lower()] = path
+    tree = load_plan_file(args.plan)
+    pipeline = build_pipeline(tree)
+    try:
+        result = execute_pipeline(pipeline, tables, args.batch_rows, args.show)
+    except UnsupportedPlan as e:
+        print(e, file=sys.stderr)
+        return 2
+    report = result.to_json()
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+        return 0
+    print(format_report(report))
+    for record in report.get("sample", [])[:args.show]:
+        print("  " + " | ".join(str(value) for value in record.values()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
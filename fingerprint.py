@@ -0,0 +1,91 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+from instrument import count
+
+
+# Plan keys that make up a plan's shape: which operators, in which order, on
+# which relations and indexes. Costs, rows and conditions are left out.
+SHAPE_KEYS = (
+    "Node Type", "Parent Relationship", "Subplan Name", "Join Type", "Strategy",
+    "Partial Mode", "Parallel Aware", "Scan Direction", "Relation Name", "Index Name",
+    "CTE Name", "Function Name",
+)
+
+
+def shape_fingerprint(qep: dict) -> str:
+    """Short hash of a JSON plan's shape.
+
+    Two plans with the same fingerprint run the same operators in the same
+    arrangement, even if their estimates differ.
+
+    Args:
+        qep (dict): The unwrapped plan, i.e. {"Plan": {...}, ...}
+    """
+    digest = hashlib.sha1()
+    # Pre-order with depths is enough to tell trees apart, and needs no recursion
+    stack = [(qep["Plan"], 0)]
+    while stack:
+        plan, depth = stack.pop()
+        fields = "|".join(str(plan.get(key, "")) for key in SHAPE_KEYS)
+        digest.update(f"{depth}|{fields}\n".encode("utf-8"))
+        for sub in reversed(plan.get("Plans", [])):
+            stack.append((sub, depth + 1))
+    return digest.hexdigest()[:16]
+
+
+def tree_fingerprint(tree) -> str:
+    """shape_fingerprint for an ExecutionTree, e.g. one parsed from text.
+
+    Text plans have no separate shape fields, so each node's operation
+    label ("Index Scan using i on t") stands in for them. Costs, rows and
+    conditions, and with them any literals, are left out, so re-planning a
+    query with other parameters or statistics keeps its fingerprint.
+    """
+    lines = []
+    stack = [(tree.root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        lines.append(f"{depth}|{node.operation}|{node.relationship or ''}\n")
+        for child in reversed(node.children):
+            stack.append((child, depth + 1))
+    return hashlib.sha1("".join(lines).encode("utf-8")).hexdigest()[:16]
+
+
+class ShapeCache:
+    """A small LRU of things that only depend on a plan's shape.
+
+    Keyed by anything that identifies the shape, e.g. tree_fingerprint.
+    Hits and misses are counted as
+    `<name>.hit` / `<name>.miss` in the current run. Safe to share between
+    the GUI's worker threads and the report server.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._entries: "OrderedDict[Hashable, object]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+        count(f"{self.name}.{'miss' if value is None else 'hit'}")
+        return value
+
+    def put(self, key: Hashable, value, max_entries: int):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,262 @@
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+from typing import Iterable, List, Optional
+
+from fingerprint import shape_fingerprint
+from plancache import query_fingerprint
+
+
+# Flag a plan that costs this much more than the previous one of its query
+DEFAULT_REGRESSION_THRESHOLD = 0.2
+
+# SQLite's default limit on bound parameters is 999
+_CHUNK = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY,
+    query_fingerprint TEXT NOT NULL,
+    plan_hash TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    dbms TEXT,
+    label TEXT,
+    sql TEXT,
+    settings TEXT,
+    total_cost REAL,
+    startup_cost REAL,
+    node_count INTEGER,
+    previous_id INTEGER,
+    flipped INTEGER NOT NULL DEFAULT 0,
+    cost_ratio REAL,
+    regression INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS plans_by_query ON plans (query_fingerprint, id);
+CREATE INDEX IF NOT EXISTS plans_flagged ON plans (recorded_at) WHERE flipped OR regression;
+
+CREATE TABLE IF NOT EXISTS plan_nodes (
+    plan_id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    operation TEXT,
+    operator_class TEXT,
+    relation TEXT,
+    net_cost REAL,
+    loops REAL,
+    attributed_cost REAL,
+    share REAL,
+    PRIMARY KEY (plan_id, node_id)
+) WITHOUT ROWID;
+"""
+
+PLAN_COLUMNS = (
+    "id", "query_fingerprint", "plan_hash", "recorded_at", "dbms", "label", "sql", "settings",
+    "total_cost", "startup_cost", "node_count", "previous_id", "flipped", "cost_ratio", "regression",
+)
+NODE_COLUMNS = ("operation", "operator_class", "relation", "net_cost", "loops", "attributed_cost", "share")
+
+
+def plan_record(sql: str, qep: dict, cost: dict, settings=None, dbms: str = "postgresql",
+                label: Optional[str] = None, recorded_at: Optional[float] = None) -> dict:
+    """Everything the history keeps about one explained plan.
+
+    Args:
+        sql (str): The query
+        qep (dict): Its plan, i.e. {"Plan": {...}}
+        cost (dict): tree.get_cost() of the plan
+        settings: Planner settings the plan was made under, e.g. the plan
+            cache's (name, value) pairs
+        label (str): Free-form tag, e.g. a release or "after ANALYZE"
+    """
+    return {
+        "query_fingerprint": query_fingerprint(sql),
+        "plan_hash": shape_fingerprint(qep),
+        "recorded_at": time.time() if recorded_at is None else recorded_at,
+        "dbms": dbms,
+        "label": label,
+        "sql": sql,
+        "settings": dict(settings or ()),
+        "total_cost": cost["total_cost"],
+        "startup_cost": cost["startup_cost"],
+        # Steps come in post-order; nodes are stored by id
+        "nodes": [tuple(step[column] for column in NODE_COLUMNS)
+                  for step in sorted(cost["steps"], key=lambda step: step["id"])],
+    }
+
+
+class PlanHistory:
+    """Explained plans over time, in a local SQLite file.
+
+    Each recorded plan is compared with the previous one of the same query:
+    a different plan hash is a flip, a total cost more than `threshold`
+    above it is a regression. Both are stored with the plan.
+
+    Args:
+        path (str): Database file, created on first use
+        threshold (float): Relative cost increase flagged as a regression
+    """
+
+    def __init__(self, path: str = "plan_history.db", threshold: float = DEFAULT_REGRESSION_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        # Shared by the GUI's worker threads; the lock serializes them
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, record: dict) -> dict:
+        return self.record_many([record])[0]
+
+    def record_many(self, records: Iterable[dict]) -> List[dict]:
+        """Store plans in one transaction and flag flips and regressions.
+
+        Returns:
+            list: Per record, its "id", "query_fingerprint", "previous_id",
+                "flipped", "cost_ratio" and "regression"
+        """
+        records = list(records)
+        if not records:
+            return []
+        with self._lock, self._conn:
+            # Ids are handed out here so plans and nodes go in with executemany
+            self._conn.execute("BEGIN IMMEDIATE")
+            next_id = self._conn.execute("SELECT coalesce(max(id), 0) + 1 FROM plans").fetchone()[0]
+            latest = self._latest({record["query_fingerprint"] for record in records})
+            plan_rows, node_rows, flags = [], [], []
+            for i, record in enumerate(records):
+                plan_id = next_id + i
+                previous = latest.get(record["query_fingerprint"])
+                flag = self._compare(record, previous)
+                flag["id"] = plan_id
+                flags.append(flag)
+                # Later records of the same query compare with this one
+                latest[record["query_fingerprint"]] = (plan_id, record["plan_hash"], record["total_cost"])
+                plan_rows.append((
+                    plan_id, record["query_fingerprint"], record["plan_hash"], record["recorded_at"],
+                    record["dbms"], record["label"], record["sql"], json.dumps(record["settings"]),
+                    record["total_cost"], record["startup_cost"], len(record["nodes"]),
+                    flag["previous_id"], int(flag["flipped"]), flag["cost_ratio"], int(flag["regression"]),
+                ))
+                node_rows.extend((plan_id, node_id) + node for node_id, node in enumerate(record["nodes"]))
+            self._conn.executemany(
+                f"INSERT INTO plans ({', '.join(PLAN_COLUMNS)}) VALUES ({', '.join('?' * len(PLAN_COLUMNS))})",
+                plan_rows,
+            )
+            self._conn.executemany(
+                f"INSERT INTO plan_nodes VALUES ({', '.join('?' * (len(NODE_COLUMNS) + 2))})", node_rows
+            )
+        return flags
+
+    def _latest(self, fingerprints: set) -> dict:
+        # Newest (id, plan hash, total cost) per fingerprint, in chunks of parameters
+        latest = {}
+        fingerprints = list(fingerprints)
+        for start in range(0, len(fingerprints), _CHUNK):
+            chunk = fingerprints[start:start + _CHUNK]
+            rows = self._conn.execute(
+                "SELECT query_fingerprint, id, plan_hash, total_cost FROM plans WHERE id IN ("
+                " SELECT max(id) FROM plans WHERE query_fingerprint IN "
+                f"({', '.join('?' * len(chunk))}) GROUP BY query_fingerprint)",
+                chunk,
+            ).fetchall()
+            for row in rows:
+                latest[row[0]] = (row[1], row[2], row[3])
+        return latest
+
+    def _compare(self, record: dict, previous: Optional[tuple]) -> dict:
+        flag = {"query_fingerprint": record["query_fingerprint"], "previous_id": None,
+                "flipped": False, "cost_ratio": None, "regression": False}
+        if previous is None:
+            return flag
+        previous_id, previous_hash, previous_cost = previous
+        flag["previous_id"] = previous_id
+        flag["flipped"] = previous_hash != record["plan_hash"]
+        if previous_cost:
+            flag["cost_ratio"] = round(record["total_cost"] / previous_cost, 4)
+            flag["regression"] = flag["cost_ratio"] > 1 + self.threshold
+        return flag
+
+    def history(self, fingerprint: str, limit: Optional[int] = None) -> List[dict]:
+        """Recorded plans of one query, newest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM plans WHERE query_fingerprint = ? ORDER BY id DESC LIMIT ?",
+                (fingerprint, -1 if limit is None else limit),
+            ).fetchall()
+        return [_plan_dict(row) for row in rows]
+
+    def nodes(self, plan_id: int) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM plan_nodes WHERE plan_id = ? ORDER BY node_id", (plan_id,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def flagged(self, since: Optional[float] = None, limit: int = 100) -> List[dict]:
+        """Plans recorded as flips or regressions, newest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM plans WHERE (flipped OR regression) AND recorded_at >= ?"
+                " ORDER BY recorded_at DESC LIMIT ?",
+                (since or 0.0, limit),
+            ).fetchall()
+        return [_plan_dict(row) for row in rows]
+
+
+def _plan_dict(row: sqlite3.Row) -> dict:
+    plan = dict(row)
+    plan["settings"] = json.loads(plan["settings"]) if plan["settings"] else {}
+    plan["flipped"] = bool(plan["flipped"])
+    plan["regression"] = bool(plan["regression"])
+    return plan
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Show recorded plans, flips and cost regressions")
+    parser.add_argument("--db", default="plan_history.db", help="History database file")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--query", help=".sql file whose history to show")
+    target.add_argument("--fingerprint", help="Query fingerprint whose history to show")
+    target.add_argument("--flagged", action="store_true", help="List plan flips and cost regressions")
+    parser.add_argument("--since", type=float, default=None, help="With --flagged: Unix time to start from")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--nodes", action="store_true", help="Include each plan's per-node costs")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    with PlanHistory(args.db) as store:
+        if args.flagged:
+            plans = store.flagged(args.since, args.limit)
+        else:
+            fingerprint = args.fingerprint
+            if args.query:
+                with open(args.query, "r", encoding="utf-8") as f:
+                    fingerprint = query_fingerprint(f.read())
+            plans = store.history(fingerprint, args.limit)
+        if args.nodes:
+            for plan in plans:
+                plan["nodes"] = store.nodes(plan["id"])
+    json.dump(plans, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+import argparse
+import gzip
+import json
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator, List, Optional, Tuple
+
+from analysis import exclusive_time, node_spill
+from costs import PlanArrays
+from fingerprint import tree_fingerprint
+from plancache import query_fingerprint
+from preprocessing import build_tree_from_json, parse_query_explanation_to_tree
+
+
+# "... LOG:  duration: 1234.567 ms  plan:" starts an auto_explain entry; the
+# plan follows on lines indented with a tab
+ENTRY_RE = re.compile(r"duration: (?P<ms>[\d.]+) ms\s+plan:\s*$")
+# Entries longer than this are cut off rather than held in memory
+MAX_ENTRY_LINES = 100_000
+# Entries parsed per task, so pickling isn't paid per plan
+CHUNK_SIZE = 32
+# Distinct queries tracked before new ones are counted under OTHER_QUERIES
+MAX_QUERIES = 10_000
+OTHER_QUERIES = "<other>"
+EXAMPLE_LENGTH = 300
+
+
+def open_log(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def iter_log_entries(path: str) -> Iterator[Tuple[float, str]]:
+    """Yield (duration in ms, plan text) for each auto_explain entry.
+
+    The file is read line by line, so only the entry being read is held in
+    memory. Works with the stderr log format, whatever the log_line_prefix;
+    the plan may be in text or JSON (auto_explain.log_format).
+    """
+    duration = None
+    lines: List[str] = []
+    with open_log(path) as f:
+        for line in f:
+            if duration is not None:
+                if line[:1] in ("\t", " ") or not line.strip():
+                    if len(lines) < MAX_ENTRY_LINES:
+                        lines.append(line)
+                    continue
+                yield duration, "".join(lines)
+                duration, lines = None, []
+            match = ENTRY_RE.search(line)
+            if match:
+                duration = float(match.group("ms"))
+    if duration is not None:
+        yield duration, "".join(lines)
+
+
+def split_entry(text: str) -> Tuple[str, object]:
+    """The query text and plan tree of one entry's plan text."""
+    stripped = text.lstrip()
+    if stripped.startswith("{"):
+        doc = json.loads(stripped)
+        return doc.get("Query Text", ""), build_tree_from_json(doc)
+    query_lines = []
+    lines = text.splitlines()
+    for line in lines:
+        if "(cost=" in line:
+            break
+        query_lines.append(line.strip())
+    query = "\n".join(query_lines)
+    if query.startswith("Query Text:"):
+        query = query[len("Query Text:"):].strip()
+    tree = parse_query_explanation_to_tree(lines)
+    tree.finalize_id()
+    return query, tree
+
+
+def summarize_entry(duration: float, text: str) -> dict:
+    """The few numbers ingestion keeps about one logged plan."""
+    query, tree = split_entry(text)
+    arrays = PlanArrays(tree)
+    attributed = arrays.attributed_cost.tolist()
+    operators, relations, spills = [], [], []
+    for node in arrays.nodes:
+        cost = attributed[node.id]
+        time_ms = exclusive_time(node) if node.analyzed else None
+        operators.append((arrays.operator_class[node.id], cost, time_ms))
+        if node.relation is not None:
+            relations.append((node.relation, "Seq Scan" in node.operation, cost))
+        spill = node_spill(node) if node.analyzed else None
+        if spill is not None:
+            spills.append((spill["kind"], node.operation, spill["disk_kb"]))
+    return {
+        "fingerprint": query_fingerprint(query, keep_literals=False),
+        "query": query[:EXAMPLE_LENGTH],
+        "shape": tree_fingerprint(tree),
+        "duration_ms": duration,
+        "total_cost": tree.root.total_cost,
+        "operators": operators,
+        "relations": relations,
+        "spills": spills,
+    }
+
+
+def summarize_chunk(entries: List[Tuple[float, str]]) -> List[dict]:
+    summaries = []
+    for duration, text in entries:
+        try:
+            summaries.append(summarize_entry(duration, text))
+        except Exception as e:
+            summaries.append({"error": f"{type(e).__name__}: {e}"})
+    return summaries
+
+
+class WorkloadSummary:
+    """Running totals over every ingested plan.
+
+    Only aggregates are kept: per query fingerprint (at most `max_queries`
+    of them), per operator class, per relation and per spill, so memory
+    does not grow with the size of the logs.
+    """
+
+    def __init__(self, max_queries: int = MAX_QUERIES):
+        self.max_queries = max_queries
+        self.plans = 0
+        self.errors = 0
+        self.queries = {}
+        self.operators = {}
+        self.relations = {}
+        self.spills = {}
+
+    def add(self, summary: dict):
+        if "error" in summary:
+            self.errors += 1
+            return
+        self.plans += 1
+        fingerprint = summary["fingerprint"]
+        if fingerprint not in self.queries and len(self.queries) >= self.max_queries:
+            fingerprint = OTHER_QUERIES
+        query = self.queries.get(fingerprint)
+        if query is None:
+            query = self.queries[fingerprint] = {
+                "fingerprint": fingerprint, "example": summary["query"], "count": 0,
+                "total_duration_ms": 0.0, "max_duration_ms": 0.0, "total_cost": 0.0,
+                "shapes": set(), "spills": 0,
+            }
+        query["count"] += 1
+        query["total_duration_ms"] += summary["duration_ms"]
+        query["max_duration_ms"] = max(query["max_duration_ms"], summary["duration_ms"])
+        query["total_cost"] += summary["total_cost"]
+        # A handful is enough to see that a query's plan keeps changing
+        if len(query["shapes"]) < 32:
+            query["shapes"].add(summary["shape"])
+        query["spills"] += len(summary["spills"])
+
+        for name, cost, time_ms in summary["operators"]:
+            operator = self.operators.setdefault(name, {"name": name, "nodes": 0, "cost": 0.0, "time_ms": 0.0})
+            operator["nodes"] += 1
+            operator["cost"] += cost
+            operator["time_ms"] += time_ms or 0.0
+        for name, seq_scan, cost in summary["relations"]:
+            relation = self.relations.setdefault(
+                name, {"name": name, "scans": 0, "cost": 0.0, "seq_scans": 0, "seq_scan_cost": 0.0})
+            relation["scans"] += 1
+            relation["cost"] += cost
+            if seq_scan:
+                relation["seq_scans"] += 1
+                relation["seq_scan_cost"] += cost
+        for kind, operation, disk_kb in summary["spills"]:
+            key = (kind, fingerprint)
+            spill = self.spills.setdefault(key, {
+                "kind": kind, "fingerprint": fingerprint, "operation": operation,
+                "count": 0, "disk_kb": 0,
+            })
+            spill["count"] += 1
+            spill["disk_kb"] += disk_kb or 0
+
+    def report(self, top_n: int = 20) -> dict:
+        def top(items, key):
+            ranked = sorted(items, key=lambda item: item[key], reverse=True)[:top_n]
+            return [{name: round(value, 3) if isinstance(value, float) else value
+                     for name, value in item.items()} for item in ranked]
+
+        queries = []
+        for query in top(self.queries.values(), "total_duration_ms"):
+            query["distinct_plans"] = len(query.pop("shapes"))
+            query["mean_duration_ms"] = round(query["total_duration_ms"] / query["count"], 3)
+            queries.append(query)
+        return {
+            "plans": self.plans,
+            "errors": self.errors,
+            "distinct_queries": len(self.queries),
+            "queries_by_duration": queries,
+            "operators_by_cost": top(self.operators.values(), "cost"),
+            "relations_by_seq_scan_cost": [relation for relation in top(self.relations.values(), "seq_scan_cost")
+                                           if relation["seq_scans"]],
+            "spills_by_count": top(self.spills.values(), "count"),
+        }
+
+
+def iter_chunks(paths: List[str], size: int = CHUNK_SIZE) -> Iterator[List[Tuple[float, str]]]:
+    chunk = []
+    for path in paths:
+        for entry in iter_log_entries(path):
+            chunk.append(entry)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def ingest(paths: List[str], executor=None, workers: int = 4,
+           summary: Optional[WorkloadSummary] = None) -> WorkloadSummary:
+    """Parse and cost every logged plan, `workers` chunks at a time.
+
+    At most `2 * workers` chunks are in flight, so reading a large log never
+    gets far ahead of parsing it. Without an executor the plans are parsed
+    in this process.
+    """
+    summary = summary or WorkloadSummary()
+    chunks = iter_chunks(paths)
+    if executor is None:
+        for chunk in chunks:
+            for result in summarize_chunk(chunk):
+                summary.add(result)
+        return summary
+
+    pending = set()
+    for chunk in chunks:
+        pending.add(executor.submit(summarize_chunk, chunk))
+        if len(pending) >= 2 * workers:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                for result in future.result():
+                    summary.add(result)
+    for future in pending:
+        for result in future.result():
+            summary.add(result)
+    return summary
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Aggregate auto_explain plans from PostgreSQL server logs")
+    parser.add_argument("logs", nargs="+", help="Log files (stderr format, optionally .gz)")
+    parser.add_argument("--workers", type=int, default=4, help="Parser processes, 0 to parse in this process")
+    parser.add_argument("--top", type=int, default=20, help="Entries per ranking")
+    parser.add_argument("--max-queries", type=int, default=MAX_QUERIES,
+                        help="Distinct queries tracked before the rest are grouped together")
+    parser.add_argument("-o", "--output", default="-", help="JSON report file, - for stdout")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    summary = WorkloadSummary(args.max_queries)
+    start = time.perf_counter()
+    if args.workers > 0:
+        with ProcessPoolExecutor(args.workers) as executor:
+            ingest(args.logs, executor, args.workers, summary)
+    else:
+        ingest(args.logs, summary=summary)
+    elapsed = time.perf_counter() - start
+    print(f"Ingested {summary.plans} plans ({summary.errors} unreadable) in {elapsed:.2f}s", file=sys.stderr)
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        json.dump(summary.report(args.top), out, indent=2)
+        out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
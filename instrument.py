@@ -0,0 +1,351 @@
+import argparse
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, List, Optional
+
+
+class Run:
+    """Timing spans and counters of one run: a GUI click, a batch query.
+
+    Spans nest; each keeps its depth and start offset, so a run reads as a
+    flame graph turned on its side. "stages" sums the spans per name.
+    """
+
+    __slots__ = ("label", "started_at", "_start", "spans", "counters", "depth", "total_ms")
+
+    def __init__(self, label: str):
+        self.label = label
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.spans: List[tuple] = []
+        self.counters = {}
+        self.depth = 0
+        self.total_ms = None
+
+    def finish(self):
+        self.total_ms = (time.perf_counter() - self._start) * 1000
+
+    def to_json(self) -> dict:
+        stages = {}
+        for name, _, _, ms in self.spans:
+            stage = stages.setdefault(name, {"calls": 0, "ms": 0.0})
+            stage["calls"] += 1
+            stage["ms"] += ms
+        for stage in stages.values():
+            stage["ms"] = round(stage["ms"], 3)
+        total_ms = self.total_ms if self.total_ms is not None else (time.perf_counter() - self._start) * 1000
+        return {
+            "label": self.label,
+            "started_at": self.started_at,
+            "total_ms": round(total_ms, 3),
+            "stages": stages,
+            "spans": [{"name": name, "depth": depth, "start_ms": round(start, 3), "ms": round(ms, 3)}
+                      for name, depth, start, ms in self.spans],
+            "counters": dict(self.counters),
+        }
+
+
+class _Span:
+    __slots__ = ("run", "name", "depth", "start")
+
+    def __init__(self, run: Run, name: str):
+        self.run = run
+        self.name = name
+
+    def __enter__(self):
+        self.depth = self.run.depth
+        self.run.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        run = self.run
+        run.depth -= 1
+        run.spans.append((self.name, self.depth, (self.start - run._start) * 1000, (end - self.start) * 1000))
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Recorder:
+    """Collects spans and counters for the run active in the calling thread.
+
+    Outside a run, `span` and `count` do nothing beyond a thread-local
+    lookup, so instrumented code costs next to nothing when nobody is
+    listening. Finished runs go to every sink in `sinks`.
+    """
+
+    def __init__(self):
+        self.sinks: List[object] = []
+        self._local = threading.local()
+
+    def current(self) -> Optional[Run]:
+        return getattr(self._local, "run", None)
+
+    @contextmanager
+    def run(self, label: str, emit: bool = True):
+        """Record the block as one run; a run inside a run joins the outer one."""
+        outer = self.current()
+        if outer is not None:
+            yield outer
+            return
+        run = Run(label)
+        self._local.run = run
+        try:
+            yield run
+        finally:
+            self._local.run = None
+            run.finish()
+            if emit:
+                self.emit(run.to_json())
+
+    def emit(self, run: dict):
+        for sink in self.sinks:
+            try:
+                sink.emit(run)
+            except Exception as e:
+                # Metrics never break the run they describe
+                print(f"Instrumentation sink failed: {e}", file=sys.stderr)
+
+    def span(self, name: str):
+        run = self.current()
+        return _Span(run, name) if run is not None else _NULL_SPAN
+
+    def count(self, name: str, value: float = 1):
+        run = self.current()
+        if run is not None:
+            run.counters[name] = run.counters.get(name, 0) + value
+
+
+RECORDER = Recorder()
+
+
+def span(name: str):
+    """Time a block as stage `name` of the current run."""
+    return RECORDER.span(name)
+
+
+def count(name: str, value: float = 1):
+    RECORDER.count(name, value)
+
+
+def timed(name: str):
+    """Decorator: time every call of the function as stage `name`."""
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            run = RECORDER.current()
+            if run is None:
+                return fn(*args, **kwargs)
+            with _Span(run, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class JSONLinesSink:
+    """Appends each finished run to a file as one JSON line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, run: dict):
+        line = json.dumps(run) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+class PrometheusSink:
+    """Keeps running totals and rewrites them as a Prometheus text file.
+
+    Meant for node_exporter's textfile collector: the file is replaced
+    atomically after every run, never left half-written.
+    """
+
+    def __init__(self, path: str, prefix: str = "pipesyntax"):
+        self.path = path
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.run_seconds = 0.0
+        self.stages = {}
+        self.counters = {}
+
+    def emit(self, run: dict):
+        with self._lock:
+            self.runs += 1
+            self.run_seconds += run["total_ms"] / 1000
+            for name, stage in run["stages"].items():
+                calls, seconds = self.stages.get(name, (0, 0.0))
+                self.stages[name] = (calls + stage["calls"], seconds + stage["ms"] / 1000)
+            for name, value in run["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            text = self.render()
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, self.path)
+
+    def render(self) -> str:
+        p = self.prefix
+        lines = [
+            f"# HELP {p}_runs_total Instrumented runs.",
+            f"# TYPE {p}_runs_total counter",
+            f"{p}_runs_total {self.runs}",
+            f"# HELP {p}_run_seconds_total Wall time of all runs.",
+            f"# TYPE {p}_run_seconds_total counter",
+            f"{p}_run_seconds_total {self.run_seconds:.6f}",
+            f"# HELP {p}_stage_calls_total Calls per stage.",
+            f"# TYPE {p}_stage_calls_total counter",
+        ]
+        lines += [f'{p}_stage_calls_total{{stage="{name}"}} {calls}'
+                  for name, (calls, _) in sorted(self.stages.items())]
+        lines += [f"# HELP {p}_stage_seconds_total Time per stage; nested stages overlap.",
+                  f"# TYPE {p}_stage_seconds_total counter"]
+        lines += [f'{p}_stage_seconds_total{{stage="{name}"}} {seconds:.6f}'
+                  for name, (_, seconds) in sorted(self.stages.items())]
+        lines += [f"# HELP {p}_events_total Counted events, e.g. plan cache hits.",
+                  f"# TYPE {p}_events_total counter"]
+        lines += [f'{p}_events_total{{event="{name}"}} {value:g}'
+                  for name, value in sorted(self.counters.items())]
+        return "\n".join(lines) + "\n"
+
+
+class CallbackSink:
+    """Hands each finished run to a function, e.g. to show it in the GUI."""
+
+    def __init__(self, callback: Callable[[dict], None]):
+        self.callback = callback
+
+    def emit(self, run: dict):
+        self.callback(run)
+
+
+def configure_from_env(recorder: Recorder = RECORDER):
+    """Add sinks named by $PIPESYNTAX_METRICS_LOG and $PIPESYNTAX_PROMETHEUS_FILE."""
+    if os.environ.get("PIPESYNTAX_METRICS_LOG"):
+        recorder.sinks.append(JSONLinesSink(os.environ["PIPESYNTAX_METRICS_LOG"]))
+    if os.environ.get("PIPESYNTAX_PROMETHEUS_FILE"):
+        recorder.sinks.append(PrometheusSink(os.environ["PIPESYNTAX_PROMETHEUS_FILE"]))
+
+
+def format_run(run: dict) -> str:
+    """The run's spans as an indented table, in the order they started."""
+    lines = [f"{run['label']}: {run['total_ms']:.1f} ms"]
+    for entry in sorted(run["spans"], key=lambda entry: entry["start_ms"]):
+        name = "  " * (entry["depth"] + 1) + entry["name"]
+        lines.append(f"{name:<32}{entry['ms']:>10.1f} ms")
+    if run["counters"]:
+        lines.append("  " + ", ".join(f"{name}={value:g}" for name, value in sorted(run["counters"].items())))
+    return "\n".join(lines)
+
+
+@contextmanager
+def profiled(prefix: str, memory: bool = True, top_n: int = 25):
+    """cProfile (and tracemalloc) the block, in the calling thread only.
+
+    Writes `<prefix>.prof` (open with pstats or snakeviz) and, with
+    `memory`, `<prefix>_memory.txt` with the lines that allocated most.
+    Yields the list the written paths are added to.
+    """
+    paths = []
+    profiler = cProfile.Profile()
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        yield paths
+    finally:
+        profiler.disable()
+        profiler.dump_stats(f"{prefix}.prof")
+        paths.append(f"{prefix}.prof")
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if started_tracing:
+                tracemalloc.stop()
+            with open(f"{prefix}_memory.txt", "w", encoding="utf-8") as f:
+                f.write(f"current {current / 1024:.1f} KB, peak {peak / 1024:.1f} KB\n")
+                for stat in snapshot.statistics("lineno")[:top_n]:
+                    f.write(f"{stat}\n")
+            paths.append(f"{prefix}_memory.txt")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    from batch import add_connection_arguments
+
+    parser = argparse.ArgumentParser(description="Time (and optionally profile) one report build, stage by stage")
+    parser.add_argument("source", help="Saved plan (JSON or text EXPLAIN), or a .sql file with --explain")
+    parser.add_argument("--explain", action="store_true", help="Explain `source` on the database first")
+    add_connection_arguments(parser)
+    parser.add_argument("--analyze", action="store_true", help="With --explain: EXPLAIN ANALYZE (rolled back)")
+    parser.add_argument("--offline", action="store_true", help="Inline plotly.js in the report")
+    parser.add_argument("--report", default="result.html", help="Where to write the report")
+    parser.add_argument("--profile", default=None, metavar="PREFIX",
+                        help="Also write PREFIX.prof (cProfile) and PREFIX_memory.txt (tracemalloc)")
+    parser.add_argument("--json", action="store_true", help="Print the run as JSON instead of a table")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from batch import db_config_from_args
+    from dbsession import DBSession
+    from interface import build_report_html, write_report
+    from plandiff import load_plan_file
+    from preprocessing import build_tree_from_json, get_plan
+
+    args = build_parser().parse_args(argv)
+    configure_from_env()
+
+    def build():
+        if args.explain:
+            with open(args.source, "r", encoding="utf-8") as f:
+                sql = f.read().strip().rstrip(";")
+            with DBSession(args.dbms, db_config_from_args(args), pool_size=1) as session:
+                qep = get_plan(sql, session, analyze=args.analyze, buffers=args.analyze)
+            tree = build_tree_from_json(qep)
+        else:
+            tree = load_plan_file(args.source)
+            qep = getattr(tree, "qep", None)
+        write_report(build_report_html(tree, qep, offline=args.offline), args.report)
+
+    paths = []
+    with RECORDER.run(os.path.basename(args.source)) as run:
+        if args.profile:
+            with profiled(args.profile) as paths:
+                build()
+        else:
+            build()
+    report = run.to_json()
+    print(json.dumps(report, indent=2) if args.json else format_run(report))
+    for path in paths:
+        print(f"Wrote {path}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    # Run the imported module's main, so spans land in the RECORDER the
+    # instrumented modules import rather than in __main__'s copy
+    import instrument
+    sys.exit(instrument.main())
@@ -1,8 +1,20 @@
+import os
+import queue
+import threading
 import webbrowser
-from tkinter import ttk, Tk, scrolledtext, StringVar, messagebox
-from preprocessing import get_qep, get_qep_mysql
-from pipesyntax import generate_pipe_syntax
-from preprocessing import parse_query_explanation_to_tree, Visualizer
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import ttk, Tk, scrolledtext, StringVar, BooleanVar, messagebox
+from preprocessing import get_plan
+from pipesyntax import build_pipeline, render_html
+from preprocessing import build_tree_from_json, Visualizer
+from dbsession import normalize_dbms, open_session
+from plancache import PlanCache
+from plansource import RecordingPlanSource, ReplayPlanSource
+from analysis import memory_settings, misestimation_report, parallel_report, spill_report
+from plandiff import build_diff_html, diff_plans
+from history import PlanHistory, plan_record
+from instrument import RECORDER, configure_from_env, format_run, profiled, span, timed
+from reportserver import DEFAULT_PORT, ReportServer
 from sv_ttk import set_theme
 
 def build_login_frame(root, login_frame, app_frame):
@@ -21,6 +33,8 @@ def build_login_frame(root, login_frame, app_frame):
     user = StringVar(value="postgres")
     password = StringVar()
     dbname = StringVar(value="TPC-H")
+    pool_size = StringVar(value="4")
+    timeout = StringVar(value="60")
 
     for label, var in [
         ("Host:", host),
@@ -28,7 +42,9 @@ def build_login_frame(root, login_frame, app_frame):
         ("Port:", port),
         ("Username:", user),
         ("Password:", password),
-        ("Database:", dbname)
+        ("Database:", dbname),
+        ("Pool Size:", pool_size),
+        ("Timeout (s):", timeout),
     ]:
         frame = ttk.Frame(inner)
         frame.pack(pady=5)
@@ -41,33 +57,36 @@ def build_login_frame(root, login_frame, app_frame):
             messagebox.showerror("Login Error", "All fields must be filled in.")
             return
 
-        root.database_type = dbms.get()
+        try:
+            root.database_type = normalize_dbms(dbms.get())
+            size = int(pool_size.get() or 4)
+            statement_timeout = float(timeout.get()) if timeout.get() else None
+        except ValueError as e:
+            messagebox.showerror("Login Error", str(e))
+            return
 
         root.db_config = {
             "host": host.get(), "port": port.get(), "user": user.get(),
             "password": password.get(), "dbname": dbname.get()
         }
 
-        if root.database_type.lower() == "postgres" or root.database_type.lower() == "postgresql":
-            try:
-                import psycopg2
-                conn = psycopg2.connect(**root.db_config)
-                conn.close()
-            except Exception as e:
-                messagebox.showerror("Connection Failed", f"Could not connect to the database:\n{e}")
-                return
-        elif root.database_type.lower() == "mysql":
-            try:
-                import mysql.connector
-                conn = mysql.connector.connect(**root.db_config)
-                conn.close()
-            except Exception as e:
-                messagebox.showerror("Connection Failed", f"Could not connect to the database:\n{e}")
-                return
-        else:
-            messagebox.showerror("Connection Failed", "Unsupported database\n")
+        try:
+            session = open_session(
+                root.database_type, root.db_config,
+                pool_size=size, statement_timeout=statement_timeout,
+            )
+        except Exception as e:
+            messagebox.showerror("Connection Failed", f"Could not connect to the database:\n{e}")
             return
-
+        if os.environ.get("PIPESYNTAX_RECORD"):
+            # Every plan of the session also goes to the archive, for replays
+            session = RecordingPlanSource(session, os.environ["PIPESYNTAX_RECORD"])
+        # Logging in again replaces the previous session
+        if root.session is not None:
+            root.session.close()
+        root.session = session
+        # Plans from a different database must not be served from the cache
+        root.plan_cache.clear()
 
         app_frame.tkraise()
 
@@ -88,7 +107,156 @@ def build_app_frame(root, app_frame):
     query_input = scrolledtext.ScrolledText(frame, height=12, wrap="word")
     query_input.grid(row=1, column=0, sticky="nsew", pady=5)
 
-    ttk.Button(frame, text="Generate Pipe-Syntax", command=lambda: run_query()).grid(row=3, column=0, pady=10)
+    analyze = BooleanVar(value=False)
+    buffers = BooleanVar(value=True)
+    options = ttk.Frame(frame)
+    options.grid(row=2, column=0, sticky="w")
+    ttk.Checkbutton(options, text="EXPLAIN ANALYZE (runs the query, then rolls back)", variable=analyze).pack(side="left")
+    ttk.Checkbutton(options, text="Buffers", variable=buffers).pack(side="left", padx=10)
+    # Inlines plotly.js so result.html opens without network access; the
+    # report server always serves its own copy
+    offline = BooleanVar(value=False)
+    ttk.Checkbutton(options, text="Offline report", variable=offline).pack(side="left")
+    # Opens diff.html comparing this run's plan with the previous one
+    compare = BooleanVar(value=False)
+    ttk.Checkbutton(options, text="Diff with previous plan", variable=compare).pack(side="left", padx=10)
+    # Writes profile.prof and profile_memory.txt for this run only
+    profile = BooleanVar(value=False)
+    ttk.Checkbutton(options, text="Profile", variable=profile).pack(side="left")
+
+    ttk.Label(options, text="Timeout (s):").pack(side="left", padx=(10, 0))
+    run_timeout = StringVar(value="")
+    ttk.Entry(options, textvariable=run_timeout, width=6).pack(side="left", padx=5)
+
+    buttons = ttk.Frame(frame)
+    buttons.grid(row=3, column=0, pady=10)
+    ttk.Button(buttons, text="Generate Pipe-Syntax", command=lambda: run_query()).pack(side="left", padx=5)
+    cancel_button = ttk.Button(buttons, text="Cancel", command=lambda: cancel_query(), state="disabled")
+    cancel_button.pack(side="left", padx=5)
+
+    status = StringVar(value="")
+    ttk.Label(frame, textvariable=status).grid(row=4, column=0, sticky="w")
+
+    # Stage timings of the last run
+    timings = scrolledtext.ScrolledText(frame, height=8, wrap="none", state="disabled")
+    timings.grid(row=5, column=0, sticky="nsew", pady=5)
+
+    def show_timings(run):
+        timings.configure(state="normal")
+        timings.delete("1.0", "end")
+        timings.insert("1.0", format_run(run))
+        timings.configure(state="disabled")
+
+    # Only the newest run's events are shown; older runs are discarded
+    state = {"generation": 0, "run": None}
+
+    def post(generation, kind, payload=None):
+        root.events.put((generation, kind, payload))
+
+    def explain_in_background(generation, run, sql, analyze_plan, use_buffers, timeout, offline_report,
+                              previous_tree=None, profile_run=False):
+        run["thread"] = threading.get_ident()
+        with RECORDER.run("report") as timing:
+            if profile_run:
+                with profiled("profile") as paths:
+                    outcome = build_in_background(generation, run, sql, analyze_plan, use_buffers, timeout,
+                                                  offline_report, previous_tree)
+                if outcome[0] == "done":
+                    outcome[1]["profile"] = paths
+            else:
+                outcome = build_in_background(generation, run, sql, analyze_plan, use_buffers, timeout,
+                                              offline_report, previous_tree)
+        if outcome[0] == "done":
+            outcome[1]["timings"] = timing.to_json()
+        post(generation, *outcome)
+
+    def build_in_background(generation, run, sql, analyze_plan, use_buffers, timeout, offline_report,
+                            previous_tree=None):
+        # Returns the (kind, payload) event that ends the run
+
+        def progress(message):
+            if run["cancelled"].is_set():
+                raise RunCancelled()
+            post(generation, "progress", message)
+
+        try:
+            progress("Explaining query...")
+            if analyze_plan:
+                # Actual timings differ on every run, so they are never cached
+                qep = get_plan(sql, root.session, timeout=timeout, analyze=True, buffers=use_buffers)
+                progress("Building execution tree...")
+                exec_tree = build_tree_from_json(qep)
+                pipeline = None
+            else:
+                # One plan (MySQL's converted) feeds the tree, the cost breakdown and the pipe syntax
+                cached = root.plan_cache.explain(sql, root.session, timeout=timeout)
+                qep, exec_tree, pipeline = cached.qep, cached.tree, cached.pipeline
+            exec_tree.qep = qep
+            # Fetched once per session; the report sizes work_mem with them
+            exec_tree.settings = root.plan_cache.planner_settings(root.session)
+            progress("Recording plan history...")
+            with span("history"):
+                flag = root.history.record(plan_record(
+                    sql, qep, exec_tree.get_cost(), exec_tree.settings,
+                    root.session.dbms, label="analyze" if analyze_plan else None,
+                ))
+            if root.report_server is not None:
+                # The server renders the report when the browser asks for it
+                progress("Publishing report...")
+                server = root.report_server
+                plan_id = server.publish(qep, exec_tree, title=" ".join(sql.split())[:80], sql=sql,
+                                         pipeline=pipeline)
+                path = server.report_url(plan_id)
+                if previous_tree is not None:
+                    previous_id = server.publish(previous_tree.qep, previous_tree)
+                    path = server.diff_url(previous_id, plan_id)
+            else:
+                combined_html = build_report_html(
+                    exec_tree, qep, pipeline=pipeline, progress=progress, offline=offline_report
+                )
+                progress("Writing report...")
+                path = write_report(combined_html)
+                if previous_tree is not None:
+                    progress("Comparing with the previous plan...")
+                    with span("diff"):
+                        diff_html = build_diff_html(diff_plans(previous_tree, exec_tree), offline=offline_report)
+                    path = write_report(diff_html, "diff.html")
+            return "done", {"qep": qep, "tree": exec_tree, "path": path, "flag": flag}
+        except RunCancelled:
+            return "cancelled", None
+        except Exception as e:
+            # A cancelled statement surfaces as a driver error
+            return ("cancelled" if run["cancelled"].is_set() else "error"), str(e)
+
+    def poll_events():
+        try:
+            while True:
+                generation, kind, payload = root.events.get_nowait()
+                if generation != state["generation"]:
+                    continue
+                if kind == "progress":
+                    status.set(payload)
+                    continue
+                state["run"] = None
+                cancel_button.configure(state="disabled")
+                if kind == "done":
+                    root.last_qep, root.exec_tree = payload["qep"], payload["tree"]
+                    done = history_status(payload["flag"])
+                    if payload.get("profile"):
+                        done += f" — profile in {', '.join(payload['profile'])}"
+                    status.set(done)
+                    show_timings(payload["timings"])
+                    webbrowser.open(payload["path"])
+                elif kind == "cancelled":
+                    status.set("Cancelled")
+                else:
+                    root.last_qep = None
+                    root.exec_tree = None
+                    status.set("Failed")
+                    messagebox.showerror("Query Failed", payload)
+        except queue.Empty:
+            pass
+        root.after(50, poll_events)
 
     def run_query():
         sql = query_input.get("1.0", "end").strip()
@@ -96,44 +264,86 @@ def build_app_frame(root, app_frame):
             messagebox.showwarning("Empty Query", "Please enter an SQL query.")
             return
         try:
-            if root.database_type.lower() == "postgres" or root.database_type.lower() == "postgresql":
-                qep = get_qep(sql, db_config=root.db_config, as_json=False)
-            exec_tree = parse_query_explanation_to_tree(qep)
-            exec_tree.finalize_id()
-            if root.database_type.lower() == "mysql":
-                qep = get_qep_mysql(sql, db_config=root.db_config)
-            root.last_qep = qep
-            root.exec_tree = exec_tree
-            exec_tree.qep = qep
-            update_plotly_browser(exec_tree, sql, root.db_config)
-        except Exception as e:
-            root.last_qep = None
-            root.exec_tree = None
-            messagebox.showerror("Query Failed", str(e))
+            timeout = float(run_timeout.get()) if run_timeout.get().strip() else None
+        except ValueError:
+            messagebox.showerror("Invalid Timeout", "Timeout must be a number of seconds.")
+            return
+        # A new run supersedes the one still in flight
+        cancel_query()
+        state["generation"] += 1
+        run = {"cancelled": threading.Event(), "thread": None}
+        state["run"] = run
+        status.set("Starting...")
+        cancel_button.configure(state="normal")
+        root.executor.submit(
+            explain_in_background, state["generation"], run, sql,
+            analyze.get(), buffers.get(), timeout, offline.get(),
+            root.exec_tree if compare.get() else None, profile.get(),
+        )
+
+    def cancel_query():
+        run = state["run"]
+        if run is None:
+            return
+        run["cancelled"].set()
+        if run["thread"] is not None and root.session is not None:
+            root.session.cancel(run["thread"])
+        status.set("Cancelling...")
+
+    root.cancel_query = cancel_query
+    poll_events()
 
-def update_plotly_browser(exec_tree, sql, db_config):
+
+def history_status(flag):
+    # What the plan history says about this run, for the status line
+    notes = []
+    if flag["flipped"]:
+        notes.append("plan changed since the last run")
+    if flag["regression"]:
+        notes.append(f"cost x{flag['cost_ratio']} of the last run")
+    return f"Done ({', '.join(notes)})" if notes else "Done"
+
+
+class RunCancelled(Exception):
+    pass
+
+
+def update_plotly_browser(exec_tree, qep, pipeline=None, offline=False):
+    webbrowser.open(write_report(build_report_html(exec_tree, qep, pipeline, offline=offline)))
+
+
+@timed("write_report")
+def write_report(combined_html, path="result.html"):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(combined_html)
+    return path
+
+
+def build_report_html(exec_tree, qep, pipeline=None, progress=None, offline=False, plotlyjs_url=None):
     import html
 
-    # 1. Visualize QEP Tree
-    viz = Visualizer()
-    fig = viz.visualize(exec_tree)
-    fig.update_layout(
-        template="plotly_white",
-        paper_bgcolor="white",
-        plot_bgcolor="white",
-        xaxis=dict(showgrid=False, showticklabels=False, zeroline=False),
-        yaxis=dict(showgrid=False, showticklabels=False, zeroline=False)
-    )
-    fig_html = fig.to_html(full_html=False, include_plotlyjs="cdn")
+    # progress(message) is called before each stage; it may raise to stop the run
+    progress = progress or (lambda message: None)
 
-    # 2. Generate both pipe-syntax versions
-    qep_temp = get_qep(sql, db_config=db_config)
-    pipe_sql_with_cost = generate_pipe_syntax(qep_temp, show_cost=True)
-    pipe_sql_without_cost = generate_pipe_syntax(qep_temp, show_cost=False)
+    # Likely spills are flagged in the tree and listed with the costs
+    spills = spill_report(exec_tree, memory_settings(getattr(exec_tree, "settings", None), qep))
+    colors = hover_notes = None
+    if spills["nodes"]:
+        colors, hover_notes = spill_markers(spills, len(exec_tree.dfs()))
 
-    # Escape HTML safely
-    pipe_with_cost_html = html.escape(pipe_sql_with_cost)
-    pipe_without_cost_html = html.escape(pipe_sql_without_cost)
+    # 1. Visualize QEP Tree; plans of a shape seen before reuse its figure
+    progress("Laying out execution tree...")
+    viz = Visualizer()
+    fig = viz.report_figure(exec_tree, colors=colors, hover_notes=hover_notes)
+    progress("Rendering figure...")
+    fig_html = viz.to_html(fig, offline=offline, plotlyjs_url=plotlyjs_url)
+
+    # 2. Render both pipe-syntax versions from one pass over the tree
+    progress("Generating pipe syntax...")
+    if pipeline is None:
+        pipeline = build_pipeline(exec_tree)
+    pipe_with_cost_html = render_html(pipeline, show_cost=True)
+    pipe_without_cost_html = render_html(pipeline, show_cost=False)
 
     # 1. Get cost breakdown
     cost_info = exec_tree.get_cost()
@@ -141,13 +351,41 @@ def update_plotly_browser(exec_tree, sql, db_config):
     startup_cost = cost_info["startup_cost"]
     cost_steps = cost_info["steps"]
 
-    # 2. Generate cost breakdown HTML
+    # 2. Generate cost breakdown HTML, most expensive operators first
+    hot_spot_rows = ""
+    for step in cost_info["hot_spots"]:
+        hot_spot_rows += (
+            f"<tr><td>{html.escape(step['operation'])}</td><td>{step['net_cost']}</td>"
+            f"<td>{step['loops']:g}</td><td>{step['attributed_cost']}</td>"
+            f"<td>{step['share'] * 100:.1f}%</td></tr>"
+        )
+    hot_spot_html = (
+        "<table cellpadding='4' style='border-collapse:collapse; text-align:left;'>"
+        "<tr><th>Operation</th><th>Net Cost</th><th>Loops</th><th>Attributed Cost</th><th>Share</th></tr>"
+        f"{hot_spot_rows}</table>"
+    )
+    groups_html = ""
+    for title, groups in (("By relation", cost_info["by_relation"]), ("By operator", cost_info["by_operator"])):
+        items = "".join(
+            f"<li><b>{html.escape(group['name'])}</b>: {group['cost']} ({group['share'] * 100:.1f}%)</li>"
+            for group in groups
+        )
+        groups_html += f"<h3>{title}</h3><ul style='padding-left: 20px;'>{items}</ul>"
+
     step_cost_html = "<ul style='padding-left: 20px;'>"
     for step in cost_steps:
-        cond_str = f" — Conditions: {', '.join(step['condition'])}" if step["condition"] else ""
-        step_cost_html += f"<li><b>{step['operation']}</b> → Step Cost: {step['net_cost']}{cond_str}</li>"
+        cond_str = f" — Conditions: {html.escape(', '.join(step['condition']))}" if step["condition"] else ""
+        loops_str = f" × {step['loops']:g} loops" if step["loops"] != 1 else ""
+        step_cost_html += f"<li><b>{html.escape(step['operation'])}</b> → Step Cost: {step['net_cost']}{loops_str}{cond_str}</li>"
     step_cost_html += "</ul>"
 
+    spill_html = build_spill_html(spills) if spills["nodes"] else ""
+    misestimation_html = ""
+    if exec_tree.analyzed:
+        misestimation_html = build_misestimation_html(misestimation_report(exec_tree))
+    parallel = parallel_report(exec_tree)
+    parallel_html = build_parallel_html(parallel) if parallel["gathers"] or parallel["serial"] else ""
+
     # 3. HTML Template with JS toggle
     combined_html = f"""
     <html>
@@ -170,23 +408,201 @@ def update_plotly_browser(exec_tree, sql, db_config):
         <label><input type="checkbox" id="costToggle" onchange="toggleCost()" checked> Show Cost</label>
 
         <div id="with_cost" style="margin-top:10px;">
-            <pre style='background:#f9f9f9;color:#222;padding:15px;border-radius:8px;'>{pipe_with_cost_html}</pre>
+            {pipe_with_cost_html}
         </div>
         <div id="without_cost" style="display:none; margin-top:10px;">
-            <pre style='background:#f9f9f9;color:#222;padding:15px;border-radius:8px;'>{pipe_without_cost_html}</pre>
+            {pipe_without_cost_html}
         </div>
-        <h2 style="margin-top:40px;">Step-wise Cost Breakdown</h2>
+        <h2 style="margin-top:40px;">Cost Hot Spots</h2>
         <p><b>Total Startup Cost:</b> {round(startup_cost, 2)}<br>
         <b>Total Cost:</b> {round(total_cost, 2)}</p>
-        {step_cost_html}
+        {hot_spot_html}
+        {groups_html}
+        <details>
+            <summary><b>Step-wise Cost Breakdown</b></summary>
+            {step_cost_html}
+        </details>
+        {spill_html}
+        {misestimation_html}
+        {parallel_html}
     </body>
     </html>
     """
 
-    # 4. Write to file & open in browser
-    with open("result.html", "w", encoding="utf-8") as f:
-        f.write(combined_html)
-    webbrowser.open("result.html")
+    return combined_html
+
+
+SPILL_COLOR = "#d62728"
+
+
+def format_kb(kb):
+    if kb >= 1024 * 1024:
+        return f"{kb / 1024 / 1024:.1f} GB"
+    if kb >= 1024:
+        return f"{kb / 1024:.1f} MB"
+    return f"{kb:.0f} kB"
+
+
+def spill_hover_text(e):
+    # What was predicted and, after ANALYZE, what happened
+    budget = "work_mem" if e["kind"] in ("sort", "materialize") else "hash_mem"
+    text = f"~{format_kb(e['estimated_kb'])} of {format_kb(e['limit_kb'])} {budget}"
+    if e["spill"]:
+        text += ", spill likely"
+        if e["batches"]:
+            text += f" ({e['batches']} batches)"
+    if e["actual_spill"] is not None:
+        actual = "spilled" if e["actual_spill"] else "in memory"
+        if e["actual_method"]:
+            actual += f", {e['actual_method']}"
+        if (e["actual_batches"] or 0) > 1:
+            actual += f", {e['actual_batches']} batches"
+        text += f"<br><b>Actual</b>: {actual} ({e['verdict']})"
+    return text
+
+
+def spill_markers(report, node_count):
+    """Marker colors and hover notes per node id that flag likely spills."""
+    colors = ["#6175c1"] * node_count
+    notes = [None] * node_count
+    for e in report["nodes"]:
+        if e["spill"] or e["actual_spill"]:
+            colors[e["id"]] = SPILL_COLOR
+        notes[e["id"]] = f"<b>Memory</b>: {spill_hover_text(e)}"
+    return colors, notes
+
+
+def build_spill_html(report):
+    import html
+
+    rows = ""
+    for e in report["nodes"]:
+        style = f" style='color:{SPILL_COLOR};'" if e["spill"] or e["actual_spill"] else ""
+        prediction = "spill" if e["spill"] else "fits"
+        if e["method"]:
+            prediction += f", {e['method']}"
+        if e["batches"] and e["batches"] > 1:
+            prediction += f", {e['batches']} batches"
+        actual = ""
+        if e["actual_spill"] is not None:
+            actual = ", ".join(str(part) for part in (
+                "spilled" if e["actual_spill"] else "in memory", e["actual_method"],
+                f"{e['actual_batches']} batches" if (e["actual_batches"] or 0) > 1 else None,
+                format_kb(e["actual_disk_kb"]) + " disk" if e["actual_disk_kb"] else None,
+                format_kb(e["actual_memory_kb"]) if e["actual_memory_kb"] is not None else None,
+            ) if part)
+        rows += (
+            f"<tr{style}><td>{html.escape(e['operation'])}</td><td>{e['rows']:g}</td><td>{e['width']:g}</td>"
+            f"<td>{format_kb(e['estimated_kb'])}</td><td>{format_kb(e['limit_kb'])}</td>"
+            f"<td>{prediction}</td><td>{html.escape(actual)}</td><td>{e['verdict'] or ''}</td></tr>"
+        )
+    sources = {"session": "session", "plan": "EXPLAIN SETTINGS", "default": "PostgreSQL defaults"}
+    checked = ""
+    if any(e["verdict"] for e in report["nodes"]):
+        checked = f"<br><b>Spilled:</b> {report['spilled']} ({report['missed']} not predicted)"
+    return f"""
+        <h2 style="margin-top:40px;">Memory and Spills</h2>
+        <p><b>work_mem:</b> {format_kb(report["work_mem_kb"])},
+        <b>hash_mem_multiplier:</b> {report["hash_mem_multiplier"]:g}
+        (from {sources[report["source"]]})<br>
+        <b>Spills predicted:</b> {report["predicted"]}{checked}</p>
+        <table cellpadding='4' style='border-collapse:collapse; text-align:left;'>
+        <tr><th>Operation</th><th>Est. Rows</th><th>Width</th><th>Est. Memory</th><th>Limit</th>
+        <th>Prediction</th><th>Actual</th><th>Verdict</th></tr>
+        {rows}</table>
+    """
+
+
+def build_misestimation_html(report):
+    import html
+
+    def rows_html(entries):
+        rows = ""
+        for e in entries:
+            time_ms = "" if e["exclusive_time_ms"] is None else e["exclusive_time_ms"]
+            share = "" if e["time_share"] is None else f"{e['time_share'] * 100:.1f}%"
+            rows += (
+                f"<tr><td>{html.escape(e['operation'])}</td><td>{e['estimated_rows']:g}</td>"
+                f"<td>{e['actual_rows']:g}</td><td>{e['loops']}</td>"
+                f"<td>x{e['error_factor']} {e['direction']}</td><td>{time_ms}</td><td>{share}</td>"
+                f"<td>{e['shared_hit_blocks'] if e['shared_hit_blocks'] is not None else ''}</td>"
+                f"<td>{e['shared_read_blocks'] if e['shared_read_blocks'] is not None else ''}</td></tr>"
+            )
+        return rows
+
+    header = (
+        "<tr><th>Operation</th><th>Est. Rows</th><th>Actual Rows</th><th>Loops</th>"
+        "<th>Estimate Error</th><th>Own Time (ms)</th><th>Time Share</th>"
+        "<th>Shared Hit</th><th>Shared Read</th></tr>"
+    )
+    table = "<table cellpadding='4' style='border-collapse:collapse; text-align:left;'>"
+    execution_time = report["execution_time_ms"]
+    return f"""
+        <h2 style="margin-top:40px;">Misestimation Report (EXPLAIN ANALYZE)</h2>
+        <p><b>Execution Time:</b> {execution_time if execution_time is not None else "n/a"} ms<br>
+        <b>Nodes misestimated:</b> {report["misestimated"]}</p>
+        <h3>By estimate error</h3>
+        {table}{header}{rows_html(report["by_error"])}</table>
+        <h3>By exclusive time</h3>
+        {table}{header}{rows_html(report["by_time"])}</table>
+    """
+
+
+def build_parallel_html(report):
+    import html
+
+    def cell(value, fmt="{}"):
+        return "" if value is None else fmt.format(value)
+
+    table = "<table cellpadding='4' style='border-collapse:collapse; text-align:left;'>"
+    gather_rows = ""
+    for g in report["gathers"]:
+        rows = g["process_rows"] or {}
+        per_process = ", ".join(f"{html.escape(name)}: {count:,.0f}" for name, count in rows.items())
+        gather_rows += (
+            f"<tr><td>{html.escape(g['operation'])}</td><td>{g['workers_planned']}</td>"
+            f"<td>{cell(g['workers_launched'])}</td><td>{cell(g['speedup'], 'x{}')}</td>"
+            f"<td>{cell(None if g['efficiency'] is None else g['efficiency'] * 100, '{:.0f}%')}</td>"
+            f"<td>{cell(g['row_skew'], 'x{}')}</td><td>{per_process}</td></tr>"
+        )
+    gathers_html = ""
+    if gather_rows:
+        gathers_html = (
+            f"<h3>Gathers</h3>{table}<tr><th>Operation</th><th>Planned</th><th>Launched</th>"
+            "<th>Speedup</th><th>Efficiency</th><th>Row Skew</th><th>Rows per Process</th></tr>"
+            f"{gather_rows}</table>"
+        )
+    serial_rows = ""
+    for e in report["serial"]:
+        serial_rows += (
+            f"<tr><td>{html.escape(e['operation'])}</td><td>{e['attributed_cost']}</td>"
+            f"<td>{e['share'] * 100:.1f}%</td><td>{cell(e['exclusive_time_ms'])}</td>"
+            f"<td>{html.escape(e['reason'])}</td></tr>"
+        )
+    serial_html = ""
+    if serial_rows:
+        serial_html = (
+            f"<h3>Serial operators</h3>{table}<tr><th>Operation</th><th>Attributed Cost</th>"
+            f"<th>Share</th><th>Own Time (ms)</th><th>Why Serial</th></tr>{serial_rows}</table>"
+        )
+    return f"""
+        <h2 style="margin-top:40px;">Parallel Query</h2>
+        <p><b>Parallel-aware nodes:</b> {report["parallel_nodes"]}<br>
+        <b>Cost run serially:</b> {report["serial_cost_share"] * 100:.1f}%</p>
+        {gathers_html}
+        {serial_html}
+    """
+
+
+def start_report_server():
+    """The local report server, or None to write report files instead."""
+    for port in (DEFAULT_PORT, 0):
+        try:
+            return ReportServer(port=port).start()
+        except OSError:
+            # Taken, e.g. by another window or a standalone reportserver.py
+            continue
+    return None
 
 
 def launch_gui():
@@ -196,9 +612,32 @@ def launch_gui():
     root.resizable(True, True)
 
     set_theme("dark")
+    # $PIPESYNTAX_METRICS_LOG / $PIPESYNTAX_PROMETHEUS_FILE also get every run's timings
+    configure_from_env()
 
     root.last_qep = None
     root.exec_tree = None
+    root.session = None
+    root.plan_cache = PlanCache()
+    # Every explained plan is kept, so plan flips and cost regressions show up
+    root.history = PlanHistory()
+    # EXPLAIN and rendering run here; the Tk thread only drains root.events
+    root.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="explain")
+    root.events = queue.Queue()
+    root.report_server = start_report_server()
+
+    def on_close():
+        root.cancel_query()
+        root.executor.shutdown(wait=False, cancel_futures=True)
+        # Return every pooled connection to the server before exiting
+        if root.session is not None:
+            root.session.close()
+        root.history.close()
+        if root.report_server is not None:
+            root.report_server.stop()
+        root.destroy()
+
+    root.protocol("WM_DELETE_WINDOW", on_close)
 
     login_frame = ttk.Frame(root)
     app_frame = ttk.Frame(root)
@@ -206,6 +645,15 @@ def launch_gui():
     build_login_frame(root, login_frame, app_frame)
     build_app_frame(root, app_frame)
 
-    login_frame.tkraise()
+    if os.environ.get("PIPESYNTAX_REPLAY"):
+        # Plans come from the archive; there is nothing to log in to
+        try:
+            root.session = ReplayPlanSource(os.environ["PIPESYNTAX_REPLAY"])
+        except OSError as e:
+            messagebox.showerror("Replay Failed", f"Could not open the plan archive:\n{e}")
+    if root.session is not None:
+        app_frame.tkraise()
+    else:
+        login_frame.tkraise()
     root.mainloop()
 
@@ -0,0 +1,418 @@
+import json
+import re
+from typing import List, Optional, Union
+
+
+# Everything downstream (trees, costs, pipe syntax, fingerprints, the plan
+# cache) reads PostgreSQL's EXPLAIN (FORMAT JSON) shape: {"Plan": {"Node Type",
+# "Total Cost", "Plan Rows", "Plans": [...], ...}}. These adapters turn
+# MySQL's EXPLAIN output into that shape.
+
+# EXPLAIN FORMAT=JSON access types
+INDEX_ACCESS_TYPES = {"const", "system", "eq_ref", "ref", "ref_or_null", "range",
+                      "index_merge", "fulltext", "unique_subquery", "index_subquery", "index"}
+
+# EXPLAIN FORMAT=TREE
+TREE_COST_RE = re.compile(r"\(cost=(?:(?P<startup>[\d.e+-]+)\.\.)?(?P<total>[\d.e+-]+) rows=(?P<rows>[\d.e+-]+)\)")
+TREE_ACTUAL_RE = re.compile(
+    r"\(actual time=(?P<startup>[\d.e+-]+)\.\.(?P<total>[\d.e+-]+) rows=(?P<rows>[\d.e+-]+) loops=(?P<loops>\d+)\)"
+)
+TREE_SCAN_RE = re.compile(
+    r"^(?P<covering>Covering )?(?P<kind>Table scan|Index scan|Index lookup|Single-row index lookup|"
+    r"Single-row covering index lookup|Index range scan|Full-text index search|Constant row from) on "
+    r"(?P<table>\S+)(?: using (?P<index>\S+))?(?: over (?P<over>.*)| \((?P<cond>.*)\))?$"
+)
+TREE_JOINS = [
+    # (prefix, node type, join type)
+    ("Nested loop inner join", "Nested Loop", "Inner"),
+    ("Nested loop left join", "Nested Loop", "Left"),
+    ("Nested loop semijoin", "Nested Loop", "Semi"),
+    ("Nested loop antijoin", "Nested Loop", "Anti"),
+    ("Inner hash join", "Hash Join", "Inner"),
+    ("Left hash join", "Hash Join", "Left"),
+    ("Hash semijoin", "Hash Join", "Semi"),
+    ("Hash antijoin", "Hash Join", "Anti"),
+]
+TREE_SUBQUERY_RE = re.compile(r"^Select #(?P<id>\d+) \((?P<what>.*)\)$")
+# Top-N sorts: "Sort: a DESC, limit input to 10 row(s) per chunk"
+TREE_SORT_LIMIT_RE = re.compile(r",? ?limit input to \d+ row\(s\) per chunk$")
+
+# Both EXPLAIN formats name tables by alias; table_aliases maps them back
+FROM_RE = re.compile(r"\b(FROM|JOIN)\s+", re.IGNORECASE)
+TABLE_REF_RE = re.compile(
+    r"(?:(?:`[^`]+`|\w+)\.)?(?P<table>`[^`]+`|\w+)(?:\s+(?:AS\s+)?(?P<alias>`[^`]+`|\w+))?",
+    re.IGNORECASE,
+)
+LIST_SEP_RE = re.compile(r"\s*,\s*")
+# Words that can follow a table reference without being its alias
+NOT_ALIASES = {"WHERE", "JOIN", "INNER", "LEFT", "RIGHT", "CROSS", "NATURAL", "STRAIGHT_JOIN",
+               "ON", "USING", "GROUP", "ORDER", "HAVING", "WINDOW", "LIMIT", "UNION", "FOR",
+               "LOCK", "USE", "FORCE", "IGNORE", "PARTITION", "SET", "INTO"}
+
+
+def _number(value, default=0.0) -> float:
+    # FORMAT=JSON prints costs as strings ("1.25") and rows as numbers
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _cost(plan: dict) -> float:
+    return plan.get("Total Cost", 0.0)
+
+
+def _unquote(name: str) -> str:
+    return name[1:-1] if name.startswith("`") else name
+
+
+def table_aliases(sql: str) -> dict:
+    """Alias -> table name for the aliased tables in `sql`'s FROM and JOIN clauses.
+
+    A rough scan, not a parser: derived tables, aliases reused for different
+    tables and anything it can't read are left out, and their plan nodes
+    keep the name MySQL gave them.
+    """
+    aliases, reused = {}, set()
+    for clause in FROM_RE.finditer(sql):
+        pos = clause.end()
+        while True:
+            ref = TABLE_REF_RE.match(sql, pos)
+            if ref is None:
+                break
+            table, alias = ref.group("table"), ref.group("alias")
+            if alias and alias.upper() not in NOT_ALIASES and _unquote(alias) != _unquote(table):
+                alias, table = _unquote(alias), _unquote(table)
+                if aliases.setdefault(alias, table) != table:
+                    reused.add(alias)
+            # FROM a x, b y: only FROM takes a list
+            comma = LIST_SEP_RE.match(sql, ref.end())
+            if clause.group(1).upper() != "FROM" or comma is None:
+                break
+            pos = comma.end()
+    return {alias: table for alias, table in aliases.items() if alias not in reused}
+
+
+def _relation(name: str, aliases: Optional[dict]) -> dict:
+    """Relation Name (the real table, for statistics) and Alias, as PostgreSQL has them."""
+    table = (aliases or {}).get(name, name)
+    return {"Relation Name": table, "Alias": name}
+
+
+def _wrap(node_type: str, child: dict, **fields) -> dict:
+    plan = {"Node Type": node_type, "Startup Cost": child.get("Startup Cost", 0.0),
+            "Total Cost": _cost(child), "Plan Rows": child.get("Plan Rows", 0.0),
+            "Plans": [child]}
+    plan.update(fields)
+    return plan
+
+
+class MySQLJSONAdapter:
+    """Convert one EXPLAIN FORMAT=JSON document to the shared plan shape.
+
+    MySQL costs are cumulative: a table's "prefix_cost" covers every table
+    joined before it. Each join becomes a Nested Loop (or Hash Join) whose
+    cost is that prefix cost; the inner table's cost is divided by the outer
+    rows so it reads per execution, like PostgreSQL's.
+    """
+
+    def __init__(self, aliases: Optional[dict] = None):
+        self.subplans = 0
+        # See table_aliases
+        self.aliases = aliases or {}
+
+    def convert(self, doc: dict) -> dict:
+        return {"Plan": self.query_block(doc["query_block"])}
+
+    def query_block(self, block: dict) -> dict:
+        if "union_result" in block:
+            plan = self.union(block["union_result"])
+        else:
+            plan = self.operation(block)
+        if "cost_info" in block and "query_cost" in block["cost_info"]:
+            plan["Total Cost"] = _number(block["cost_info"]["query_cost"])
+        return plan
+
+    def union(self, union: dict) -> dict:
+        parts = [self.query_block(spec["query_block"]) for spec in union.get("query_specifications", [])]
+        plan = {"Node Type": "Append", "Startup Cost": 0.0,
+                "Total Cost": sum(_cost(part) for part in parts),
+                "Plan Rows": sum(part.get("Plan Rows", 0.0) for part in parts), "Plans": parts}
+        if union.get("using_temporary_table"):
+            # UNION (not UNION ALL) removes duplicates through a temporary table
+            plan = _wrap("Unique", plan)
+        return plan
+
+    def operation(self, block: dict) -> dict:
+        """The operation nodes of a query block, outermost first."""
+        if "ordering_operation" in block:
+            inner = self.operation(block["ordering_operation"])
+            if not block["ordering_operation"].get("using_filesort"):
+                # Rows already come out in index order
+                return inner
+            sort_cost = _number(block["ordering_operation"].get("cost_info", {}).get("sort_cost"))
+            return self.with_subqueries(
+                block, _wrap("Sort", inner, **{"Total Cost": _cost(inner) + sort_cost}))
+        if "grouping_operation" in block:
+            grouping = block["grouping_operation"]
+            inner = self.operation(grouping)
+            strategy = "Hashed" if grouping.get("using_temporary_table") else "Sorted"
+            return self.with_subqueries(block, _wrap("Aggregate", inner, Strategy=strategy))
+        if "duplicates_removal" in block:
+            return _wrap("Unique", self.operation(block["duplicates_removal"]))
+        if "windowing" in block:
+            return _wrap("WindowAgg", self.operation(block["windowing"]))
+        if "buffer_result" in block:
+            return _wrap("Materialize", self.operation(block["buffer_result"]))
+        if "nested_loop" in block:
+            plan = self.nested_loop(block["nested_loop"])
+        elif "table" in block:
+            plan = self.table(block["table"])
+        else:
+            # "Impossible WHERE", "No tables used", ...
+            plan = {"Node Type": "Result", "Startup Cost": 0.0, "Total Cost": 0.0, "Plan Rows": 0.0}
+            if "message" in block:
+                plan["One-Time Filter"] = block["message"]
+        return self.with_subqueries(block, plan)
+
+    def with_subqueries(self, block: dict, plan: dict) -> dict:
+        for key in ("optimized_away_subqueries", "attached_subqueries", "select_list_subqueries",
+                    "having_subqueries", "order_by_subqueries", "group_by_subqueries"):
+            for sub in block.get(key, []):
+                self.subplans += 1
+                child = self.query_block(sub["query_block"])
+                if sub.get("dependent"):
+                    child["Parent Relationship"] = "SubPlan"
+                    child["Subplan Name"] = f"SubPlan {self.subplans}"
+                else:
+                    child["Parent Relationship"] = "InitPlan"
+                    child["Subplan Name"] = f"InitPlan {self.subplans}"
+                plan.setdefault("Plans", []).append(child)
+        return plan
+
+    def table(self, table: dict, outer_rows: float = 1.0) -> dict:
+        access = table.get("access_type", "ALL")
+        name = table.get("table_name", "<unknown_table>")
+        cost_info = table.get("cost_info", {})
+        # read + eval cost covers all executions of the table
+        cost = _number(cost_info.get("read_cost")) + _number(cost_info.get("eval_cost"))
+        loops = max(outer_rows, 1.0)
+        rows = _number(table.get("rows_produced_per_join")) / loops
+        plan = {"Startup Cost": 0.0, "Total Cost": cost / loops, "Plan Rows": rows}
+
+        if "materialized_from_subquery" in table:
+            sub = self.query_block(table["materialized_from_subquery"]["query_block"])
+            plan.update({"Node Type": "Subquery Scan", "Alias": name, "Plans": [sub]})
+        elif name.startswith("<"):
+            # <derivedN>, <unionN>, <subqueryN>: internal temporary tables
+            plan.update({"Node Type": "Subquery Scan", "Alias": name})
+        elif access in INDEX_ACCESS_TYPES:
+            covering = table.get("using_index")
+            plan.update({"Node Type": "Index Only Scan" if covering else "Index Scan",
+                         "Index Name": table.get("key"), **_relation(name, self.aliases)})
+            refs = [ref for ref in table.get("ref", []) if ref]
+            parts = table.get("used_key_parts", [])
+            if table.get("index_condition"):
+                plan["Index Cond"] = table["index_condition"]
+            elif refs and len(refs) == len(parts):
+                plan["Index Cond"] = " AND ".join(f"({part} = {ref})" for part, ref in zip(parts, refs))
+        else:
+            plan.update({"Node Type": "Seq Scan", **_relation(name, self.aliases)})
+        if table.get("attached_condition"):
+            plan["Filter"] = table["attached_condition"]
+        return self.with_subqueries(table, plan)
+
+    def nested_loop(self, tables: List[dict]) -> dict:
+        """Left-deep join of the tables, in MySQL's join order."""
+        first = tables[0]
+        plan = self.operation(first)
+        for entry in tables[1:]:
+            table = entry.get("table", entry)
+            outer_rows = plan.get("Plan Rows", 0.0)
+            buffer = table.get("using_join_buffer", "")
+            hashed = "hash" in buffer.lower()
+            # Hashed or buffered inner tables are read once, not per outer row
+            inner = self.table(table, 1.0 if hashed else outer_rows)
+            join_cost = _number(table.get("cost_info", {}).get("prefix_cost"), _cost(plan) + _cost(inner))
+            rows = _number(table.get("rows_produced_per_join"))
+            if hashed:
+                hash_node = _wrap("Hash", inner)
+                plan = {"Node Type": "Hash Join", "Join Type": "Inner", "Startup Cost": _cost(inner),
+                        "Total Cost": join_cost, "Plan Rows": rows, "Plans": [plan, hash_node]}
+                if inner.get("Filter"):
+                    plan["Hash Cond"] = inner.pop("Filter")
+            else:
+                plan = {"Node Type": "Nested Loop", "Join Type": "Inner", "Startup Cost": 0.0,
+                        "Total Cost": join_cost, "Plan Rows": rows, "Plans": [plan, inner]}
+        return plan
+
+
+def _parse_tree_operation(text: str, aliases: Optional[dict] = None) -> dict:
+    """Plan fields for one FORMAT=TREE line, without costs."""
+    scan = TREE_SCAN_RE.match(text)
+    if scan:
+        table = scan.group("table")
+        kind = scan.group("kind")
+        if table.startswith("<"):
+            plan = {"Node Type": "Subquery Scan", "Alias": table}
+        elif kind == "Table scan":
+            plan = {"Node Type": "Seq Scan", **_relation(table, aliases)}
+        else:
+            covering = scan.group("covering") or "covering" in kind
+            plan = {"Node Type": "Index Only Scan" if covering else "Index Scan", **_relation(table, aliases)}
+        if scan.group("index"):
+            plan["Index Name"] = scan.group("index")
+        cond = scan.group("cond") or scan.group("over")
+        if cond:
+            plan["Index Cond"] = f"({cond})"
+        return plan
+    for prefix, node_type, join_type in TREE_JOINS:
+        if text.startswith(prefix):
+            plan = {"Node Type": node_type, "Join Type": join_type}
+            cond = text[len(prefix):].strip()
+            if cond:
+                plan["Hash Cond" if node_type == "Hash Join" else "Join Filter"] = cond
+            return plan
+    label, _, detail = text.partition(": ")
+    if label == "Filter":
+        return {"Node Type": "Filter", "Filter": detail}
+    if label.startswith("Sort"):
+        plan = {"Node Type": "Unique" if "duplicate removal" in label else "Sort"}
+        detail = TREE_SORT_LIMIT_RE.sub("", detail)
+        if detail:
+            plan["Sort Key"] = [key.strip() for key in detail.split(", ")]
+        return plan
+    if label in ("Limit", "Limit/Offset"):
+        return {"Node Type": "Limit"}
+    if text.startswith("Aggregate using temporary table"):
+        return {"Node Type": "Aggregate", "Strategy": "Hashed"}
+    if label == "Group aggregate":
+        return {"Node Type": "Aggregate", "Strategy": "Sorted"}
+    if label == "Aggregate":
+        return {"Node Type": "Aggregate", "Strategy": "Plain"}
+    if text.startswith("Remove duplicates"):
+        return {"Node Type": "Unique"}
+    if text.startswith("Window"):
+        return {"Node Type": "WindowAgg"}
+    if text.startswith(("Materialize", "Temporary table")):
+        return {"Node Type": "Materialize"}
+    if text == "Hash":
+        return {"Node Type": "Hash"}
+    if text.startswith(("Append", "Union")):
+        return {"Node Type": "Append"}
+    if text.startswith(("Zero rows", "Rows fetched before execution")):
+        return {"Node Type": "Result", "One-Time Filter": text}
+    return {"Node Type": label}
+
+
+def mysql_tree_plan(text: Union[str, List[str]], aliases: Optional[dict] = None) -> dict:
+    """Convert EXPLAIN FORMAT=TREE (or EXPLAIN ANALYZE) output to the shared shape.
+
+    Iterator costs are already per execution, so they map directly. "Filter"
+    iterators are folded into the node below them, where PostgreSQL shows
+    filters; "Select #N" lines mark the next node as a SubPlan or InitPlan.
+    `aliases` (see table_aliases) gives scans their real table names.
+    """
+    lines = text.splitlines() if isinstance(text, str) else list(text)
+    root: Optional[dict] = None
+    # (indent, plan) of the open ancestors
+    stack = []
+    pending_subplan = None
+    for line in lines:
+        stripped = line.strip()
+        if not stripped.startswith("->"):
+            continue
+        indent = len(line) - len(line.lstrip())
+        body = stripped[2:].strip()
+        fields = {}
+        cost = TREE_COST_RE.search(body)
+        if cost:
+            fields["Startup Cost"] = _number(cost.group("startup"))
+            fields["Total Cost"] = _number(cost.group("total"))
+            fields["Plan Rows"] = _number(cost.group("rows"))
+        actual = TREE_ACTUAL_RE.search(body)
+        if actual:
+            fields["Actual Startup Time"] = _number(actual.group("startup"))
+            fields["Actual Total Time"] = _number(actual.group("total"))
+            # Averaged over loops, so not always whole
+            rows = _number(actual.group("rows"))
+            fields["Actual Rows"] = int(rows) if rows.is_integer() else rows
+            fields["Actual Loops"] = int(actual.group("loops"))
+        elif "(never executed)" in body:
+            fields.update({"Actual Rows": 0, "Actual Loops": 0})
+        operation = body.split("  (")[0].strip()
+
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        subquery = TREE_SUBQUERY_RE.match(operation)
+        if subquery:
+            # Not a node itself: remember it for the line below
+            correlated = "dependent" in subquery.group("what")
+            pending_subplan = (indent, ("SubPlan" if correlated else "InitPlan") + f" {subquery.group('id')}")
+            continue
+        plan = _parse_tree_operation(operation, aliases)
+        plan.update(fields)
+        if pending_subplan is not None and indent > pending_subplan[0]:
+            plan["Parent Relationship"] = pending_subplan[1].split()[0]
+            plan["Subplan Name"] = pending_subplan[1]
+            pending_subplan = None
+        if stack:
+            stack[-1][1].setdefault("Plans", []).append(plan)
+        else:
+            root = plan
+        stack.append((indent, plan))
+
+    if root is None:
+        raise ValueError("No query plan found in the explanation")
+    return {"Plan": _fold_filters(root)}
+
+
+def _fold_filter(plan: dict) -> dict:
+    """The node a Filter iterator reads from, with the filter moved onto it."""
+    regular = [sub for sub in plan.get("Plans", []) if "Parent Relationship" not in sub]
+    if plan["Node Type"] != "Filter" or len(regular) != 1:
+        return plan
+    below = regular[0]
+    below["Filter"] = plan["Filter"]
+    for key in ("Total Cost", "Plan Rows", "Actual Rows", "Actual Total Time"):
+        if key in plan:
+            below[key] = plan[key]
+    # Subqueries in the condition now hang off the filtered node
+    below.setdefault("Plans", []).extend(sub for sub in plan["Plans"] if sub is not below)
+    if "Parent Relationship" in plan:
+        below["Parent Relationship"] = plan["Parent Relationship"]
+        below["Subplan Name"] = plan["Subplan Name"]
+    return below
+
+
+def _fold_filters(root: dict) -> dict:
+    """Merge Filter iterators into their input and fill in missing costs."""
+    order = []
+    stack = [root]
+    while stack:
+        plan = stack.pop()
+        order.append(plan)
+        stack.extend(plan.get("Plans", []))
+    # Children before parents
+    for plan in reversed(order):
+        children = plan.get("Plans", [])
+        children[:] = [_fold_filter(child) for child in children]
+        # Sorts, limits, ... print no cost in older versions; use their input's
+        if "Total Cost" not in plan:
+            regular = [child for child in children if "Parent Relationship" not in child]
+            plan["Startup Cost"] = max((child["Startup Cost"] for child in regular), default=0.0)
+            plan["Total Cost"] = sum(child["Total Cost"] for child in regular)
+            plan["Plan Rows"] = regular[0]["Plan Rows"] if regular else 0.0
+        plan.setdefault("Startup Cost", 0.0)
+        plan.setdefault("Plan Rows", 0.0)
+    return _fold_filter(root)
+
+
+def mysql_json_plan(doc: Union[str, dict], aliases: Optional[dict] = None) -> dict:
+    """Convert EXPLAIN FORMAT=JSON output (text or parsed) to the shared shape.
+
+    `aliases` (see table_aliases) gives scans their real table names.
+    """
+    if isinstance(doc, str):
+        doc = json.loads(doc)
+    return MySQLJSONAdapter(aliases).convert(doc)
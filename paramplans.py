@@ -0,0 +1,247 @@
+import argparse
+import csv
+import json
+import re
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from batch import add_connection_arguments, db_config_from_args
+from dbsession import DBSession
+from fingerprint import shape_fingerprint
+from pipesyntax import generate_pipe_syntax
+from preprocessing import explain_prefix
+
+
+# A generic plan this many times worse than a sample's custom plan is flagged
+DEFAULT_WORSE_FACTOR = 2.0
+
+STATEMENT_NAME = "pipesyntax_paramplan"
+_PARAM_RE = re.compile(r"\$(\d+)")
+
+
+def parameter_count(sql: str) -> int:
+    return max((int(n) for n in _PARAM_RE.findall(sql)), default=0)
+
+
+def read_samples(path: str, header: bool = False) -> List[list]:
+    """Parameter rows from a CSV file; empty cells are NULL."""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        rows = list(csv.reader(f))
+    if header:
+        rows = rows[1:]
+    return [[value if value != "" else None for value in row] for row in rows if row]
+
+
+def explain_prepared(sql: str, session, params: list, mode: str, timeout: Optional[float] = None,
+                     analyze: bool = False) -> dict:
+    """EXPLAIN EXECUTE `sql` with `params` under plan_cache_mode = `mode`."""
+    result = {"params": params, "mode": mode, "fingerprint": None, "total_cost": None,
+              "actual_ms": None, "error": None, "qep": None}
+    start = time.perf_counter()
+    try:
+        with session.cursor(timeout=timeout) as cur:
+            cur.execute("SELECT set_config('plan_cache_mode', %s, true)", (mode,))
+            cur.execute(f"PREPARE {STATEMENT_NAME} AS {sql}")
+            try:
+                placeholders = ", ".join(["%s"] * len(params))
+                cur.execute(f"{explain_prefix(True, analyze)} EXECUTE {STATEMENT_NAME}({placeholders})",
+                            params)
+                qep = cur.fetchone()[0][0]
+            finally:
+                # Prepared statements outlive the rollback, and an error leaves
+                # the transaction unusable until it is rolled back
+                cur.connection.rollback()
+                cur.execute(f"DEALLOCATE {STATEMENT_NAME}")
+        result["qep"] = qep
+        result["fingerprint"] = shape_fingerprint(qep)
+        result["total_cost"] = qep["Plan"]["Total Cost"]
+        if "Execution Time" in qep:
+            result["actual_ms"] = qep["Execution Time"]
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return result
+
+
+def _spread(costs: List[float]) -> dict:
+    return {"min_cost": min(costs), "median_cost": statistics.median(costs), "max_cost": max(costs)}
+
+
+def summarize_params(generic: List[dict], custom: List[dict], worse_factor: float = DEFAULT_WORSE_FACTOR) -> dict:
+    """Group the custom plans by shape and compare each sample with the generic plan.
+
+    Without ANALYZE the comparison is between estimates: the generic plan's
+    cost is the planner's guess for any parameters, so a sample far below
+    it is one where a custom plan is expected to win. With ANALYZE the
+    samples' actual execution times are compared instead.
+    """
+    plans = {}
+    for sample in custom:
+        if sample["error"]:
+            continue
+        plan = plans.get(sample["fingerprint"])
+        if plan is None:
+            plan = plans[sample["fingerprint"]] = {
+                "fingerprint": sample["fingerprint"],
+                "samples": 0,
+                "costs": [],
+                "example_params": sample["params"],
+                "pipe_syntax": generate_pipe_syntax(sample["qep"], show_cost=False),
+            }
+        plan["samples"] += 1
+        plan["costs"].append(sample["total_cost"])
+
+    valid_generic = [g for g in generic if not g["error"]]
+    generic_plan = None
+    if valid_generic:
+        first = valid_generic[0]
+        generic_plan = {
+            "fingerprint": first["fingerprint"],
+            "total_cost": first["total_cost"],
+            "pipe_syntax": generate_pipe_syntax(first["qep"], show_cost=False),
+            "error": None,
+        }
+    elif generic:
+        generic_plan = {"error": generic[0]["error"]}
+
+    # One generic run per sample with ANALYZE, a single one otherwise
+    generic_by_sample = generic if len(generic) == len(custom) else [generic[0] if generic else None] * len(custom)
+    samples, worse = [], []
+    for sample, generic_run in zip(custom, generic_by_sample):
+        entry = {
+            "params": sample["params"],
+            "fingerprint": sample["fingerprint"],
+            "total_cost": sample["total_cost"],
+            "actual_ms": sample["actual_ms"],
+            "error": sample["error"],
+            "generic_ratio": None,
+        }
+        if not sample["error"] and generic_run is not None and not generic_run["error"]:
+            if sample["actual_ms"] is not None and generic_run["actual_ms"] is not None:
+                entry["generic_actual_ms"] = generic_run["actual_ms"]
+                if sample["actual_ms"]:
+                    entry["generic_ratio"] = round(generic_run["actual_ms"] / sample["actual_ms"], 4)
+            elif sample["total_cost"]:
+                entry["generic_ratio"] = round(generic_run["total_cost"] / sample["total_cost"], 4)
+            entry["same_plan_as_generic"] = sample["fingerprint"] == generic_run["fingerprint"]
+        samples.append(entry)
+        if entry["generic_ratio"] is not None and entry["generic_ratio"] >= worse_factor:
+            worse.append(entry)
+
+    custom_plans = []
+    for plan in sorted(plans.values(), key=lambda plan: plan["samples"], reverse=True):
+        plan.update(_spread(plan.pop("costs")))
+        if generic_plan is not None:
+            plan["same_as_generic"] = plan["fingerprint"] == generic_plan.get("fingerprint")
+        custom_plans.append(plan)
+
+    costs = [sample["total_cost"] for sample in custom if not sample["error"]]
+    prefers_generic = None
+    if costs and generic_plan is not None and not generic_plan["error"]:
+        # Roughly PostgreSQL's rule in auto mode, after five custom plans:
+        # go generic once it is no dearer than the average custom plan
+        prefers_generic = generic_plan["total_cost"] <= statistics.mean(costs)
+    return {
+        "generic": generic_plan,
+        "custom_plans": custom_plans,
+        "custom_cost": _spread(costs) if costs else None,
+        "auto_mode_prefers_generic": prefers_generic,
+        "generic_worse": sorted(worse, key=lambda entry: entry["generic_ratio"], reverse=True),
+        "samples": samples,
+        "failed": sum(1 for sample in custom if sample["error"]),
+    }
+
+
+def run_params(sql: str, session, samples: List[list], workers: int = 4, timeout: Optional[float] = None,
+               analyze: bool = False, worse_factor: float = DEFAULT_WORSE_FACTOR) -> dict:
+    """Explain `sql` with every sample's parameters, custom and generic.
+
+    Each EXPLAIN runs on its own pooled connection inside a transaction that
+    is rolled back, and the prepared statement is deallocated afterwards.
+    """
+    if session.dbms != "postgresql":
+        raise ValueError("Generic and custom plans need PostgreSQL")
+    expected = parameter_count(sql)
+    for row in samples:
+        if len(row) != expected:
+            raise ValueError(f"Query takes {expected} parameters, sample has {len(row)}: {row}")
+    with ThreadPoolExecutor(workers) as executor:
+        custom_futures = [executor.submit(explain_prepared, sql, session, params, "force_custom_plan",
+                                          timeout, analyze) for params in samples]
+        # Generic plans ignore the values; only ANALYZE needs one run per sample
+        generic_samples = samples if analyze else samples[:1]
+        generic_futures = [executor.submit(explain_prepared, sql, session, params, "force_generic_plan",
+                                           timeout, analyze) for params in generic_samples]
+        custom = [future.result() for future in custom_futures]
+        generic = [future.result() for future in generic_futures]
+    report = summarize_params(generic, custom, worse_factor)
+    report["analyze"] = analyze
+    report["worse_factor"] = worse_factor
+    return report
+
+
+def print_summary(report: dict, out=sys.stderr):
+    print(f"{len(report['samples'])} samples, {len(report['custom_plans'])} custom plan shapes, "
+          f"{report['failed']} failed", file=out)
+    generic = report["generic"]
+    if generic and not generic["error"]:
+        print(f"Generic plan cost {generic['total_cost']}; custom {report['custom_cost']}", file=out)
+    measure = "actual time" if report["analyze"] else "estimated cost"
+    print(f"Generic plan at least x{report['worse_factor']:g} worse ({measure}) for "
+          f"{len(report['generic_worse'])} samples", file=out)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Compare generic and custom plans of a prepared statement")
+    parser.add_argument("query", help=".sql file with one statement using $1, $2, ...")
+    parser.add_argument("samples", help="CSV file, one row of parameter values per sample")
+    parser.add_argument("--header", action="store_true", help="Skip the CSV's first row")
+    add_connection_arguments(parser)
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Concurrent EXPLAINs, also the number of connections")
+    parser.add_argument("--timeout", type=float, default=None, help="Statement timeout in seconds")
+    parser.add_argument("--analyze", action="store_true",
+                        help="EXPLAIN ANALYZE each sample, custom and generic (runs it, then rolls back)")
+    parser.add_argument("--worse-factor", type=float, default=DEFAULT_WORSE_FACTOR,
+                        help="Flag samples whose generic plan is this many times worse")
+    parser.add_argument("-o", "--output", default="-", help="JSON report file, - for stdout")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.workers < 1:
+        print("--workers must be at least 1", file=sys.stderr)
+        return 2
+    with open(args.query, "r", encoding="utf-8") as f:
+        sql = f.read().strip().rstrip(";")
+    samples = read_samples(args.samples, args.header)
+    if not samples:
+        print("No parameter samples", file=sys.stderr)
+        return 2
+
+    with DBSession(args.dbms, db_config_from_args(args), pool_size=args.workers,
+                   statement_timeout=args.timeout) as session:
+        try:
+            report = run_params(sql, session, samples, args.workers, args.timeout,
+                                args.analyze, args.worse_factor)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+
+    print_summary(report)
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        json.dump(report, out, indent=2)
+        out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if report["generic"] is None or report["generic"]["error"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
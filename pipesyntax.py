@@ -1,70 +1,312 @@
-def generate_pipe_syntax(qep, show_cost=True):
-    steps = []
-    first_from = None
+import html
+import re
+from typing import List, Optional, Union
 
-    def traverse(plan, depth=0):
-        nonlocal first_from
-        node_type = plan.get("Node Type", "")
-        line = describe_node(plan, show_cost=show_cost)
-        # Debug output
-        print(f"{'  ' * depth}Processing node: {node_type}")
-        print(f"{'  ' * depth}→ Generated: {line}")
-        if line.startswith("FROM") and not first_from:
-            first_from = line
-        else:
-            steps.append(line)
-        for sub in plan.get("Plans", []):
-            traverse(sub,depth+1)
+from analysis import MISESTIMATE_FACTOR, estimate_direction, estimate_error
+from costs import exclusive_costs
+from instrument import timed
+from preprocessing import AGGREGATE_STRATEGIES, ExecutionTree, ExecutionTreeNode, build_tree_from_json
 
-    traverse(qep["Plan"])
-    steps.reverse()
-    return "\n".join([first_from] + steps if first_from else steps)
 
-def describe_node(plan, show_cost=True):
+SCAN_TYPES = {"SEQ SCAN", "INDEX SCAN", "INDEX ONLY SCAN"}
+
+# Text EXPLAIN join labels: "Hash Left Join", "Nested Loop Anti Join", ...
+# Only an inner Nested Loop goes without "Join"; a bare "Hash" is the Hash
+# node under a hash join
+_TEXT_JOIN_KINDS = r"(Left|Right|Full|Semi|Anti|Right Semi|Right Anti)"
+TEXT_JOIN_RE = re.compile(
+    rf"^(?:(Hash|Merge)(?: {_TEXT_JOIN_KINDS})? Join|(Nested Loop)(?: {_TEXT_JOIN_KINDS} Join)?)$"
+)
+TEXT_JOIN_TYPES = {"Hash": "Hash Join", "Merge": "Merge Join", "Nested Loop": "Nested Loop"}
+TEXT_AGGREGATES = {label: strategy for strategy, label in AGGREGATE_STRATEGIES.items()}
+# Keys whose JSON value is a list rather than a string
+LIST_KEYS = ("Sort Key", "Group Key", "Presorted Key")
+
+
+class PipeStep:
+    """One step of a pipe-syntax query, in the order it is printed.
+
+    Attributes:
+        kind (str): "scan", "filter", "join", "aggregate", "order", "limit",
+            "hash", "materialize", "unique", "gather" or "other"
+        text (str): The step without its cost comment
+        node_id (int): Pre-order id of the plan node the step comes from
+        node (ExecutionTreeNode): That node, when built from a tree
+        plan (dict): That node's plan, as JSON or rebuilt from text EXPLAIN
+    """
+
+    __slots__ = ("kind", "text", "node_id", "node", "plan", "node_type",
+                 "startup_cost", "total_cost", "rows", "actuals")
+
+    def __init__(self, kind: str, text: str, node_id: int, plan: dict,
+                 node: Optional[ExecutionTreeNode] = None):
+        self.kind = kind
+        self.text = text
+        self.node_id = node_id
+        self.node = node
+        self.plan = plan
+        self.node_type = plan.get("Node Type", "UNKNOWN")
+        self.startup_cost = plan.get("Startup Cost", 0)
+        self.total_cost = plan.get("Total Cost", 0)
+        self.rows = plan.get("Plan Rows", 0)
+        self.actuals = describe_actuals(plan)
+
+    def cost_comment(self) -> str:
+        return f"  -- Cost: {self.total_cost}{self.actuals}"
+
+    def to_json(self) -> dict:
+        return {
+            "kind": self.kind,
+            "text": self.text,
+            "node_id": self.node_id,
+            "node_type": self.node_type,
+            "relation": self.plan.get("Relation Name"),
+            "startup_cost": self.startup_cost,
+            "total_cost": self.total_cost,
+            "rows": self.rows,
+            "parallel_aware": bool(self.plan.get("Parallel Aware")),
+            "workers_planned": self.plan.get("Workers Planned"),
+            "workers_launched": self.plan.get("Workers Launched"),
+        }
+
+
+class Pipeline:
+    """Pipe-syntax IR of one plan; every renderer works from this.
+
+    Args:
+        steps (list): PipeSteps in printed order
+        tree (ExecutionTree): The tree it was built from, if any
+        qep (dict): The JSON plan it was built from, if any
+    """
+
+    def __init__(self, steps: List[PipeStep], tree: Optional[ExecutionTree] = None,
+                 qep: Optional[dict] = None):
+        self.steps = steps
+        self.tree = tree
+        self.qep = qep
+        self._net_costs = None
+
+    def __len__(self):
+        return len(self.steps)
+
+    def net_costs(self) -> List[float]:
+        """Each node's own cost per execution, by node id (see costs.py)."""
+        if self._net_costs is None:
+            tree = self.tree if self.tree is not None else build_tree_from_json(self.qep)
+            self._net_costs = exclusive_costs(tree)
+        return self._net_costs
+
+
+def text_plan(node: ExecutionTreeNode) -> dict:
+    """Rebuild the JSON keys describe_steps needs from a text EXPLAIN node."""
+    node_type = node.operation.split(" on ")[0].split(" using ")[0]
+    plan = {"Total Cost": node.total_cost, "Startup Cost": node.startup_cost, "Plan Rows": node.rows}
+    if node_type.startswith("Parallel "):
+        node_type = node_type[len("Parallel "):]
+        plan["Parallel Aware"] = True
+    if node_type.endswith(" Backward"):
+        node_type = node_type[:-len(" Backward")]
+    for mode in ("Partial ", "Finalize "):
+        if node_type.startswith(mode):
+            node_type = node_type[len(mode):]
+            plan["Partial Mode"] = mode.strip()
+    join = TEXT_JOIN_RE.match(node_type)
+    if join:
+        node_type = TEXT_JOIN_TYPES[join.group(1) or join.group(3)]
+        plan["Join Type"] = join.group(2) or join.group(4) or "Inner"
+    elif node_type in TEXT_AGGREGATES:
+        plan["Strategy"] = TEXT_AGGREGATES[node_type]
+        node_type = "Aggregate"
+    plan["Node Type"] = node_type
+    if node.relation:
+        plan["Relation Name"] = node.relation
+    if node.workers_planned is not None:
+        plan["Workers Planned"] = node.workers_planned
+    if node.workers_launched is not None:
+        plan["Workers Launched"] = node.workers_launched
+    for condition in node.condition:
+        key, _, value = condition.partition(":")
+        value = value.strip()
+        plan[key.strip()] = [value] if key.strip() in LIST_KEYS else value
+    if node.analyzed:
+        plan["Actual Rows"] = node.actual_rows
+        plan["Actual Loops"] = node.actual_loops
+        if node.actual_total_time is not None:
+            plan["Actual Total Time"] = node.actual_total_time
+    return plan
+
+
+def describe_workers(plan: dict) -> str:
+    # "(2 workers planned, 2 launched)"; launched is only known after ANALYZE
+    planned = plan.get("Workers Planned")
+    if planned is None:
+        return ""
+    launched = plan.get("Workers Launched")
+    return f" ({planned} workers planned" + (f", {launched} launched)" if launched is not None else ")")
+
+
+def describe_steps(plan: dict) -> List[tuple]:
+    """(kind, text) of the steps one plan node becomes, in print order."""
     node_type = plan.get("Node Type", "UNKNOWN").upper()
-    cost = plan.get("Total Cost", 0)
-    cost_info = f"  -- Cost: {cost}" if show_cost else ""
+    # Parallel-aware nodes split their work between the Gather's processes
+    parallel = " /* parallel */" if plan.get("Parallel Aware") else ""
 
     # Scans
-    if node_type in {"SEQ SCAN", "INDEX SCAN", "INDEX ONLY SCAN"}:
+    if node_type in SCAN_TYPES:
         rel = plan.get("Relation Name", "<unknown_table>")
         filt = plan.get("Filter")
-        return f"FROM {rel}" + (f" WHERE {filt}" if filt else "") + cost_info
+        return [("scan", f"FROM {rel}" + (f" WHERE {filt}" if filt else "") + parallel)]
 
     # Joins
-    elif "JOIN" in node_type or node_type == "NESTED LOOP":
+    if "JOIN" in node_type or node_type == "NESTED LOOP":
         join_type = plan.get("Join Type", "INNER").upper()
         if join_type == "LEFT":
             join_type = "LEFT OUTER"
         elif join_type == "RIGHT":
             join_type = "RIGHT OUTER"
         cond = plan.get("Hash Cond") or plan.get("Merge Cond") or plan.get("Join Filter") or "<missing join condition>"
-        return f"|> {join_type} JOIN ON {cond}{cost_info}"
+        step = ("join", f"|> {join_type} JOIN ON {cond}{parallel}")
 
     # Aggregates
     elif node_type == "AGGREGATE":
         keys = plan.get("Group Key", [])
         key_str = ", ".join(keys) if keys else "<no group keys>"
         strategy = plan.get("Strategy", "")
-        return f"|> AGGREGATE ({strategy}) GROUP BY {key_str}{cost_info}"
+        # Partial aggregates run in each worker, the Finalize above the Gather combines them
+        if plan.get("Partial Mode") in ("Partial", "Finalize"):
+            strategy += f", {plan['Partial Mode'].lower()}"
+        step = ("aggregate", f"|> AGGREGATE ({strategy}) GROUP BY {key_str}")
 
     # Sorting
     elif node_type == "SORT":
         sort_keys = plan.get("Sort Key", [])
         key_str = ", ".join(sort_keys) if sort_keys else "<unknown>"
-        return f"|> ORDER BY {key_str}{cost_info}"
+        step = ("order", f"|> ORDER BY {key_str}")
 
     # Limiting
     elif node_type == "LIMIT":
-        return f"|> LIMIT{cost_info}"
+        step = ("limit", "|> LIMIT")
 
-    # Materialize, Hash, Unique, Gather
+    # Materialize, Hash, Unique
     elif node_type in {"HASH", "MATERIALIZE", "UNIQUE", "CTE SCAN"}:
-        return f"|> {node_type}{cost_info}"
+        step = (node_type.lower() if node_type != "CTE SCAN" else "other", f"|> {node_type}{parallel}")
 
-    elif node_type == "GATHER MERGE":
-        return f"|> GATHER MERGE{cost_info}"
+    # Gather, Gather Merge: where the workers' rows come back together
+    elif node_type in {"GATHER", "GATHER MERGE"}:
+        step = ("gather", f"|> {node_type}{describe_workers(plan)}")
 
     # Default fallback
-    return f"|> {node_type}{cost_info}"
+    else:
+        step = ("other", f"|> {node_type}{parallel}")
+
+    # A filter on anything but a scan (e.g. HAVING) runs on the step's output
+    if plan.get("Filter"):
+        return [step, ("filter", f"|> WHERE {plan['Filter']}")]
+    return [step]
+
+
+def describe_node(plan, show_cost=True):
+    # The node's main step as one line, as generate_pipe_syntax prints it
+    kind, text = describe_steps(plan)[0]
+    if not show_cost:
+        return text
+    return text + PipeStep(kind, text, 0, plan).cost_comment()
+
+
+@timed("pipe_syntax")
+def build_pipeline(source: Union[dict, ExecutionTree]) -> Pipeline:
+    """Build the pipe-syntax IR in one iterative pass over the plan.
+
+    Args:
+        source: A JSON plan ({"Plan": {...}}) or an ExecutionTree. Trees
+            parsed from text EXPLAIN work too; their steps keep the node.
+
+    Returns:
+        Pipeline: The first scan leads, every other step follows in the
+            order it runs (bottom-up)
+    """
+    from_tree = isinstance(source, ExecutionTree)
+    tree = source if from_tree else None
+    qep = getattr(source, "qep", None) if from_tree else source
+    steps: List[PipeStep] = []
+    first_from = None
+    stack = [source.root if from_tree else source["Plan"]]
+    node_id = 0
+    while stack:
+        item = stack.pop()
+        if from_tree:
+            node = item
+            plan = node.plan if node.plan is not None else text_plan(node)
+            children = node.children
+        else:
+            node, plan = None, item
+            children = plan.get("Plans", ())
+        described = describe_steps(plan)
+        # Steps are reversed below, so a node's trailing steps go first here
+        for kind, text in reversed(described):
+            step = PipeStep(kind, text, node_id, plan, node)
+            if kind == "scan" and first_from is None:
+                first_from = step
+            else:
+                steps.append(step)
+        node_id += 1
+        stack.extend(reversed(children))
+    steps.reverse()
+    if first_from is not None:
+        steps.insert(0, first_from)
+    return Pipeline(steps, tree, qep)
+
+
+def render_text(pipeline: Pipeline, show_cost: bool = True) -> str:
+    if not show_cost:
+        return "\n".join(step.text for step in pipeline.steps)
+    return "\n".join(
+        step.text if step.kind == "filter" else step.text + step.cost_comment()
+        for step in pipeline.steps
+    )
+
+
+def render_json(pipeline: Pipeline) -> List[dict]:
+    return [step.to_json() for step in pipeline.steps]
+
+
+@timed("render_pipe_syntax")
+def render_html(pipeline: Pipeline, show_cost: bool = True) -> str:
+    """Pipe syntax as HTML, each step over a bar sized by its own cost."""
+    net_costs = pipeline.net_costs()
+    peak = max((net_costs[step.node_id] for step in pipeline.steps), default=0.0) or 1.0
+    rows = []
+    for step in pipeline.steps:
+        text = html.escape(step.text)
+        if step.kind == "filter":
+            rows.append(f"<div style='padding:1px 4px;'>{text}</div>")
+            continue
+        net = net_costs[step.node_id]
+        comment = html.escape(step.cost_comment()) if show_cost else ""
+        rows.append(
+            "<div style='position:relative; padding:1px 4px;'>"
+            f"<div style='position:absolute; left:0; top:0; bottom:0; width:{100 * net / peak:.1f}%;"
+            " background:#dde3f7; border-radius:3px;'></div>"
+            f"<span style='position:relative;' title='Own cost {net:.2f}'>{text}"
+            f"<span style='color:#777;'>{comment}</span></span></div>"
+        )
+    return ("<div style='font-family:monospace; white-space:pre; background:#f9f9f9; color:#222;"
+            " padding:15px; border-radius:8px;'>" + "".join(rows) + "</div>")
+
+
+def generate_pipe_syntax(qep, show_cost=True):
+    return render_text(build_pipeline(qep), show_cost=show_cost)
+
 
+def describe_actuals(plan):
+    # Only EXPLAIN ANALYZE plans have actuals to compare with the estimate
+    if "Actual Loops" not in plan:
+        return ""
+    text = f", actual rows={plan['Actual Rows']} loops={plan['Actual Loops']}"
+    if "Actual Total Time" in plan:
+        text += f" time={plan['Actual Total Time']}ms"
+    factor = estimate_error(plan.get("Plan Rows", 0), plan["Actual Rows"])
+    if factor >= MISESTIMATE_FACTOR:
+        direction = estimate_direction(plan.get("Plan Rows", 0), plan["Actual Rows"])
+        text += f" (rows {direction}estimated x{factor:.1f})"
+    return text
@@ -0,0 +1,370 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from typing import List, Optional
+
+from dbsession import DBSession
+from instrument import count, timed
+from pipesyntax import Pipeline, build_pipeline, render_text
+from preprocessing import ExecutionTree, build_tree_from_json, get_plan
+
+
+# Settings that change which plan PostgreSQL picks; they are part of the key
+PLANNER_SETTINGS = (
+    "server_version_num", "search_path", "work_mem", "hash_mem_multiplier",
+    "random_page_cost", "seq_page_cost", "cpu_tuple_cost", "cpu_index_tuple_cost",
+    "cpu_operator_cost", "effective_cache_size", "default_statistics_target",
+    "max_parallel_workers_per_gather", "parallel_setup_cost", "parallel_tuple_cost",
+    "join_collapse_limit", "from_collapse_limit", "jit", "plan_cache_mode",
+    "enable_bitmapscan", "enable_hashagg", "enable_hashjoin", "enable_indexscan",
+    "enable_indexonlyscan", "enable_material", "enable_mergejoin", "enable_nestloop",
+    "enable_parallel_hash", "enable_partitionwise_join", "enable_seqscan",
+    "enable_sort", "enable_incremental_sort",
+)
+
+# The MySQL equivalents; the current schema plays the part of search_path
+MYSQL_PLANNER_SETTINGS = (
+    "version", "optimizer_switch", "optimizer_search_depth", "optimizer_prune_level",
+    "eq_range_index_dive_limit", "range_optimizer_max_mem_size", "join_buffer_size",
+    "sort_buffer_size", "max_seeks_for_key",
+)
+
+# One round trip for every table a plan reads. The planner scales reltuples
+# by the table's current size, so the live page count is compared as well.
+# Plans name relations without their schema, so only the tables the
+# session's search_path resolves the names to are read.
+STATS_QUERY = """
+SELECT c.relname, c.reltuples, c.relpages,
+       pg_relation_size(c.oid) / current_setting('block_size')::int,
+       coalesce(s.analyze_count, 0) + coalesce(s.autoanalyze_count, 0)
+FROM unnest(%s::text[]) AS r(name)
+JOIN pg_class c ON c.oid = to_regclass(quote_ident(r.name))
+LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+WHERE c.relkind IN ('r', 'm', 'p')
+ORDER BY c.oid
+"""
+
+# information_schema.TABLES has the optimizer's row estimate and the live size
+MYSQL_STATS_QUERY = """
+SELECT table_name, coalesce(table_rows, 0), coalesce(data_length, 0),
+       coalesce(index_length, 0), 0
+FROM information_schema.tables
+WHERE table_schema = DATABASE() AND table_name IN ({})
+ORDER BY table_name
+"""
+
+_TOKEN_RE = re.compile(
+    r"'(?:[^']|'')*'"        # string literal
+    r'|"(?:[^"]|"")*"'       # quoted identifier
+    r"|--[^\n]*"             # line comment
+    r"|/\*.*?\*/"            # block comment
+    r"|\s+"
+    r"|[^'\";\s/-]+|.",
+    re.S,
+)
+
+# Numbers standing alone, not digits inside identifiers like t1
+_NUMBER_RE = re.compile(r"(?<![\w$.])\d+(?:\.\d*)?(?:e[+-]?\d+)?(?![\w.])")
+
+
+def normalize_sql(sql: str, keep_literals: bool = True) -> str:
+    """Normalize a query so formatting differences share a cache entry.
+
+    Comments are dropped, whitespace is collapsed and everything outside
+    quotes is lowercased. Literals are kept by default, since they change
+    the plan; without `keep_literals` they become "?", so a query matches
+    every run of it (as pg_stat_statements groups them).
+    """
+    parts = []
+    for token in _TOKEN_RE.findall(sql):
+        if token.startswith(("--", "/*")) or token.isspace():
+            if parts and parts[-1] != " ":
+                parts.append(" ")
+        elif token[0] == "'":
+            parts.append(token if keep_literals else "?")
+        elif token[0] == '"':
+            parts.append(token)
+        elif keep_literals:
+            parts.append(token.lower())
+        else:
+            parts.append(_NUMBER_RE.sub("?", token.lower()))
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def query_fingerprint(sql: str, keep_literals: bool = True) -> str:
+    """Short hash of a query, equal for queries that normalize the same."""
+    return hashlib.sha1(normalize_sql(sql, keep_literals).encode("utf-8")).hexdigest()[:16]
+
+
+def fetch_planner_settings(session) -> tuple:
+    """The session's PLANNER_SETTINGS (MYSQL_PLANNER_SETTINGS) as (name, value) pairs."""
+    with session.cursor() as cur:
+        if session.dbms == "mysql":
+            names = MYSQL_PLANNER_SETTINGS
+            cur.execute("SELECT DATABASE(), " + ", ".join(f"@@{name}" for name in names))
+            values = cur.fetchone()
+            return tuple(zip(("database",) + names, (str(value) for value in values)))
+        cur.execute(
+            "SELECT name, setting FROM pg_settings WHERE name = ANY(%s) ORDER BY name",
+            (list(PLANNER_SETTINGS),),
+        )
+        return tuple(cur.fetchall())
+
+
+def split_statements(text: str) -> List[str]:
+    """Split a SQL script on semicolons that are not inside quotes or comments."""
+    statements, current = [], []
+    for token in _TOKEN_RE.findall(text):
+        if token == ";":
+            statement = "".join(current).strip()
+            if statement:
+                statements.append(statement)
+            current = []
+        else:
+            current.append(token)
+    statement = "".join(current).strip()
+    if statement:
+        statements.append(statement)
+    # Drop pieces that were only comments
+    return [s for s in statements if normalize_sql(s)]
+
+
+def plan_relations(qep: dict) -> List[str]:
+    relations = set()
+    stack = [qep["Plan"]]
+    while stack:
+        plan = stack.pop()
+        if "Relation Name" in plan:
+            relations.add(plan["Relation Name"])
+        stack.extend(plan.get("Plans", []))
+    return sorted(relations)
+
+
+class CachedPlan:
+    """Everything derived from one plan, so a cache hit skips all of it.
+
+    The tree and the pipeline are shared by every caller of the cache and
+    only ever read; callers get a view of the tree (see copy).
+    """
+
+    def __init__(
+        self,
+        qep: dict,
+        tree: ExecutionTree,
+        pipe_with_cost: str,
+        pipe_without_cost: str,
+        relations: List[str],
+        stats: list,
+        pipeline: Optional[Pipeline] = None,
+    ):
+        self.qep = qep
+        self.tree = tree
+        self.pipe_with_cost = pipe_with_cost
+        self.pipe_without_cost = pipe_without_cost
+        self.relations = relations
+        self.stats = stats
+        self.pipeline = pipeline if pipeline is not None else build_pipeline(tree)
+
+    @classmethod
+    def from_qep(cls, qep: dict, stats: list = None) -> "CachedPlan":
+        tree = build_tree_from_json(qep)
+        # One pass over the plan, rendered both ways
+        pipeline = build_pipeline(tree)
+        return cls(
+            qep,
+            tree,
+            render_text(pipeline, show_cost=True),
+            render_text(pipeline, show_cost=False),
+            plan_relations(qep),
+            stats or [],
+            pipeline,
+        )
+
+    def copy(self) -> "CachedPlan":
+        """The entry for one caller: a view of the tree, everything else shared.
+
+        Callers set per-run attributes (qep, settings) on the tree they get,
+        from several threads at once, so they never get the one kept here.
+        """
+        return CachedPlan(
+            self.qep,
+            self.tree.view(),
+            self.pipe_with_cost,
+            self.pipe_without_cost,
+            self.relations,
+            self.stats,
+            self.pipeline,
+        )
+
+    def to_json(self) -> dict:
+        # The tree is rebuilt from the plan on load, it is cheap next to planning
+        return {
+            "qep": self.qep,
+            "pipe_with_cost": self.pipe_with_cost,
+            "pipe_without_cost": self.pipe_without_cost,
+            "relations": self.relations,
+            "stats": self.stats,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "CachedPlan":
+        return cls(
+            data["qep"],
+            build_tree_from_json(data["qep"]),
+            data["pipe_with_cost"],
+            data["pipe_without_cost"],
+            data["relations"],
+            data["stats"],
+        )
+
+
+class PlanCache:
+    """LRU cache of explained plans with an optional on-disk tier.
+
+    Entries are keyed by the normalized query and the session's planner
+    settings. Before an entry is served, the statistics of the tables it
+    reads are re-checked with one catalog query; if an ANALYZE or table
+    growth changed them, the query is planned again.
+
+    Args:
+        max_entries (int): Plans kept in memory before the least recently
+            used one is evicted
+        disk_dir (str): Directory for the persistent tier, None to disable
+    """
+
+    def __init__(self, max_entries: int = 256, disk_dir: Optional[str] = None):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+        self._entries: "OrderedDict[str, CachedPlan]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._settings = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def planner_settings(self, session) -> tuple:
+        # Fetched once per session; pooled sessions only ever use SET LOCAL
+        settings = self._settings.get(session)
+        if settings is None:
+            if isinstance(session, DBSession):
+                settings = fetch_planner_settings(session)
+            else:
+                # A plan source (plansource.py) answers for itself
+                settings = session.planner_settings()
+            self._settings[session] = settings
+        return settings
+
+    def make_key(self, sql: str, session) -> str:
+        payload = json.dumps([normalize_sql(sql), self.planner_settings(session)])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    @timed("table_stats")
+    def table_stats(session, relations: List[str]) -> list:
+        if not relations:
+            return []
+        if not isinstance(session, DBSession):
+            return session.table_stats(relations)
+        with session.cursor() as cur:
+            if session.dbms == "mysql":
+                # The connector has no array parameters
+                cur.execute(MYSQL_STATS_QUERY.format(", ".join(["%s"] * len(relations))), tuple(relations))
+            else:
+                cur.execute(STATS_QUERY, (list(relations),))
+            # Lists rather than tuples so entries compare equal after a JSON round trip
+            return [[name, float(tuples), int(pages), int(size), int(analyzed)]
+                    for name, tuples, pages, size, analyzed in cur.fetchall()]
+
+    def get(self, key: str) -> Optional[CachedPlan]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        entry = self._load(key)
+        if entry is not None:
+            self.put(key, entry, persist=False)
+        return entry
+
+    def put(self, key: str, entry: CachedPlan, persist: bool = True):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if persist:
+            self._store(key, entry)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+        path = self._path(key)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def explain(self, sql: str, session, timeout: Optional[float] = None) -> CachedPlan:
+        """Return the cached plan for `sql`, planning it on a miss.
+
+        Every call gets its own copy of the tree (see CachedPlan.copy).
+        """
+        key = self.make_key(sql, session)
+        entry = self.get(key)
+        if entry is not None:
+            if self.table_stats(session, entry.relations) == entry.stats:
+                with self._lock:
+                    self.hits += 1
+                count("plan_cache.hits")
+                return entry.copy()
+            with self._lock:
+                self.invalidations += 1
+            count("plan_cache.invalidations")
+            self.invalidate(key)
+
+        with self._lock:
+            self.misses += 1
+        count("plan_cache.misses")
+        qep = get_plan(sql, session=session, timeout=timeout)
+        entry = CachedPlan.from_qep(qep)
+        entry.stats = self.table_stats(session, entry.relations)
+        self.put(key, entry)
+        return entry.copy()
+
+    def _path(self, key: str) -> Optional[str]:
+        if not self.disk_dir:
+            return None
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _load(self, key: str) -> Optional[CachedPlan]:
+        path = self._path(key)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return CachedPlan.from_json(json.load(f))
+        except (OSError, ValueError, KeyError):
+            # A truncated or stale-format file is just a miss
+            return None
+
+    def _store(self, key: str, entry: CachedPlan):
+        path = self._path(key)
+        if not path:
+            return
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry.to_json(), f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,449 @@
+import argparse
+import difflib
+import html
+import json
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from costs import exclusive_costs
+from mysqlplan import mysql_json_plan, mysql_tree_plan
+from pipesyntax import describe_node
+from preprocessing import (
+    ExecutionTree, ExecutionTreeNode, Visualizer, build_tree_from_json, parse_explain_file,
+)
+
+
+SAME = "same"
+CHANGED = "changed"
+INSERTED = "inserted"
+REMOVED = "removed"
+
+STATUS_COLORS = {
+    SAME: "#6175c1",
+    CHANGED: "#e69f00",
+    INSERTED: "#2ca02c",
+    REMOVED: "#d62728",
+}
+
+# Markers in the annotated pipe syntax, like a unified diff
+STATUS_MARKERS = {SAME: " ", CHANGED: "~", INSERTED: "+", REMOVED: "-"}
+
+
+def node_label(node: ExecutionTreeNode) -> tuple:
+    # What has to be equal for two nodes to be the same operator
+    return (node.operation, node.relation, tuple(node.condition))
+
+
+def node_kind(node: ExecutionTreeNode) -> tuple:
+    # Looser match: same operator on the same relation, conditions may differ
+    return (node.operation.split(" on ")[0].split(" using ")[0], node.relation)
+
+
+def node_relation(node: ExecutionTreeNode) -> Optional[tuple]:
+    # Loosest match: any scan of the same relation, e.g. Seq Scan -> Index Scan
+    return (node.relation,) if node.relation else None
+
+
+def _subtree_hashes(nodes: List[ExecutionTreeNode]) -> List[int]:
+    # nodes in pre-order with node.id == index; children come after parents
+    hashes = [0] * len(nodes)
+    for node in reversed(nodes):
+        hashes[node.id] = hash((node_label(node), tuple(hashes[c.id] for c in node.children)))
+    return hashes
+
+
+class PlanDiff:
+    """Node-by-node comparison of two plans of the same query.
+
+    Subtrees are matched top-down: children of matched nodes are aligned on
+    their subtree hashes, so identical subtrees pair up in one step, and the
+    rest pair up by operation, relation and condition (or, failing that, by
+    operation and relation alone). Unmatched subtrees that reappear elsewhere
+    in the other plan, e.g. after a join order change, are paired as moved.
+
+    Matched nodes are "same" or "changed" (label, cost or row estimate
+    differs); the rest are "removed" from `before` or "inserted" in `after`.
+
+    Args:
+        before (ExecutionTree): The old plan
+        after (ExecutionTree): The new plan
+    """
+
+    def __init__(self, before: ExecutionTree, after: ExecutionTree):
+        self.before = before
+        self.after = after
+        before.finalize_id()
+        after.finalize_id()
+        self.before_nodes = before.dfs()
+        self.after_nodes = after.dfs()
+        self.before_net_cost = exclusive_costs(before)
+        self.after_net_cost = exclusive_costs(after)
+        # Index of the matched node in the other tree, -1 if unmatched
+        self.before_match = [-1] * len(self.before_nodes)
+        self.after_match = [-1] * len(self.after_nodes)
+        self.moved = set()
+        self._match()
+        self.merged_nodes = self.merged()
+        self.entries = self._build_entries()
+
+    def _pair(self, a: ExecutionTreeNode, b: ExecutionTreeNode):
+        self.before_match[a.id] = b.id
+        self.after_match[b.id] = a.id
+
+    def _pair_identical(self, a: ExecutionTreeNode, b: ExecutionTreeNode, moved: bool = False):
+        # Equal subtree hashes: both subtrees have the same shape, walk them together
+        stack = [(a, b)]
+        while stack:
+            a, b = stack.pop()
+            self._pair(a, b)
+            if moved:
+                self.moved.add(b.id)
+            stack.extend(zip(a.children, b.children))
+
+    def _match(self):
+        before_hash = _subtree_hashes(self.before_nodes)
+        after_hash = _subtree_hashes(self.after_nodes)
+        # The roots both produce the query's result, so they always match
+        stack = [(self.before.root, self.after.root)]
+        while stack:
+            a, b = stack.pop()
+            if before_hash[a.id] == after_hash[b.id]:
+                self._pair_identical(a, b)
+                continue
+            self._pair(a, b)
+            matcher = difflib.SequenceMatcher(
+                None,
+                [before_hash[c.id] for c in a.children],
+                [after_hash[c.id] for c in b.children],
+                autojunk=False,
+            )
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                if tag == "equal":
+                    for x, y in zip(a.children[i1:i2], b.children[j1:j2]):
+                        self._pair_identical(x, y)
+                else:
+                    stack.extend(self._pair_children(a.children[i1:i2], b.children[j1:j2]))
+
+        # Whole subtrees that moved to another parent
+        unmatched: Dict[int, List[ExecutionTreeNode]] = {}
+        for node in reversed(self.after_nodes):
+            if self.after_match[node.id] == -1:
+                unmatched.setdefault(after_hash[node.id], []).append(node)
+        if not unmatched:
+            return
+        for node in self.before_nodes:
+            if self.before_match[node.id] != -1:
+                continue
+            candidates = unmatched.get(before_hash[node.id])
+            # Lists are in reverse pre-order, so pop() takes the first one left
+            while candidates and self.after_match[candidates[-1].id] != -1:
+                candidates.pop()
+            if candidates:
+                self._pair_identical(node, candidates.pop(), moved=True)
+
+    @staticmethod
+    def _pair_children(old: List[ExecutionTreeNode],
+                       new: List[ExecutionTreeNode]) -> List[Tuple[ExecutionTreeNode, ExecutionTreeNode]]:
+        # Children that differ somewhere below: pair equal labels first, then
+        # equal kinds, then scans of the same relation, each in order. A single
+        # operator replaced by another (Sort -> Incremental Sort) is the same
+        # step changed; scans of other tables are not. The rest stays unmatched.
+        pairs = []
+        for key in (node_label, node_kind, node_relation):
+            waiting: Dict[tuple, List[ExecutionTreeNode]] = {}
+            for a in reversed(old):
+                waiting.setdefault(key(a), []).append(a)
+            remaining = []
+            for b in new:
+                candidates = waiting.get(key(b))
+                if candidates and key(b) is not None:
+                    pairs.append((candidates.pop(), b))
+                else:
+                    remaining.append(b)
+            paired = {id(a) for a, _ in pairs}
+            old = [a for a in old if id(a) not in paired]
+            new = remaining
+        if len(old) == 1 and len(new) == 1 and not old[0].relation and not new[0].relation:
+            pairs.append((old[0], new[0]))
+        return pairs
+
+    def status(self, a: Optional[ExecutionTreeNode], b: Optional[ExecutionTreeNode]) -> str:
+        if a is None:
+            return INSERTED
+        if b is None:
+            return REMOVED
+        if (node_label(a) != node_label(b) or a.startup_cost != b.startup_cost
+                or a.total_cost != b.total_cost or a.rows != b.rows):
+            return CHANGED
+        return SAME
+
+    def merged(self) -> List[Tuple[int, Optional[ExecutionTreeNode], Optional[ExecutionTreeNode]]]:
+        """Both plans as one tree of (depth, before node, after node), pre-order.
+
+        The after plan gives the shape; removed nodes are slotted in next to
+        where they used to be.
+        """
+        result = []
+        stack = [(0, self.before.root, self.after.root)]
+        while stack:
+            depth, a, b = stack.pop()
+            result.append((depth, a, b))
+            children = []
+            old = [c for c in a.children if self.before_match[c.id] == -1] if a is not None else []
+            if b is not None:
+                for child in b.children:
+                    match = self.after_match[child.id]
+                    partner = self.before_nodes[match] if match != -1 else None
+                    if partner is not None and partner.parent is a:
+                        # Removed siblings that came before this one in the old plan
+                        while old and old[0].id < partner.id:
+                            children.append((depth + 1, old.pop(0), None))
+                    children.append((depth + 1, partner, child))
+            children.extend((depth + 1, c, None) for c in old)
+            stack.extend(reversed(children))
+        return result
+
+    def _build_entries(self) -> List[dict]:
+        entries = []
+        for depth, a, b in self.merged_nodes:
+            status = self.status(a, b)
+            node = b if b is not None else a
+            entry = {
+                "status": status,
+                "moved": b is not None and b.id in self.moved,
+                "depth": depth,
+                "before_id": a.id if a is not None else None,
+                "after_id": b.id if b is not None else None,
+                "operation": node.operation,
+                "previous_operation": None,
+                "condition": node.condition,
+                "before": None,
+                "after": None,
+            }
+            if a is not None and b is not None and node_label(a) != node_label(b):
+                entry["previous_operation"] = a.operation
+                entry["previous_condition"] = a.condition
+            for side, n, net_costs in (("before", a, self.before_net_cost),
+                                       ("after", b, self.after_net_cost)):
+                if n is not None:
+                    entry[side] = {
+                        "startup_cost": n.startup_cost,
+                        "total_cost": n.total_cost,
+                        "net_cost": round(net_costs[n.id], 2),
+                        "rows": n.rows,
+                    }
+            if a is not None and b is not None:
+                for field in ("startup_cost", "total_cost", "net_cost", "rows"):
+                    entry[f"{field}_delta"] = round(entry["after"][field] - entry["before"][field], 2)
+            entries.append(entry)
+        return entries
+
+    def summary(self) -> dict:
+        counts = {status: 0 for status in STATUS_COLORS}
+        for entry in self.entries:
+            counts[entry["status"]] += 1
+        before_cost = self.before.root.total_cost
+        after_cost = self.after.root.total_cost
+        return {
+            "counts": counts,
+            "moved": len(self.moved),
+            "before_total_cost": before_cost,
+            "after_total_cost": after_cost,
+            "total_cost_delta": round(after_cost - before_cost, 2),
+            "total_cost_ratio": round(after_cost / before_cost, 4) if before_cost else None,
+        }
+
+    def to_json(self) -> dict:
+        return {"summary": self.summary(), "nodes": self.entries}
+
+    def colors(self, side: str) -> List[str]:
+        """Marker color per node id of the "before" or "after" tree."""
+        nodes = self.before_nodes if side == "before" else self.after_nodes
+        colors = [STATUS_COLORS[REMOVED if side == "before" else INSERTED]] * len(nodes)
+        for entry in self.entries:
+            if entry[f"{side}_id"] is not None:
+                colors[entry[f"{side}_id"]] = STATUS_COLORS[entry["status"]]
+        return colors
+
+    def hover_notes(self, side: str) -> List[Optional[str]]:
+        nodes = self.before_nodes if side == "before" else self.after_nodes
+        notes: List[Optional[str]] = [None] * len(nodes)
+        for entry in self.entries:
+            if entry[f"{side}_id"] is not None:
+                notes[entry[f"{side}_id"]] = describe_change(entry, html_breaks=True)
+        return notes
+
+
+def format_delta(before: float, after: float) -> str:
+    text = f"{before:g} -> {after:g}"
+    if before:
+        text += f" ({(after - before) / before:+.1%})"
+    return text
+
+
+def describe_change(entry: dict, html_breaks: bool = False) -> str:
+    """One line (or hover block) saying how a node changed."""
+    parts = [entry["status"] + (" (moved)" if entry["moved"] else "")]
+    if entry["previous_operation"] is not None:
+        parts.append(f"was {entry['previous_operation']}")
+    if entry["before"] is not None and entry["after"] is not None:
+        for field, name in (("total_cost", "cost"), ("net_cost", "net cost"),
+                            ("startup_cost", "startup"), ("rows", "rows")):
+            before, after = entry["before"][field], entry["after"][field]
+            if before != after:
+                parts.append(f"{name} {format_delta(before, after)}")
+    if html_breaks:
+        return "<b>Diff</b>: " + "<br>".join(html.escape(part) for part in parts)
+    return ", ".join(parts)
+
+
+def diff_plans(before: ExecutionTree, after: ExecutionTree) -> PlanDiff:
+    return PlanDiff(before, after)
+
+
+def diff_figure(diff: PlanDiff, side_by_side: bool = True, visualizer: Optional[Visualizer] = None):
+    """Draw the diff with the Visualizer, colored by status.
+
+    Side by side draws the old plan left of the new one; otherwise only the
+    new plan is drawn, with the old values in its hover text.
+    """
+    import plotly.graph_objs as go
+
+    viz = visualizer or Visualizer()
+    fig = go.Figure()
+    height = 0.0
+    x_offset = 0.0
+    if side_by_side:
+        width, height = viz.add_tree_traces(
+            fig, diff.before, diff.colors("before"), diff.hover_notes("before")
+        )
+        fig.add_annotation(x=0, y=height + 0.6, text="<b>Before</b>", showarrow=False, xanchor="left")
+        x_offset = width + 2
+    _, after_height = viz.add_tree_traces(
+        fig, diff.after, diff.colors("after"), diff.hover_notes("after"), x_offset=x_offset
+    )
+    if side_by_side:
+        fig.add_annotation(x=x_offset, y=after_height + 0.6, text="<b>After</b>",
+                           showarrow=False, xanchor="left")
+    height = max(height, after_height)
+    large = viz.is_large(diff.before_nodes) or viz.is_large(diff.after_nodes)
+    viz.style_figure(fig, height + 2, large)
+    return fig
+
+
+def annotated_pipe_syntax(diff: PlanDiff, show_cost: bool = True) -> str:
+    """Pipe syntax of the merged plan, each step marked like a unified diff.
+
+    " " unchanged, "~" changed, "+" only in the new plan, "-" only in the old
+    one. Changed steps get a comment with the cost and row deltas.
+    """
+    entries = []
+    for entry, (_, a, b) in zip(diff.entries, diff.merged_nodes):
+        node = b if b is not None else a
+        if node.plan is not None:
+            line = describe_node(node.plan, show_cost=show_cost)
+        else:
+            # Trees parsed from text EXPLAIN have no plan dict
+            line = f"|> {node.operation}"
+            if show_cost:
+                line += f"  -- Cost: {node.total_cost}"
+        if entry["status"] != SAME or entry["moved"]:
+            line += f"  -- {describe_change(entry)}"
+        entries.append(f"{STATUS_MARKERS[entry['status']]} {line}")
+
+    # Same ordering as generate_pipe_syntax: the first FROM leads, the rest
+    # runs bottom-up
+    first_from = next((i for i, line in enumerate(entries) if line[2:].startswith("FROM")), None)
+    steps = [line for i, line in enumerate(entries) if i != first_from]
+    steps.reverse()
+    if first_from is not None:
+        steps.insert(0, entries[first_from])
+    return "\n".join(steps)
+
+
+def build_diff_html(diff: PlanDiff, side_by_side: bool = True, offline: bool = False,
+                    plotlyjs_url: Optional[str] = None) -> str:
+    viz = Visualizer()
+    fig = diff_figure(diff, side_by_side=side_by_side, visualizer=viz)
+    fig.update_layout(template="plotly_white", paper_bgcolor="white", plot_bgcolor="white")
+    fig_html = viz.to_html(fig, offline=offline, plotlyjs_url=plotlyjs_url)
+    summary = diff.summary()
+    counts = summary["counts"]
+    legend = " ".join(
+        f"<span style='color:{color}'>&#9679;</span> {status} ({counts[status]})"
+        for status, color in STATUS_COLORS.items()
+    )
+    rows = "".join(
+        f"<tr><td style='color:{STATUS_COLORS[entry['status']]}'>{entry['status']}</td>"
+        f"<td>{html.escape(entry['operation'])}</td>"
+        f"<td>{html.escape(describe_change(entry))}</td></tr>"
+        for entry in diff.entries
+        if entry["status"] != SAME or entry["moved"]
+    )
+    ratio = summary["total_cost_ratio"]
+    return f"""
+    <html>
+    <head><meta charset='utf-8'><title>QEP Diff</title></head>
+    <body style='font-family:Segoe UI, sans-serif; background:white; color:black; padding:20px;'>
+        <h2>QEP Diff</h2>
+        <p><b>Total Cost:</b> {format_delta(summary['before_total_cost'], summary['after_total_cost'])}
+        {f"(x{ratio})" if ratio is not None else ""}<br>
+        {legend}, moved subtrees: {summary['moved']}</p>
+        {fig_html}
+        <h2 style="margin-top:40px;">Annotated Pipe-Syntax SQL</h2>
+        <pre style='background:#f9f9f9;color:#222;padding:15px;border-radius:8px;'>{html.escape(annotated_pipe_syntax(diff))}</pre>
+        <h2 style="margin-top:40px;">Changed Nodes</h2>
+        <table cellpadding='4' style='border-collapse:collapse; text-align:left;'>
+        <tr><th>Status</th><th>Operation</th><th>Change</th></tr>{rows}</table>
+    </body>
+    </html>
+    """
+
+
+def load_plan_file(path: str) -> ExecutionTree:
+    """Tree from a saved `EXPLAIN (FORMAT JSON)` result or a text EXPLAIN,
+    from PostgreSQL or MySQL (FORMAT=JSON or FORMAT=TREE)."""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if text.lstrip()[:1] in ("[", "{"):
+        qep = json.loads(text)
+        if isinstance(qep, list):
+            qep = qep[0]
+        if "query_block" in qep:
+            qep = mysql_json_plan(qep)
+        return build_tree_from_json(qep)
+    if text.lstrip().startswith("->"):
+        return build_tree_from_json(mysql_tree_plan(text))
+    return parse_explain_file(path)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Compare two saved EXPLAIN plans node by node")
+    parser.add_argument("before", help="Old plan, JSON or text EXPLAIN output")
+    parser.add_argument("after", help="New plan, JSON or text EXPLAIN output")
+    parser.add_argument("--html", default=None, help="Write an HTML report here")
+    parser.add_argument("--overlay", action="store_true",
+                        help="Draw only the new plan, colored by change, instead of side by side")
+    parser.add_argument("--offline", action="store_true", help="Inline plotly.js in the HTML report")
+    parser.add_argument("--json", action="store_true", help="Print the diff as JSON instead of pipe syntax")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    diff = diff_plans(load_plan_file(args.before), load_plan_file(args.after))
+    if args.json:
+        print(json.dumps(diff.to_json(), indent=2))
+    else:
+        print(annotated_pipe_syntax(diff))
+    if args.html:
+        with open(args.html, "w", encoding="utf-8") as f:
+            f.write(build_diff_html(diff, side_by_side=not args.overlay, offline=args.offline))
+    summary = diff.summary()
+    print(f"Total cost {format_delta(summary['before_total_cost'], summary['after_total_cost'])}, "
+          + ", ".join(f"{n} {status}" for status, n in summary["counts"].items()), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,353 @@
+import abc
+import argparse
+import glob
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import sys
+import threading
+import time
+import zlib
+from typing import Iterator, List, Optional
+
+from dbsession import DBSession, normalize_dbms
+from plancache import PlanCache, fetch_planner_settings, normalize_sql
+from preprocessing import get_qep, get_qep_mysql
+
+
+# Each writer appends to its own pair of files, so worker processes can
+# record into one archive without locking each other out
+DATA_SUFFIX = ".plans"
+INDEX_SUFFIX = ".index"
+
+_segment_ids = itertools.count()
+_segment_lock = threading.Lock()
+_last_segment_us = 0
+
+
+class PlanNotRecorded(LookupError):
+    pass
+
+
+def segment_name() -> str:
+    """A new segment's file name, which sorts in creation order.
+
+    Microseconds of wall-clock time, never repeating or going back within
+    the process, then the pid and a zero-padded counter to break ties.
+    """
+    global _last_segment_us
+    with _segment_lock:
+        stamp = max(time.time_ns() // 1000, _last_segment_us + 1)
+        _last_segment_us = stamp
+        seconds, micros = divmod(stamp, 1_000_000)
+        return (f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime(seconds))}.{micros:06d}"
+                f"-{os.getpid():010d}-{next(_segment_ids):06d}")
+
+
+def record_key(kind: str, dbms: str, *parts) -> str:
+    payload = json.dumps([kind, dbms, *parts], sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:24]
+
+
+def explain_key(dbms: str, sql: str, as_json: bool = True, analyze: bool = False,
+                settings: Optional[dict] = None, tree: bool = False, **ignored) -> str:
+    """Archive key of one EXPLAIN.
+
+    Queries that normalize the same (see normalize_sql) share a key.
+    BUFFERS and TIMING don't tell plans apart: a replay serves whatever
+    was recorded for the query with or without ANALYZE.
+    """
+    settings = {name: str(value) for name, value in (settings or {}).items()}
+    return record_key("explain", dbms, normalize_sql(sql), bool(as_json), bool(tree), bool(analyze), settings)
+
+
+def stats_key(dbms: str, relations: List[str]) -> str:
+    return record_key("stats", dbms, sorted(relations))
+
+
+class ArchiveWriter:
+    """Appends records to a plan archive, a directory of segment files.
+
+    A segment is a data file of zlib-compressed JSON records, one after the
+    other, and an index file with one JSON line per record: its key, kind,
+    offset and length. Both are flushed after every record, so an archive
+    is readable while it is being written and survives a crash.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        name = segment_name()
+        self._data = open(os.path.join(path, name + DATA_SUFFIX), "ab")
+        self._index = open(os.path.join(path, name + INDEX_SUFFIX), "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self.written = 0
+
+    def append(self, key: str, kind: str, dbms: str, record: dict):
+        blob = zlib.compress(json.dumps(record, separators=(",", ":")).encode("utf-8"))
+        with self._lock:
+            offset = self._data.tell()
+            self._data.write(blob)
+            self._data.flush()
+            entry = {"key": key, "kind": kind, "dbms": dbms, "offset": offset, "length": len(blob)}
+            self._index.write(json.dumps(entry) + "\n")
+            self._index.flush()
+            self.written += 1
+
+    def close(self):
+        with self._lock:
+            self._data.close()
+            self._index.close()
+
+
+class PlanArchive:
+    """Read side of a plan archive.
+
+    The indexes of all segments are loaded up front; when a key was
+    recorded more than once, the newest segment wins. Records are read
+    out of memory-mapped segment files, only when asked for, and the
+    maps are shared by all threads.
+    """
+
+    def __init__(self, path: str):
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"No plan archive at {path}")
+        self.path = path
+        self._entries = {}
+        self._maps = {}
+        self._files = []
+        # Segment names sort in creation order (see segment_name)
+        for index_path in sorted(glob.glob(os.path.join(path, "*" + INDEX_SUFFIX))):
+            segment = index_path[:-len(INDEX_SUFFIX)]
+            with open(index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Half-written last line of a writer that died
+                        continue
+                    # Re-inserted at the end, so entries stay oldest first
+                    self._entries.pop(entry["key"], None)
+                    self._entries[entry["key"]] = (segment, entry)
+        for segment in {segment for segment, _ in self._entries.values()}:
+            f = open(segment + DATA_SUFFIX, "rb")
+            self._files.append(f)
+            self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def _read(self, segment: str, entry: dict) -> dict:
+        start = entry["offset"]
+        blob = self._maps[segment][start:start + entry["length"]]
+        return json.loads(zlib.decompress(blob))
+
+    def get(self, key: str) -> Optional[dict]:
+        found = self._entries.get(key)
+        return None if found is None else self._read(*found)
+
+    def latest(self, kind: str, dbms: Optional[str] = None) -> Optional[dict]:
+        # Entries are in segment order, the newest last
+        for segment, entry in reversed(list(self._entries.values())):
+            if entry["kind"] == kind and (dbms is None or entry["dbms"] == dbms):
+                return self._read(segment, entry)
+        return None
+
+    def dbms(self) -> Optional[str]:
+        entries = list(self._entries.values())
+        return entries[-1][1]["dbms"] if entries else None
+
+    def records(self, kind: Optional[str] = None) -> Iterator[dict]:
+        for segment, entry in self._entries.values():
+            if kind is None or entry["kind"] == kind:
+                yield self._read(segment, entry)
+
+    def close(self):
+        for m in self._maps.values():
+            m.close()
+        for f in self._files:
+            f.close()
+        self._maps.clear()
+        self._files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PlanSource(abc.ABC):
+    """Where get_qep and get_qep_mysql get plans from, instead of a live session.
+
+    The live source is a DBSession itself. A RecordingPlanSource explains on
+    one and archives every plan; a ReplayPlanSource serves archived plans
+    without a database. Sources also answer for the planner settings and
+    table statistics the plan cache asks for.
+    """
+
+    dbms = "postgresql"
+
+    @abc.abstractmethod
+    def explain(self, sql: str, timeout: Optional[float] = None, **options):
+        """The plan get_qep (or get_qep_mysql) would return for `sql`."""
+
+    @abc.abstractmethod
+    def planner_settings(self) -> tuple:
+        """What fetch_planner_settings returns on a live session."""
+
+    @abc.abstractmethod
+    def table_stats(self, relations: List[str]) -> list:
+        """What PlanCache.table_stats returns on a live session."""
+
+    def cancel(self, thread_id: Optional[int] = None) -> int:
+        return 0
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RecordingPlanSource(PlanSource):
+    """Explains on a live session and writes every answer to an archive."""
+
+    def __init__(self, session: DBSession, path: str):
+        self.session = session
+        self.dbms = session.dbms
+        self.writer = ArchiveWriter(path)
+        self._settings = None
+
+    def explain(self, sql: str, timeout: Optional[float] = None, **options):
+        explain = get_qep_mysql if self.dbms == "mysql" else get_qep
+        qep = explain(sql, session=self.session, timeout=timeout, **options)
+        self.writer.append(explain_key(self.dbms, sql, **options), "explain", self.dbms,
+                           {"sql": sql, "options": options, "result": qep})
+        return qep
+
+    def planner_settings(self) -> tuple:
+        # Once per source, like the plan cache does per session
+        if self._settings is None:
+            self._settings = fetch_planner_settings(self.session)
+            self.writer.append(record_key("settings", self.dbms), "settings", self.dbms,
+                               {"result": self._settings})
+        return self._settings
+
+    def table_stats(self, relations: List[str]) -> list:
+        stats = PlanCache.table_stats(self.session, relations)
+        self.writer.append(stats_key(self.dbms, relations), "stats", self.dbms,
+                           {"relations": relations, "result": stats})
+        return stats
+
+    def cursor(self, *args, **kwargs):
+        # Statements other than EXPLAIN run live and aren't recorded
+        return self.session.cursor(*args, **kwargs)
+
+    def cancel(self, thread_id: Optional[int] = None) -> int:
+        return self.session.cancel(thread_id)
+
+    def close(self):
+        self.writer.close()
+        self.session.close()
+
+
+class ReplayPlanSource(PlanSource):
+    """Serves the plans in an archive; a query that wasn't recorded fails.
+
+    Args:
+        path (str): The archive directory
+        dbms (str): Whose plans to serve, default the archive's newest
+    """
+
+    def __init__(self, path: str, dbms: Optional[str] = None):
+        self.archive = PlanArchive(path)
+        self.dbms = normalize_dbms(dbms or self.archive.dbms() or "postgresql")
+
+    def explain(self, sql: str, timeout: Optional[float] = None, **options):
+        record = self.archive.get(explain_key(self.dbms, sql, **options))
+        if record is None:
+            analyze = " ANALYZE" if options.get("analyze") else ""
+            raise PlanNotRecorded(f"No EXPLAIN{analyze} of this query in {self.archive.path}")
+        return record["result"]
+
+    def planner_settings(self) -> tuple:
+        record = self.archive.latest("settings", self.dbms)
+        return tuple(tuple(pair) for pair in record["result"]) if record else ()
+
+    def table_stats(self, relations: List[str]) -> list:
+        record = self.archive.get(stats_key(self.dbms, relations))
+        return record["result"] if record else []
+
+    def cursor(self, *args, **kwargs):
+        raise PlanNotRecorded(f"Replaying {self.archive.path}: there is no database to run statements on")
+
+    def close(self):
+        self.archive.close()
+
+
+def open_plan_source(dbms: str, db_config: Optional[dict] = None, record: Optional[str] = None,
+                     replay: Optional[str] = None, **session_kwargs):
+    """A live DBSession, one recording into `record`, or a replay of `replay`."""
+    if replay:
+        return ReplayPlanSource(replay, dbms)
+    session = DBSession(dbms, db_config, **session_kwargs)
+    if record:
+        return RecordingPlanSource(session, record)
+    return session
+
+
+def import_plan(writer: ArchiveWriter, dbms: str, sql: str, qep, analyze: bool = False):
+    """Archive a plan explained elsewhere, as if recorded for `sql`."""
+    options = {"analyze": analyze} if dbms == "mysql" else {"as_json": isinstance(qep, dict), "analyze": analyze}
+    writer.append(explain_key(dbms, sql, **options), "explain", dbms,
+                  {"sql": sql, "options": options, "result": qep})
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="List a plan archive, or add saved plans to one")
+    parser.add_argument("archive", help="Archive directory")
+    parser.add_argument("--add", nargs=2, action="append", default=[], metavar=("SQL", "PLAN"),
+                        help="Archive PLAN (EXPLAIN FORMAT JSON output) as the plan of the query in SQL")
+    parser.add_argument("--dbms", default="postgresql", help="Whose plans --add adds")
+    parser.add_argument("--analyze", action="store_true", help="The added plans are EXPLAIN ANALYZE output")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.add:
+        dbms = normalize_dbms(args.dbms)
+        writer = ArchiveWriter(args.archive)
+        try:
+            for sql_path, plan_path in args.add:
+                with open(sql_path, "r", encoding="utf-8") as f:
+                    sql = f.read().strip()
+                with open(plan_path, "r", encoding="utf-8") as f:
+                    qep = json.load(f)
+                if isinstance(qep, list):
+                    # EXPLAIN's own output wraps the plan in a list
+                    qep = qep[0]
+                import_plan(writer, dbms, sql, qep, args.analyze)
+        finally:
+            writer.close()
+        print(f"Added {len(args.add)} plans to {args.archive}", file=sys.stderr)
+    with PlanArchive(args.archive) as archive:
+        for record in archive.records("explain"):
+            sql = " ".join(record["sql"].split())
+            analyze = "analyze " if record["options"].get("analyze") else ""
+            print(f"{analyze}{sql[:100]}")
+        print(f"{len(archive)} records in {args.archive}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,37 +1,132 @@
-import psycopg2
-import json
+from dbsession import DBSession
+from instrument import span, timed
+
 
+def _temporary_session(dbms, db_config):
+    # Callers without a session still get their connection closed afterwards
+    return DBSession(dbms, db_config, pool_size=1)
 
-def get_qep(sql_query, db_config, as_json=True):
-    conn = psycopg2.connect(**db_config)
-    cur = conn.cursor()
 
+def explain_prefix(as_json=True, analyze=False, buffers=False, timing=True):
+    options = []
     if as_json:
-        cur.execute(f"EXPLAIN (FORMAT JSON) {sql_query}")
-        result = cur.fetchone()[0]  # JSON list
-        qep = result[0]  # unwrap first element
-        print(json.dumps(result[0], indent=2))
-        return qep  # unwrap from list
-    else:
-        cur.execute(f"EXPLAIN {sql_query}")
-        qep = cur.fetchall()  # list of tuples (text lines)
-    cur.close()
-    conn.close()
+        options.append("FORMAT JSON")
+    if analyze:
+        options.append("ANALYZE")
+        if buffers:
+            options.append("BUFFERS")
+        if not timing:
+            options.append("TIMING false")
+    if not options:
+        return "EXPLAIN"
+    return f"EXPLAIN ({', '.join(options)})"
+
+
+def get_qep(sql_query, db_config=None, as_json=True, session=None, timeout=None,
+            analyze=False, buffers=False, timing=True, settings=None):
+    """Explain `sql_query` on a pooled session.
+
+    With `analyze` the query is really executed (EXPLAIN ANALYZE), optionally
+    with BUFFERS and without per-node TIMING. The session always rolls the
+    transaction back afterwards, so data-modifying statements leave no trace.
+
+    `settings` maps planner settings (GUCs) to values applied for this
+    EXPLAIN only, like SET LOCAL.
+
+    `session` may also be a recording or replaying plan source (see
+    plansource.py) instead of a live DBSession.
+    """
+    if session is None:
+        with _temporary_session("postgresql", db_config) as tmp:
+            return get_qep(sql_query, as_json=as_json, session=tmp, timeout=timeout,
+                           analyze=analyze, buffers=buffers, timing=timing, settings=settings)
+    if not isinstance(session, DBSession):
+        return session.explain(sql_query, timeout=timeout, as_json=as_json, analyze=analyze,
+                               buffers=buffers, timing=timing, settings=settings)
+
+    prefix = explain_prefix(as_json, analyze, buffers, timing)
+    with span("explain"), session.cursor(timeout=timeout) as cur:
+        for name, value in (settings or {}).items():
+            # set_config(..., true) is SET LOCAL with bind parameters
+            cur.execute("SELECT set_config(%s, %s, true)", (name, str(value)))
+        cur.execute(f"{prefix} {sql_query}")
+        if as_json:
+            result = cur.fetchone()[0]  # JSON list
+            qep = result[0]  # unwrap first element
+        else:
+            qep = cur.fetchall()  # list of tuples (text lines)
     return qep
 
-    
+
 import json
-import queue
-from typing import List, Optional, Tuple
+import re
+import sys
+import textwrap
+from typing import Iterable, List, Optional, Tuple
+
+from costs import attribute_costs
+from mysqlplan import mysql_json_plan, mysql_tree_plan, table_aliases
+
+
+COST_INFO_RE = re.compile(
+    r"cost=(?P<startup>[\d.]+)\.\.(?P<total>[\d.]+)\s+"
+    r"rows=(?P<rows>\d+)\s+width=(?P<width>\d+)"
+)
+ACTUAL_INFO_RE = re.compile(
+    r"actual (?:time=(?P<startup>[\d.]+)\.\.(?P<total>[\d.]+)\s+)?"
+    r"rows=(?P<rows>[\d.]+)\s+loops=(?P<loops>\d+)"
+)
+BUFFERS_RE = re.compile(r"shared(?: hit=(?P<hit>\d+))?(?: read=(?P<read>\d+))?")
+RELATION_RE = re.compile(r" on (\S+)")
+SUBPLAN_RE = re.compile(r"(?:hashed )?(?:InitPlan|SubPlan) \d+")
+# "Worker 0:  actual time=... rows=... loops=1" and other per-worker lines
+WORKER_RE = re.compile(r"Worker (\d+):\s+(.*)")
 
 
 class ExecutionTreeNode:
+    # Plans on partitioned tables or wide UNION ALLs have thousands of nodes,
+    # so nodes carry no per-instance __dict__
+    __slots__ = (
+        "children", "parent", "condition", "operation", "relation", "plan", "id",
+        "level", "info", "startup_cost", "total_cost", "rows", "width",
+        "actual_rows", "actual_loops", "actual_startup_time", "actual_total_time",
+        "shared_hit_blocks", "shared_read_blocks", "relationship", "subplan_name",
+        "parallel_aware", "workers_planned", "workers_launched", "workers",
+        "max_hover_text_length",
+    )
+
     def __init__(self, id: int = 0, max_hover_text_length: int = 60):
         self.children: List[ExecutionTreeNode] = []
         self.parent = None
         self.condition: List[str] = []
         self.operation: str = None
+        self.relation: Optional[str] = None
+        self.plan: Optional[dict] = None
         self.id = id
+        self.level = 0
+        self.info = ""
+        self.startup_cost = 0.0
+        self.total_cost = 0.0
+        self.rows = 0.0
+        self.width = 0.0
+        # Only filled in by EXPLAIN ANALYZE; times are in ms and per loop
+        self.actual_rows: Optional[float] = None
+        self.actual_loops: Optional[int] = None
+        self.actual_startup_time: Optional[float] = None
+        self.actual_total_time: Optional[float] = None
+        self.shared_hit_blocks: Optional[int] = None
+        self.shared_read_blocks: Optional[int] = None
+        # "InitPlan" or "SubPlan" (with its name, e.g. "hashed SubPlan 1")
+        # for subqueries; regular children may be left as None
+        self.relationship: Optional[str] = None
+        self.subplan_name: Optional[str] = None
+        # Parallel query: Gather nodes plan and launch workers, nodes below
+        # them may be parallel aware. Per-worker actuals (dicts with "worker",
+        # "actual_rows", "actual_loops", times and buffers) need ANALYZE VERBOSE
+        self.parallel_aware = False
+        self.workers_planned: Optional[int] = None
+        self.workers_launched: Optional[int] = None
+        self.workers: Optional[List[dict]] = None
         self.max_hover_text_length = max_hover_text_length
 
     def add_child(self, child):
@@ -54,11 +149,17 @@ class ExecutionTreeNode:
 
     def set_operation(self, operation: str):
         if "  " in operation:
-            self.operation, self.info = operation.split("  ", 1)
+            operation, self.info = operation.split("  ", 1)
             self.parse_info(self.info)
         else:
-            self.operation = operation
             self.info = ""
+        # The same few operation labels repeat across every node
+        self.operation = sys.intern(operation)
+        self.parallel_aware = operation.startswith("Parallel ")
+        match = RELATION_RE.search(self.operation)
+        # "Bitmap Index Scan on x" names an index, not a relation
+        if match and not self.operation.startswith("Bitmap Index Scan"):
+            self.relation = match.group(1)
 
     def parse_info(self, info: str):
         # Info looks like this
@@ -66,12 +167,65 @@ class ExecutionTreeNode:
         # for cost, first is the startup cost, second is the total cost
         # for rows, it is the estimated number of rows output
         # for width, it is estimated average width of rows output
-        info = info.replace("(", "").replace(")", "")
-        cost, rows, width = info.split(" ")
-        self.startup_cost = float(cost.split("..")[0].split("=")[1])
-        self.total_cost = float(cost.split("..")[1])
-        self.rows = float(rows.split("=")[1])
-        self.width = float(width.split("=")[1])
+        # EXPLAIN ANALYZE appends (actual time=... rows=... loops=...),
+        # so match the estimate group instead of splitting on spaces
+        match = COST_INFO_RE.search(info)
+        if match is None:
+            raise ValueError(f"Cannot parse plan node info: {info}")
+        self.startup_cost = float(match.group("startup"))
+        self.total_cost = float(match.group("total"))
+        self.rows = float(match.group("rows"))
+        self.width = float(match.group("width"))
+        actual = ACTUAL_INFO_RE.search(info)
+        if actual is not None:
+            self.actual_rows = float(actual.group("rows"))
+            self.actual_loops = int(actual.group("loops"))
+            if actual.group("total") is not None:
+                self.actual_startup_time = float(actual.group("startup"))
+                self.actual_total_time = float(actual.group("total"))
+
+    def parse_buffers(self, line: str):
+        # Buffers: shared hit=1911 read=12
+        match = BUFFERS_RE.search(line)
+        if match is not None:
+            self.shared_hit_blocks = int(match.group("hit") or 0)
+            self.shared_read_blocks = int(match.group("read") or 0)
+
+    def parse_workers(self, line: str):
+        # "Workers Planned: 2", "Workers Launched: 2" or a "Worker N:" line
+        key, _, value = line.partition(":")
+        if key == "Workers Planned":
+            self.workers_planned = int(value)
+            return
+        if key == "Workers Launched":
+            self.workers_launched = int(value)
+            return
+        match = WORKER_RE.match(line)
+        actual = ACTUAL_INFO_RE.match(match.group(2)) if match else None
+        if actual is None:
+            # Per-worker sort or hash details read like conditions
+            self.add_condition(line)
+            return
+        worker = {
+            "worker": int(match.group(1)),
+            "actual_rows": float(actual.group("rows")),
+            "actual_loops": int(actual.group("loops")),
+            "actual_startup_time": None,
+            "actual_total_time": None,
+        }
+        if actual.group("total") is not None:
+            worker["actual_startup_time"] = float(actual.group("startup"))
+            worker["actual_total_time"] = float(actual.group("total"))
+        self.add_worker(worker)
+
+    def add_worker(self, worker: dict):
+        if self.workers is None:
+            self.workers = []
+        self.workers.append(worker)
+
+    @property
+    def analyzed(self) -> bool:
+        return self.actual_loops is not None
 
     def __repr__(self):
         operation = self.operation.split("  ")[0].strip()
@@ -104,7 +258,9 @@ class ExecutionTreeNode:
         elif "hash" in op and "join" not in op:
             return "H"     # hash
         elif "gather merge" in op:
-            return "γₘ"    # merged aggregate
+            return "⇉ₘ"    # gather, keeping the workers' sort order
+        elif "gather" in op:
+            return "⇉"     # gather worker output
         elif "materialize" in op:
             return "M"
         elif "append" in op:
@@ -129,6 +285,23 @@ class ExecutionTreeNode:
             "rows": self.rows,
             "width": self.width,
         }
+        if self.analyzed:
+            dict_info["actual rows"] = self.actual_rows
+            dict_info["loops"] = self.actual_loops
+            if self.actual_total_time is not None:
+                dict_info["actual time"] = f"{self.actual_startup_time}..{self.actual_total_time} ms"
+            if self.shared_hit_blocks is not None:
+                dict_info["buffers"] = f"hit={self.shared_hit_blocks} read={self.shared_read_blocks}"
+        if self.parallel_aware:
+            dict_info["parallel"] = "aware"
+        if self.workers_planned is not None:
+            launched = "" if self.workers_launched is None else f", {self.workers_launched} launched"
+            dict_info["workers"] = f"{self.workers_planned} planned{launched}"
+        if self.workers:
+            dict_info["worker rows"] = ", ".join(
+                f"#{worker['worker']}: {worker['actual_rows'] * worker['actual_loops']:,.0f}"
+                for worker in self.workers
+            )
         # Above is all the info we get
         # Below is just some logic to make text format better :D
         if self.condition:
@@ -136,25 +309,10 @@ class ExecutionTreeNode:
         result = []
         for k, v in dict_info.items():
             k = k.capitalize()
-            text = f"{k}: {v}"
-            # This is a bit stupid, but we need to split the text if it is too long
-            # I cannot find a better way to do this
-            first_line = True
-            while len(text) > self.max_hover_text_length:
-                split_pos = text[: self.max_hover_text_length].rfind(" ")
-                if split_pos == -1:
-                    split_pos = self.max_hover_text_length
-                now_text = text[:split_pos]
-                if first_line:
-                    now_text = now_text.removeprefix(f"{k}: ")
-                    now_text = f"<b>{k}</b>: {now_text}"
-                first_line = False
-                result.append(now_text)
-                text = text[split_pos:].strip()
-            if first_line:
-                text = text.removeprefix(f"{k}: ")
-                text = f"<b>{k}</b>: {text}"
-            result.append(text)
+            # Split long values over several lines; textwrap does it in one pass
+            lines = textwrap.wrap(f"{k}: {v}", self.max_hover_text_length) or [f"{k}:"]
+            lines[0] = f"<b>{k}</b>:{lines[0][len(k) + 1:]}"
+            result.extend(lines)
         return "<br>".join(result)
 
     def natural_language(self):
@@ -198,181 +356,482 @@ class ExecutionTree:
     def set_root(self, root: ExecutionTreeNode):
         self.root = root
 
+    @property
+    def analyzed(self) -> bool:
+        return self.root is not None and self.root.analyzed
+
     def finalize_id(
         self, node: Optional[ExecutionTreeNode] = None, curr_id: int = 0
     ) -> int:
+        # Number nodes in pre-order; returns the last id handed out
         if node is None:
             node = self.root
-        node.id = curr_id
-        for child in node.children:
-            curr_id = self.finalize_id(child, curr_id + 1)
+        stack = [node]
+        curr_id -= 1
+        while stack:
+            node = stack.pop()
+            curr_id += 1
+            # A numbered tree (e.g. one shared by the plan cache) isn't written to
+            if node.id != curr_id:
+                node.id = curr_id
+            stack.extend(reversed(node.children))
         return curr_id
 
+    def view(self) -> "ExecutionTree":
+        """A new tree over the same nodes.
+
+        Per-run attributes such as `qep` and `settings` go on the view, so a
+        tree shared between threads (see PlanCache) is only ever read.
+        """
+        view = ExecutionTree()
+        view.__dict__.update(self.__dict__)
+        return view
+
     def bfs(self) -> List[List[ExecutionTreeNode]]:
-        # Use a queue to do BFS
-        q = queue.Queue()
-        q.put(self.root)
+        # Nodes level by level
         result = []
-        while not q.empty():
-            level = []
-            for _ in range(q.qsize()):
-                node = q.get()
-                level.append(node)
-                for child in node.children:
-                    q.put(child)
+        level = [self.root]
+        while level:
             result.append(level)
+            level = [child for node in level for child in node.children]
+        return result
 
     def dfs(self) -> List[ExecutionTreeNode]:
+        # Pre-order, the same order finalize_id numbers the nodes in
         result = []
-        self._dfs(self.root, result)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            result.append(node)
+            stack.extend(reversed(node.children))
         return result
 
-    def _dfs(self, node: ExecutionTreeNode, result: List[ExecutionTreeNode]):
-        result.append(node)
-        for child in node.children:
-            self._dfs(child, result)
-
     def traversal(self) -> List[ExecutionTreeNode]:
-        return self._traversal(self.root)
-
-    def _traversal(self, node: ExecutionTreeNode) -> List[ExecutionTreeNode]:
+        # Post-order: children (left to right) before their parent. Walking
+        # parent-first with children pushed in order visits the exact reverse
         result = []
-        for child in node.children:
-            result.extend(self._traversal(child))
-        # Traverse child then parent
-        result.append(node)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            result.append(node)
+            stack.extend(node.children)
+        result.reverse()
         return result
 
-    def get_cost(self):
-        # If get cost is called, we need to traverse the tree
-        nodes = self.traversal()
-        total_cost = 0
-        startup_cost = 0
-        cost_breakdown = []
-
-        for node in nodes:
-            # Sum of children total costs
-            child_cost_sum = sum(child.total_cost for child in node.children)
-
-            # Net cost = total - children (the cost of just this step)
-            net_cost = node.total_cost - child_cost_sum
-
-            total_cost += node.total_cost
-            startup_cost += node.startup_cost
-
-            cost_breakdown.append({
-                "id": node.id,
-                "operation": node.operation,
-                "startup_cost": round(node.startup_cost, 2),
-                "total_cost": round(node.total_cost, 2),
-                "net_cost": round(net_cost, 2),
-                "condition": node.condition
-            })
-
-        return {
-            "total_cost": round(total_cost, 2),
-            "startup_cost": round(startup_cost, 2),
-            "steps": cost_breakdown
-        }
-def parse_query_explanation_to_tree(explanation: List[Tuple[str]]) -> ExecutionTree:
-    # Parsing a query explanation into a tree
+    def get_cost(self, top_n: int = 10) -> dict:
+        """Cost breakdown of the plan, see costs.attribute_costs.
+
+        The plan's cost is the root's; each step's net cost is what the node
+        adds on top of its children, scaled by how often it runs.
+        """
+        return attribute_costs(self, top_n)
+
+
+@timed("parse_text")
+def parse_query_explanation_to_tree(explanation: Iterable) -> ExecutionTree:
+    """Parse text-format EXPLAIN output into a tree in one streaming pass.
+
+    Args:
+        explanation (Iterable): Plan lines, either 1-tuples as returned by a
+            cursor or plain strings (a file, a log). psql's "QUERY PLAN"
+            header and "(N rows)" footer are skipped.
+
+    Returns:
+        ExecutionTree: The parsed tree, ids not yet finalized
+    """
     tree = ExecutionTree()
-    root = ExecutionTreeNode()
-    root.set_level(0)
-    tree.set_root(root)
-    current_node = root
-    # Store all nodes we added so far
-    all_nodes = [root]
-    # The level of the node is determined by the arrow position
-    arrow_places = [0]
-    current_node.set_operation(explanation[0][0])
-    current_level = 0
-    # The first line must be the root node
-    for idx, (query_plan) in enumerate(explanation[1:]):
-        query_plan = query_plan[0]  # The query plan is a tuple
-        if is_cond(query_plan):
-            # If it is a condition, we add it to the current node
-            # It is some condition follow the current node
-            current_node.add_condition(query_plan)
-        elif is_query(query_plan):
-            # If it is a query, we add a new node
-            new_node = ExecutionTreeNode()
-            # Get the position of the arrow
+    # Open ancestors of the line being read, with the column of their arrow.
+    # A new node's parent is the nearest one whose arrow is left of its own.
+    stack: List[Tuple[int, ExecutionTreeNode]] = []
+    root_indent = -1
+    current_node = None
+    # "InitPlan 1 (returns $0)" / "SubPlan 2" heading the next child: (column, name)
+    subplan = None
+    # Buffers lines after a "Worker N:" line are that worker's, not the node's
+    in_workers = False
+    for query_plan in explanation:
+        if not isinstance(query_plan, str):
+            query_plan = query_plan[0]  # Cursor rows are tuples
+        query_plan = query_plan.rstrip("\r\n")
+        stripped = query_plan.lstrip()
+        indent = len(query_plan) - len(stripped)
+
+        if current_node is None:
+            # The first line with a cost estimate is the root node
+            if "(cost=" not in query_plan:
+                continue
+            root = ExecutionTreeNode()
+            root.set_level(0)
+            root.set_operation(stripped)
+            tree.set_root(root)
+            root_indent = indent
+            stack.append((indent, root))
+            current_node = root
+            continue
+
+        if indent <= root_indent:
+            # Back at the root's column: the ANALYZE trailer (Planning Time:,
+            # Execution Time:) or psql's row count, the plan is over
+            break
+        if is_query(stripped):
             arrow_position = query_plan.index("->")
-            if arrow_position not in arrow_places:
-                # If not exist, we add it to the arrow places
-                arrow_places.append(arrow_position)
-            # The level equals to the pos in the arrow position
-            level = arrow_places.index(arrow_position)
-
-            # If we access to a child node of current node
-            if level > current_level:
-                # The index of the arrow index is the level of the node
-                new_node.set_level(level)
-                # Add operation
-                new_node.set_operation(query_plan.split("->")[-1].strip())
-                # Set parents to current node
-                new_node.set_parent(current_node)
-                # Append this node
-                all_nodes.append(new_node)
-                # Add the child to the current node
-                current_node.add_child(new_node)
-                current_node = new_node
-                # Set to next level
-                current_level = level
-            elif level <= current_level:
-                # If this level is less than the current level
-                # We pop the last node util we find the closest
-                while all_nodes[-1].level >= level:
-                    all_nodes.pop()
-
-                # Add the operation and level as usual
-                new_node.set_level(level)
-                new_node.set_operation(query_plan.split("->")[-1].strip())
-                # This last node is the parent of the new node
-                new_node.set_parent(all_nodes[-1])
-                # Add the new node to the parent
-                all_nodes[-1].add_child(new_node)
-                # Append this node
-                all_nodes.append(new_node)
-                current_level = level
-                current_node = new_node
-                # import pdb; pdb.set_trace()
+            while stack[-1][0] >= arrow_position:
+                stack.pop()
+            parent = stack[-1][1]
+            new_node = ExecutionTreeNode()
+            new_node.set_level(len(stack))
+            new_node.set_operation(stripped[2:].strip())
+            if subplan is not None and arrow_position <= subplan[0]:
+                subplan = None
+            elif subplan is not None and arrow_position == subplan[0] + 2:
+                new_node.subplan_name = subplan[1]
+                new_node.relationship = "InitPlan" if "InitPlan" in subplan[1] else "SubPlan"
+            new_node.set_parent(parent)
+            parent.add_child(new_node)
+            stack.append((arrow_position, new_node))
+            current_node = new_node
+            in_workers = False
+        elif SUBPLAN_RE.match(stripped):
+            subplan = (indent, stripped)
+        elif stripped.startswith(("Workers Planned:", "Workers Launched:", "Worker ")):
+            current_node.parse_workers(stripped)
+            in_workers = in_workers or stripped.startswith("Worker ")
+        elif stripped.startswith("Buffers:"):
+            if not in_workers:
+                current_node.parse_buffers(stripped)
+        elif is_cond(stripped):
+            # It is some condition follow the current node
+            current_node.add_condition(stripped)
 
+    if tree.root is None:
+        raise ValueError("No query plan found in the explanation")
     return tree
 
+
+def parse_explain_file(path: str) -> ExecutionTree:
+    """Parse a text plan saved to a file, reading it line by line."""
+    with open(path, "r", encoding="utf-8") as f:
+        return parse_query_explanation_to_tree(f)
+
+
 def is_query(plan: str) -> bool:
-    return "->" in plan
+    return plan.lstrip().startswith("->")
 
 def is_cond(plan: str) -> bool:
     return ":" in plan
 
+
+# Plan keys that EXPLAIN's text format prints as "Key: value" lines,
+# in the order they appear there
+JSON_CONDITION_KEYS = [
+    "Sort Key", "Presorted Key", "Group Key", "Hash Cond", "Merge Cond",
+    "Join Filter", "Index Cond", "Recheck Cond", "TID Cond", "Order By",
+    "Cache Key", "Filter", "One-Time Filter",
+]
+
+AGGREGATE_STRATEGIES = {
+    "Plain": "Aggregate",
+    "Sorted": "GroupAggregate",
+    "Hashed": "HashAggregate",
+    "Mixed": "MixedAggregate",
+}
+
+JOIN_PREFIXES = {"Nested Loop": "Nested Loop", "Hash Join": "Hash", "Merge Join": "Merge"}
+
+
+def json_operation(plan: dict) -> str:
+    """Build the operation label EXPLAIN's text format would show for a node,
+    e.g. "Hash Right Join" or "Index Scan using orders_pkey on orders o"."""
+    node_type = plan.get("Node Type", "Unknown")
+    operation = node_type
+    join_type = plan.get("Join Type")
+    if node_type in JOIN_PREFIXES and join_type and join_type != "Inner":
+        operation = f"{JOIN_PREFIXES[node_type]} {join_type} Join"
+    elif node_type == "Aggregate":
+        operation = AGGREGATE_STRATEGIES.get(plan.get("Strategy"), node_type)
+        if plan.get("Partial Mode") in ("Partial", "Finalize"):
+            operation = f"{plan['Partial Mode']} {operation}"
+    if plan.get("Parallel Aware"):
+        operation = f"Parallel {operation}"
+
+    if plan.get("Scan Direction") == "Backward":
+        operation += " Backward"
+    if "Index Name" in plan and node_type != "Bitmap Index Scan":
+        operation += f" using {plan['Index Name']}"
+    if "Relation Name" in plan:
+        operation += f" on {plan['Relation Name']}"
+        alias = plan.get("Alias")
+        if alias and alias != plan["Relation Name"]:
+            operation += f" {alias}"
+    elif node_type == "Bitmap Index Scan":
+        operation += f" on {plan.get('Index Name')}"
+    elif "CTE Name" in plan or "Function Name" in plan:
+        name = plan.get("CTE Name") or plan["Function Name"]
+        operation += f" on {name}"
+        alias = plan.get("Alias")
+        if alias and alias != name:
+            operation += f" {alias}"
+    elif node_type == "Subquery Scan" and "Alias" in plan:
+        operation += f" on {plan['Alias']}"
+    return operation
+
+
+def json_conditions(plan: dict) -> List[str]:
+    conditions = []
+    for key in JSON_CONDITION_KEYS:
+        value = plan.get(key)
+        if value is None:
+            continue
+        if isinstance(value, list):
+            value = ", ".join(value)
+        conditions.append(f"{key}: {value}")
+    return conditions
+
+
+def build_node_from_json(plan: dict, level: int = 0) -> ExecutionTreeNode:
+    node = ExecutionTreeNode()
+    node.set_level(level)
+    node.operation = sys.intern(json_operation(plan))
+    node.relation = plan.get("Relation Name")
+    node.plan = plan
+    node.startup_cost = float(plan.get("Startup Cost", 0.0))
+    node.total_cost = float(plan.get("Total Cost", 0.0))
+    node.rows = float(plan.get("Plan Rows", 0))
+    node.width = float(plan.get("Plan Width", 0))
+    node.set_condition(json_conditions(plan))
+    node.relationship = plan.get("Parent Relationship")
+    node.subplan_name = plan.get("Subplan Name")
+    if "Actual Loops" in plan:
+        node.actual_rows = float(plan["Actual Rows"])
+        node.actual_loops = int(plan["Actual Loops"])
+        if "Actual Total Time" in plan:
+            node.actual_startup_time = float(plan["Actual Startup Time"])
+            node.actual_total_time = float(plan["Actual Total Time"])
+    if "Shared Hit Blocks" in plan:
+        node.shared_hit_blocks = int(plan["Shared Hit Blocks"])
+        node.shared_read_blocks = int(plan["Shared Read Blocks"])
+    node.parallel_aware = bool(plan.get("Parallel Aware"))
+    node.workers_planned = plan.get("Workers Planned")
+    node.workers_launched = plan.get("Workers Launched")
+    for worker in plan.get("Workers", ()):
+        # Without VERBOSE, workers only report their sort or hash details
+        if "Actual Loops" not in worker:
+            continue
+        node.add_worker({
+            "worker": worker.get("Worker Number"),
+            "actual_rows": float(worker["Actual Rows"]),
+            "actual_loops": int(worker["Actual Loops"]),
+            "actual_startup_time": worker.get("Actual Startup Time"),
+            "actual_total_time": worker.get("Actual Total Time"),
+        })
+    return node
+
+
+@timed("build_tree")
+def build_tree_from_json(qep: dict) -> ExecutionTree:
+    """Build an ExecutionTree from one `EXPLAIN (FORMAT JSON)` plan.
+
+    Args:
+        qep (dict): The unwrapped plan, i.e. {"Plan": {...}, ...}
+
+    Returns:
+        ExecutionTree: The tree, with ids finalized and `qep` attached
+    """
+    tree = ExecutionTree()
+    root = build_node_from_json(qep["Plan"])
+    tree.set_root(root)
+    stack = [(root, qep["Plan"])]
+    while stack:
+        node, plan = stack.pop()
+        for sub in plan.get("Plans", []):
+            child = build_node_from_json(sub, node.level + 1)
+            child.set_parent(node)
+            node.add_child(child)
+            stack.append((child, sub))
+    tree.finalize_id()
+    tree.qep = qep
+    return tree
+
+
 import plotly.graph_objs as go
+import plotly.io as pio
 from igraph import Graph
 
+from fingerprint import ShapeCache, tree_fingerprint
+
+# Shown on click in the report to fold and unfold a node's subtree. Every
+# node trace carries each node's parent id in its meta and comes right after
+# its edge trace; edge i leads to node i + 1.
+COLLAPSE_SCRIPT = """
+var gd = document.getElementById('{plot_id}');
+var trees = {};
+gd.data.forEach(function (trace, t) {
+    if (!Array.isArray(trace.meta)) { return; }
+    trees[t] = {
+        parents: trace.meta, collapsed: {},
+        x0: trace.x.slice(), y0: trace.y.slice(),
+        ex0: gd.data[t - 1].x.slice(), ey0: gd.data[t - 1].y.slice()
+    };
+});
+gd.on('plotly_click', function (event) {
+    var t = event.points[0].curveNumber, tree = trees[t];
+    if (!tree) { return; }
+    var parents = tree.parents, collapsed = tree.collapsed;
+    var id = event.points[0].pointIndex;
+    collapsed[id] = !collapsed[id];
+    var hidden = new Array(parents.length).fill(false);
+    for (var i = 1; i < parents.length; i++) {
+        // Pre-order ids: a parent is always decided before its children
+        hidden[i] = hidden[parents[i]] || !!collapsed[parents[i]];
+    }
+    var x = tree.x0.slice(), y = tree.y0.slice(), ex = tree.ex0.slice(), ey = tree.ey0.slice();
+    for (var j = 1; j < parents.length; j++) {
+        if (hidden[j]) {
+            x[j] = null; y[j] = null;
+            ex[3 * (j - 1)] = null; ex[3 * (j - 1) + 1] = null;
+            ey[3 * (j - 1)] = null; ey[3 * (j - 1) + 1] = null;
+        }
+    }
+    var symbols = tree.x0.map(function (_, k) { return collapsed[k] ? 'circle-dot' : 'circle'; });
+    Plotly.restyle(gd, {x: [ex], y: [ey]}, [t - 1]);
+    Plotly.restyle(gd, {x: [x], y: [y], 'marker.symbol': [symbols]}, [t]);
+});
+"""
+
+# Condition text shown per node in large-plan hovers
+LARGE_PLAN_CONDITION_LENGTH = 120
+
+
 class Visualizer(object):
+    """Draws an ExecutionTree with Plotly.
+
+    Plans with at least `large_plan_threshold` nodes switch to WebGL traces,
+    smaller markers and short one-line-per-field hover labels built in one
+    batch, instead of word-wrapping every node's full explanation.
+
+    Layouts, and the report's styled figure less its hover text and colors,
+    only depend on the tree's shape. Both are shared by all visualizers, the
+    layouts keyed by each node's parent id in pre-order and the figures by
+    tree_fingerprint and large_plan_threshold, so a re-run or another query
+    with the same plan shape only redraws the per-node annotations.
+
+    Args:
+        large_plan_threshold (int): Node count at which large-plan mode starts
+        layout_cache_size (int): Tree shapes whose layout is remembered
+        figure_cache_size (int): Tree shapes whose report figure is remembered
+    """
+
+    _layout_cache = ShapeCache("layout_cache")
+    _figure_cache = ShapeCache("figure_cache")
+
+    # The report's look; applying a template deep-copies it, which is not free
+    REPORT_LAYOUT = dict(
+        template="plotly_white",
+        paper_bgcolor="white",
+        plot_bgcolor="white",
+        xaxis=dict(showgrid=False, showticklabels=False, zeroline=False),
+        yaxis=dict(showgrid=False, showticklabels=False, zeroline=False),
+    )
+
+    def __init__(self, large_plan_threshold: int = 1000, layout_cache_size: int = 64,
+                 figure_cache_size: int = 16):
+        self.large_plan_threshold = large_plan_threshold
+        self.layout_cache_size = layout_cache_size
+        self.figure_cache_size = figure_cache_size
+
+    @timed("layout")
     def calc_layout(self, tree: ExecutionTree):
         tree.finalize_id()
         nodes = tree.dfs()
         parents = [node.parent.id for node in nodes if node.parent]
         edges = [(node.id, parent) for node, parent in zip(nodes[1:], parents)]
+        # Coordinates only depend on who is whose parent, whatever the operators
+        key = tuple(parents)
+        node_layout = self._layout_cache.get(key)
+        if node_layout is not None:
+            return nodes, node_layout, edges
+
         g = Graph(n=len(nodes), edges=edges, directed=True)
         node_layout = g.layout("rt", root=[0], mode="all")
         min_y = min([pos[1] for pos in node_layout])
         node_layout = [(pos[0], pos[1] - min_y) for pos in node_layout]
         max_y = max([pos[1] for pos in node_layout])
         node_layout = [(pos[0], max_y - pos[1]) for pos in node_layout]
+
+        self._layout_cache.put(key, node_layout, self.layout_cache_size)
         return nodes, node_layout, edges
 
-    def visualize(self, tree: ExecutionTree) -> go.Figure:
-        fig = go.Figure()
+    @staticmethod
+    def short_hover_text(node: ExecutionTreeNode) -> str:
+        condition = " ".join(node.condition)
+        if len(condition) > LARGE_PLAN_CONDITION_LENGTH:
+            condition = condition[:LARGE_PLAN_CONDITION_LENGTH] + "..."
+        text = (f"<b>Operation</b>: {node.operation}<br><b>Cost</b>: {node.total_cost}"
+                f"<br><b>Rows</b>: {node.rows}<br><b>Width</b>: {node.width}")
+        if condition:
+            text += f"<br><b>Condition</b>: {condition}"
+        return text
+
+    def is_large(self, nodes: List[ExecutionTreeNode]) -> bool:
+        return len(nodes) >= self.large_plan_threshold
+
+    def hover_texts(self, nodes: List[ExecutionTreeNode], hover_notes=None) -> List[str]:
+        if self.is_large(nodes):
+            # One flat batch of short labels instead of wrapping every field
+            hovertext = [self.short_hover_text(node) for node in nodes]
+        else:
+            hovertext = [node.explain() for node in nodes]
+        if hover_notes is not None:
+            hovertext = [f"{text}<br>{note}" if note else text
+                         for text, note in zip(hovertext, hover_notes)]
+        return hovertext
+
+    @staticmethod
+    def marker_colors(colors=None) -> dict:
+        if colors is None:
+            return dict(color="#6175c1")
+        palette = list(dict.fromkeys(colors))
+        if len(palette) == 1:
+            return dict(color=palette[0])
+        # Indices into a stepped colorscale validate much faster than one
+        # color string per point
+        index = {color: i for i, color in enumerate(palette)}
+        steps = len(palette)
+        scale = []
+        for i, color in enumerate(palette):
+            scale += [[i / steps, color], [(i + 1) / steps, color]]
+        return dict(color=[index[color] for color in colors], colorscale=scale,
+                    cmin=-0.5, cmax=steps - 0.5)
+
+    def add_tree_traces(self, fig: go.Figure, tree: ExecutionTree, colors=None,
+                        hover_notes=None, x_offset: float = 0.0) -> Tuple[float, float]:
+        """Add one tree's edge trace and node trace to `fig`.
+
+        Args:
+            fig (go.Figure): Figure to draw into
+            tree (ExecutionTree): The tree
+            colors (list): Marker color per node id, default all the same
+            hover_notes (list): Extra hover text per node id (or None)
+            x_offset (float): Shift the tree right, to draw several side by side
+
+        Returns:
+            Tuple[float, float]: Width and height of the drawn layout
+        """
         nodes, node_layout, edges = self.calc_layout(tree)
+        large = self.is_large(nodes)
+        scatter = go.Scattergl if large else go.Scatter
         Xe, Ye = [], []
         for edge in edges:
-            Xe += [node_layout[edge[0]][0], node_layout[edge[1]][0], None]
+            Xe += [node_layout[edge[0]][0] + x_offset, node_layout[edge[1]][0] + x_offset, None]
             Ye += [node_layout[edge[0]][1], node_layout[edge[1]][1], None]
+        Xn = [pos[0] + x_offset for pos in node_layout]
+        Yn = [pos[1] for pos in node_layout]
+        symbols = [node.symbol() for node in nodes]
+        if len(set(symbols)) == 1:
+            # A scalar skips Plotly's per-point enum validation
+            symbols = symbols[0]
         fig.add_trace(
-            go.Scatter(
+            scatter(
                 x=Xe,
                 y=Ye,
                 mode="lines",
@@ -381,30 +840,40 @@ class Visualizer(object):
                 hoverinfo="none",
             )
         )
+        # Parent ids let the collapse script rebuild visibility
+        parents = [-1] + [parent for _, parent in edges]
+        text = [node.get_text() for node in nodes]
+        hovertext = self.hover_texts(nodes, hover_notes)
+        marker_colors = self.marker_colors(colors)
         # markers = [node.get_marker() for node in nodes]
         fig.add_trace(
-            go.Scatter(
-                x=[pos[0] for pos in node_layout],
-                y=[pos[1] for pos in node_layout],
+            scatter(
+                x=Xn,
+                y=Yn,
                 mode="markers+text",
                 showlegend=False,
                 marker=dict(
-                    symbol=[node.symbol() for node in nodes],
-                    size=35,
+                    symbol=symbols,
+                    size=14 if large else 35,
                     opacity=1,
-                    color="#6175c1",
                     line=dict(color="rgb(50,50,50)", width=1),
+                    **marker_colors,
                 ),
-                text=[node.get_text() for node in nodes],
+                text=text,
                 textposition="middle center",
-                textfont=dict(size=14, color="white"),
+                textfont=dict(size=8 if large else 14, color="white"),
+                meta=parents,
                 hoverinfo="text",
-                hovertext=[node.explain() for node in nodes],
+                hovertext=hovertext,
                 hoverlabel=dict(font=dict(family="monospace")),
             )
         )
-        layer = max([pos[1] for pos in node_layout]) + 1
-        height = max(300, 55 * layer)
+        width = max(pos[0] for pos in node_layout) - min(pos[0] for pos in node_layout)
+        return width, max(pos[1] for pos in node_layout)
+
+    def style_figure(self, fig: go.Figure, layers: float, large: bool):
+        # Height grows with the number of levels drawn
+        height = max(300, (25 if large else 55) * layers)
         fig.update_layout(
             showlegend=False,
             margin=dict(l=0, r=0, t=0, b=0),
@@ -414,15 +883,96 @@ class Visualizer(object):
             yaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
             height=height,
         )
+
+    @timed("visualize")
+    def visualize(self, tree: ExecutionTree, colors=None, hover_notes=None) -> go.Figure:
+        # colors and hover_notes as in add_tree_traces, e.g. to flag spills
+        fig = go.Figure()
+        _, height = self.add_tree_traces(fig, tree, colors=colors, hover_notes=hover_notes)
+        self.style_figure(fig, height + 1, self.is_large(fig.data[-1].x))
         return fig
-import mysql.connector
-
-def get_qep_mysql(sql_query, db_config):
-    conn = mysql.connector.connect(**db_config)
-    cur = conn.cursor(dictionary=True)
-    cur.execute(f"EXPLAIN FORMAT=JSON {sql_query}")
-    result = cur.fetchone()[0]
-    #print(result)
-    cur.close()
-    conn.close()
-    return result[0]
\ No newline at end of file
+
+    @timed("report_figure")
+    def report_figure(self, tree: ExecutionTree, colors=None, hover_notes=None) -> dict:
+        """The report's styled figure for `tree`, as a plain figure dict.
+
+        The first tree of a shape is drawn, styled and validated by Plotly
+        as usual and kept as the shape's skeleton. Later trees of that shape
+        only get their own hover text and marker colors put into a copy of
+        it, which skips the layout, the template and Plotly's validation.
+        """
+        # Visualizers share the cache, and the threshold changes the figure
+        key = (tree_fingerprint(tree), self.large_plan_threshold)
+        skeleton = self._figure_cache.get(key)
+        if skeleton is None:
+            fig = go.Figure()
+            _, height = self.add_tree_traces(fig, tree)
+            self.style_figure(fig, height + 1, self.is_large(fig.data[-1].x))
+            with span("style_figure"):
+                fig.update_layout(**self.REPORT_LAYOUT)
+            skeleton = fig.to_dict()
+            self._figure_cache.put(key, skeleton, self.figure_cache_size)
+        nodes = tree.dfs()
+        edge_trace, node_trace = skeleton["data"]
+        # The skeleton is shared, so only ever copied, never changed
+        node_trace = dict(node_trace, hovertext=self.hover_texts(nodes, hover_notes),
+                          marker=dict(node_trace["marker"], **self.marker_colors(colors)))
+        return {"data": [edge_trace, node_trace], "layout": skeleton["layout"]}
+
+    @timed("to_html")
+    def to_html(self, fig, offline: bool = False, plotlyjs_url: Optional[str] = None) -> str:
+        """Serialize a figure from `visualize` or `report_figure` for the report.
+
+        Args:
+            fig (go.Figure or dict): The figure; a dict is taken as already valid
+            offline (bool): Inline plotly.js so the report opens without
+                network access, instead of loading it from the CDN
+            plotlyjs_url (str): Load plotly.js from here instead, e.g. the
+                report server's shared copy
+        """
+        return pio.to_html(
+            fig,
+            full_html=False,
+            include_plotlyjs=plotlyjs_url or (True if offline else "cdn"),
+            post_script=COLLAPSE_SCRIPT,
+            config={"displaylogo": False},
+            validate=not isinstance(fig, dict),
+        )
+
+
+def get_qep_mysql(sql_query, db_config=None, session=None, timeout=None, analyze=False, tree=False):
+    """Explain `sql_query` on MySQL, in the same plan shape get_qep returns.
+
+    The default is EXPLAIN FORMAT=JSON; `tree` uses FORMAT=TREE instead.
+    `analyze` runs EXPLAIN ANALYZE (MySQL 8.0.18+, tree output only), which
+    executes the query; the session rolls it back like on PostgreSQL.
+    """
+    if session is None:
+        with _temporary_session("mysql", db_config) as tmp:
+            return get_qep_mysql(sql_query, session=tmp, timeout=timeout, analyze=analyze, tree=tree)
+    if not isinstance(session, DBSession):
+        # A recording or replaying plan source, see get_qep
+        return session.explain(sql_query, timeout=timeout, analyze=analyze, tree=tree)
+
+    if analyze:
+        prefix = "EXPLAIN ANALYZE"
+    else:
+        prefix = "EXPLAIN FORMAT=TREE" if tree else "EXPLAIN FORMAT=JSON"
+    with span("explain"), session.cursor(timeout=timeout) as cur:
+        cur.execute(f"{prefix} {sql_query}")
+        # One row, one column holding the whole document
+        result = cur.fetchone()[0]
+    if isinstance(result, (bytes, bytearray)):
+        result = result.decode("utf-8")
+    # MySQL names tables by alias; the plan cache needs the real names for statistics
+    aliases = table_aliases(sql_query)
+    if analyze or tree:
+        return mysql_tree_plan(result, aliases)
+    return mysql_json_plan(result, aliases)
+
+
+def get_plan(sql_query, session, timeout=None, analyze=False, buffers=False):
+    """Explain on whichever database `session` is connected to."""
+    if session.dbms == "mysql":
+        return get_qep_mysql(sql_query, session=session, timeout=timeout, analyze=analyze)
+    return get_qep(sql_query, session=session, timeout=timeout, analyze=analyze, buffers=buffers)
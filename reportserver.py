@@ -0,0 +1,501 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import html
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from typing import Callable, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+from instrument import RECORDER
+
+
+DEFAULT_PORT = 8765
+# Published plans kept, oldest dropped first
+MAX_REPORTS = 500
+# Rendered pages kept in memory, least recently viewed dropped first
+MAX_RENDERED = 64
+# Largest plan accepted by POST /plans
+MAX_BODY = 64 * 1024 * 1024
+# Idle keep-alive connections are closed after this many seconds
+KEEP_ALIVE = 15
+# Responses smaller than this aren't worth compressing
+GZIP_MIN_SIZE = 1024
+
+STATUS_TEXT = {
+    200: "OK", 201: "Created", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+}
+
+
+def plan_id(qep: Optional[dict] = None, tree=None) -> str:
+    """Content address of a plan: publishing the same plan twice gives one report."""
+    if qep is not None:
+        payload = json.dumps(qep, sort_keys=True, default=str)
+    else:
+        # Text EXPLAIN trees have no JSON; their nodes are the content
+        payload = json.dumps([(node.operation, node.startup_cost, node.total_cost, node.rows,
+                               node.condition, node.actual_rows, node.actual_total_time)
+                              for node in tree.dfs()])
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class PublishedPlan:
+    __slots__ = ("id", "title", "sql", "qep", "tree", "pipeline", "published_at")
+
+    def __init__(self, id: str, title: str, sql: Optional[str], qep: Optional[dict], tree=None,
+                 pipeline=None):
+        self.id = id
+        self.title = title
+        self.sql = sql
+        self.qep = qep
+        self.tree = tree
+        # The plan cache's pipe syntax, when the plan came from it
+        self.pipeline = pipeline
+        self.published_at = time.time()
+
+    def get_tree(self):
+        # Built on first view; trees aren't kept for plans nobody opens
+        if self.tree is None:
+            from preprocessing import build_tree_from_json
+
+            self.tree = build_tree_from_json(self.qep)
+        return self.tree
+
+
+class Page:
+    """A rendered response body, compressed once up front."""
+
+    __slots__ = ("body", "gzipped", "content_type", "etag")
+
+    def __init__(self, body: bytes, content_type: str, etag: str):
+        self.body = body
+        self.gzipped = gzip.compress(body, 6) if len(body) >= GZIP_MIN_SIZE else None
+        self.content_type = content_type
+        self.etag = etag
+
+
+class ReportServer:
+    """Serves plan reports over HTTP, rendering each one when first viewed.
+
+    `publish` only stores the plan and returns at once; the report, the
+    plan diff and the plan JSON are built on request, one render at a time
+    on a worker thread (plotly is CPU bound), and the rendered pages are
+    kept in an LRU. Pages are gzipped once, carry ETags derived from the
+    plan's content and answer conditional GETs with 304. plotly.js is
+    served from one versioned URL that browsers cache for good, instead of
+    being inlined in every report.
+
+    Args:
+        host (str): Interface to listen on; keep it local, there is no auth
+        port (int): Port, 0 for any free one
+        max_reports (int): Published plans kept
+        max_rendered (int): Rendered pages kept in memory
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT,
+                 max_reports: int = MAX_REPORTS, max_rendered: int = MAX_RENDERED):
+        self.host = host
+        self.port = port
+        self.max_reports = max_reports
+        self.max_rendered = max_rendered
+        self._plans: "OrderedDict[str, PublishedPlan]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Only touched from the event loop
+        self._pages: "OrderedDict[str, Page]" = OrderedDict()
+        self._rendering = {}
+        # A restarted server may render differently; its ETags must differ too
+        self._token = format(int(time.time() * 1000), "x")
+        self._renderer = ThreadPoolExecutor(1, thread_name_prefix="report-render")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server = None
+        self._thread = None
+        self._plotly_version = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def report_url(self, id: str) -> str:
+        return f"{self.url}/report/{id}"
+
+    def diff_url(self, before: str, after: str) -> str:
+        return f"{self.url}/diff/{before}/{after}"
+
+    def publish(self, qep: Optional[dict] = None, tree=None, title: Optional[str] = None,
+                sql: Optional[str] = None, pipeline=None) -> str:
+        """Make a plan viewable; returns its id. Safe from any thread."""
+        if qep is None and tree is not None:
+            qep = getattr(tree, "qep", None)
+        id = plan_id(qep, tree)
+        with self._lock:
+            plan = self._plans.get(id)
+            if plan is None:
+                plan = self._plans[id] = PublishedPlan(id, title or id, sql, qep, tree, pipeline)
+                while len(self._plans) > self.max_reports:
+                    self._plans.popitem(last=False)
+            else:
+                # Newest first in the index
+                self._plans.move_to_end(id)
+                plan.published_at = time.time()
+        return id
+
+    def get(self, id: str) -> Optional[PublishedPlan]:
+        with self._lock:
+            return self._plans.get(id)
+
+    # Lifecycle
+
+    async def _start(self):
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # Port 0 binds any free port; report the real one
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve(self, ready: Optional[Callable[[], None]] = None):
+        """Serve until cancelled, in the calling event loop; `ready` is called once listening."""
+        await self._start()
+        if ready is not None:
+            ready()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start(self) -> "ReportServer":
+        """Serve from a background thread; returns once listening."""
+        started = threading.Event()
+        failure = []
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self._start())
+            except Exception as e:
+                failure.append(e)
+                started.set()
+                loop.close()
+                return
+            started.set()
+            try:
+                loop.run_forever()
+            finally:
+                # Idle keep-alive connections would otherwise die with the loop
+                tasks = asyncio.all_tasks(loop)
+                for task in tasks:
+                    task.cancel()
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                loop.close()
+
+        self._thread = threading.Thread(target=run, name="report-server", daemon=True)
+        self._thread.start()
+        started.wait()
+        if failure:
+            raise failure[0]
+        return self
+
+    def stop(self):
+        loop = self._loop
+        if loop is not None and self._thread is not None and loop.is_running():
+            def shutdown():
+                self._server.close()
+                loop.stop()
+            loop.call_soon_threadsafe(shutdown)
+            self._thread.join(timeout=5)
+        self._renderer.shutdown(wait=False)
+
+    # HTTP
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), KEEP_ALIVE)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+                    # ValueError: a malformed Content-Length or an overlong line
+                    break
+                if request is None:
+                    break
+                method, path, version, headers, body = request
+                try:
+                    status, response_headers, payload = await self._respond(method, path, headers, body)
+                except Exception as e:
+                    status, response_headers, payload = self._error(500, f"{type(e).__name__}: {e}")
+                keep_alive = (headers.get("connection", "").lower() != "close"
+                              and (version == "HTTP/1.1" or headers.get("connection", "").lower() == "keep-alive"))
+                self._write_response(writer, status, response_headers, b"" if method == "HEAD" else payload,
+                                     len(payload), keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            # Cancelled: the server is stopping; just hang up
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3:
+            return None
+        method, target, version = parts
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+            if len(headers) > 100:
+                return None
+        body = b""
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY:
+            # Too large to read; the handler answers 413 and the connection closes
+            headers["connection"] = "close"
+            body = None
+        elif length:
+            body = await reader.readexactly(length)
+        return method.upper(), unquote(urlsplit(target).path), version, headers, body
+
+    def _write_response(self, writer, status: int, headers: dict, payload: bytes, length: int,
+                        keep_alive: bool):
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}",
+                 f"Date: {formatdate(usegmt=True)}", "Server: pipesyntax-reports",
+                 f"Content-Length: {length}", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + payload)
+
+    def _error(self, status: int, message: str) -> Tuple[int, dict, bytes]:
+        return status, {"Content-Type": "text/plain; charset=utf-8"}, message.encode("utf-8")
+
+    def _page_response(self, page: Page, headers: dict) -> Tuple[int, dict, bytes]:
+        response_headers = {"Content-Type": page.content_type, "ETag": page.etag,
+                            "Cache-Control": self._cache_control(page), "Vary": "Accept-Encoding"}
+        if self._not_modified(headers, page.etag):
+            return 304, response_headers, b""
+        if page.gzipped is not None and "gzip" in headers.get("accept-encoding", ""):
+            response_headers["Content-Encoding"] = "gzip"
+            return 200, response_headers, page.gzipped
+        return 200, response_headers, page.body
+
+    @staticmethod
+    def _cache_control(page: Page) -> str:
+        if page.content_type.startswith("application/javascript"):
+            # The URL carries the plotly version, so the file never changes
+            return "public, max-age=31536000, immutable"
+        return "no-cache"
+
+    @staticmethod
+    def _not_modified(headers: dict, etag: str) -> bool:
+        match = headers.get("if-none-match")
+        if not match:
+            return False
+        return match.strip() == "*" or etag in (tag.strip() for tag in match.split(","))
+
+    async def _respond(self, method: str, path: str, headers: dict, body) -> Tuple[int, dict, bytes]:
+        if method == "POST" and path == "/plans":
+            return self._receive_plan(headers, body)
+        if method not in ("GET", "HEAD"):
+            return self._error(405, "Only GET, HEAD and POST /plans")
+        parts = [part for part in path.split("/") if part]
+
+        if not parts:
+            return self._index()
+        if parts[0] == "static" and len(parts) == 2 and parts[1] == self._plotly_file():
+            page = await self._page("static:plotly", self._render_plotly)
+            return self._page_response(page, headers)
+        if parts[0] == "report" and len(parts) == 2:
+            plan = self.get(parts[1])
+            if plan is None:
+                return self._error(404, "No such plan")
+            etag = f'"{plan.id}-{self._token}"'
+            # Known without rendering: a cached copy costs the viewer nothing
+            if self._not_modified(headers, etag):
+                return 304, {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}, b""
+            page = await self._page(f"report:{plan.id}", lambda: self._render_report(plan, etag))
+            return self._page_response(page, headers)
+        if parts[0] == "diff" and len(parts) == 3:
+            before, after = self.get(parts[1]), self.get(parts[2])
+            if before is None or after is None:
+                return self._error(404, "No such plan")
+            etag = f'"{before.id}-{after.id}-{self._token}"'
+            if self._not_modified(headers, etag):
+                return 304, {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}, b""
+            page = await self._page(f"diff:{before.id}:{after.id}",
+                                    lambda: self._render_diff(before, after, etag))
+            return self._page_response(page, headers)
+        if parts[0] == "plan" and len(parts) == 2 and parts[1].endswith(".json"):
+            plan = self.get(parts[1][:-len(".json")])
+            if plan is None or plan.qep is None:
+                return self._error(404, "No such JSON plan")
+            page = await self._page(f"json:{plan.id}", lambda: Page(
+                json.dumps(plan.qep, indent=2).encode("utf-8"), "application/json", f'"{plan.id}-json"'))
+            return self._page_response(page, headers)
+        return self._error(404, "Not found")
+
+    def _receive_plan(self, headers: dict, body) -> Tuple[int, dict, bytes]:
+        # A form or text/plain POST from another page needs no preflight; JSON does
+        content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            return self._error(415, "Plans are posted as application/json")
+        if body is None:
+            return self._error(413, f"Plans are limited to {MAX_BODY} bytes")
+        try:
+            doc = json.loads(body)
+            qep = doc["qep"]
+            if isinstance(qep, list):
+                qep = qep[0]
+            if "Plan" not in qep:
+                raise KeyError("Plan")
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            return self._error(400, f"Expected {{\"qep\": {{\"Plan\": ...}}}}: {e}")
+        id = self.publish(qep, title=doc.get("title"), sql=doc.get("sql"))
+        payload = json.dumps({"id": id, "url": self.report_url(id)}).encode("utf-8")
+        return 201, {"Content-Type": "application/json", "Location": f"/report/{id}"}, payload
+
+    def _index(self) -> Tuple[int, dict, bytes]:
+        with self._lock:
+            plans = list(reversed(self._plans.values()))
+        rows = "".join(
+            f"<tr><td><a href='/report/{plan.id}'>{html.escape(plan.title)}</a></td>"
+            f"<td>{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(plan.published_at))}</td>"
+            f"<td>{'' if plan.qep is None else f'<a href=/plan/{plan.id}.json>JSON</a>'}</td></tr>"
+            for plan in plans
+        )
+        body = (
+            "<html><head><meta charset='utf-8'><title>Plan reports</title></head>"
+            "<body style='font-family:Segoe UI, sans-serif; padding:20px;'><h2>Plan reports</h2>"
+            "<table cellpadding='4' style='border-collapse:collapse; text-align:left;'>"
+            f"<tr><th>Plan</th><th>Published</th><th></th></tr>{rows}</table></body></html>"
+        )
+        return 200, {"Content-Type": "text/html; charset=utf-8", "Cache-Control": "no-store"}, body.encode("utf-8")
+
+    # Rendering
+
+    async def _page(self, key: str, render: Callable[[], Page]) -> Page:
+        # One render per key, however many viewers ask for it at once
+        page = self._pages.get(key)
+        if page is not None:
+            self._pages.move_to_end(key)
+            return page
+        future = self._rendering.get(key)
+        if future is None:
+            future = self._loop.run_in_executor(self._renderer, render)
+            self._rendering[key] = future
+            future.add_done_callback(lambda done: self._rendered(key, done))
+        # A viewer hanging up must not cancel the render the others wait for
+        return await asyncio.shield(future)
+
+    def _rendered(self, key: str, future):
+        self._rendering.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        self._pages[key] = future.result()
+        while len(self._pages) > self.max_rendered:
+            self._pages.popitem(last=False)
+
+    def _plotly_file(self) -> str:
+        if self._plotly_version is None:
+            import plotly
+
+            self._plotly_version = plotly.__version__
+        return f"plotly-{self._plotly_version}.min.js"
+
+    def _plotly_url(self) -> str:
+        return f"/static/{self._plotly_file()}"
+
+    def _render_plotly(self) -> Page:
+        from plotly.offline import get_plotlyjs
+
+        return Page(get_plotlyjs().encode("utf-8"), "application/javascript; charset=utf-8",
+                    f'"{self._plotly_file()}"')
+
+    def _render_report(self, plan: PublishedPlan, etag: str) -> Page:
+        from interface import build_report_html
+
+        with RECORDER.run(f"render {plan.id}"):
+            page = build_report_html(plan.get_tree(), plan.qep, pipeline=plan.pipeline,
+                                     plotlyjs_url=self._plotly_url())
+        return Page(page.encode("utf-8"), "text/html; charset=utf-8", etag)
+
+    def _render_diff(self, before: PublishedPlan, after: PublishedPlan, etag: str) -> Page:
+        from plandiff import build_diff_html, diff_plans
+
+        with RECORDER.run(f"diff {before.id} {after.id}"):
+            page = build_diff_html(diff_plans(before.get_tree(), after.get_tree()),
+                                   plotlyjs_url=self._plotly_url())
+        return Page(page.encode("utf-8"), "text/html; charset=utf-8", etag)
+
+
+def publish_remote(server_url: str, qep: dict, title: Optional[str] = None, sql: Optional[str] = None,
+                   timeout: float = 10.0) -> str:
+    """POST a plan to a running report server; returns its report URL."""
+    body = json.dumps({"qep": qep, "title": title, "sql": sql}).encode("utf-8")
+    request = urllib.request.Request(f"{server_url.rstrip('/')}/plans", data=body, method="POST",
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())["url"]
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Serve plan reports over HTTP, rendered on demand")
+    parser.add_argument("plans", nargs="*", help="Saved plans to publish at start (JSON or text EXPLAIN)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--cache-dir", default=None, help="Also publish every plan in this plan cache directory")
+    parser.add_argument("--max-reports", type=int, default=MAX_REPORTS)
+    parser.add_argument("--max-rendered", type=int, default=MAX_RENDERED)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from plancache import CachedPlan
+    from plandiff import load_plan_file
+
+    args = build_parser().parse_args(argv)
+    server = ReportServer(args.host, args.port, args.max_reports, args.max_rendered)
+    for path in args.plans:
+        tree = load_plan_file(path)
+        server.publish(getattr(tree, "qep", None), tree, title=os.path.basename(path))
+    if args.cache_dir:
+        for name in sorted(os.listdir(args.cache_dir)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(args.cache_dir, name), "r", encoding="utf-8") as f:
+                    entry = CachedPlan.from_json(json.load(f))
+            except (OSError, ValueError, KeyError):
+                continue
+            server.publish(entry.qep, title=name[:-len(".json")][:16])
+
+    def ready():
+        print(f"Serving {len(server._plans)} plans on {server.url}", file=sys.stderr)
+
+    try:
+        asyncio.run(server.serve(ready))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"Cannot listen on {args.host}:{args.port}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
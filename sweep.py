@@ -0,0 +1,244 @@
+import argparse
+import itertools
+import json
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from batch import add_connection_arguments, db_config_from_args
+from dbsession import DBSession
+from fingerprint import shape_fingerprint
+from pipesyntax import generate_pipe_syntax
+from plandiff import diff_plans
+from preprocessing import build_tree_from_json, get_qep
+
+
+# Swept when no --set is given: the usual suspects when a plan flips
+DEFAULT_GRID = {
+    "enable_hashjoin": ["on", "off"],
+    "enable_nestloop": ["on", "off"],
+    "enable_seqscan": ["on", "off"],
+    "work_mem": ["4MB", "64MB"],
+    "random_page_cost": ["1.1", "4"],
+    "max_parallel_workers_per_gather": ["0", "2"],
+}
+
+# PostgreSQL adds this to operators a disabled enable_* setting could not
+# avoid; such plans were forced, not chosen
+DISABLE_COST = 1.0e10
+
+_SETTING_NAME_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_.]*$")
+
+
+def parse_grid(specs: List[str]) -> Dict[str, List[str]]:
+    """Parse "name=value1,value2" specs into a settings grid."""
+    grid = {}
+    for spec in specs:
+        name, sep, values = spec.partition("=")
+        name = name.strip()
+        if not sep or not _SETTING_NAME_RE.match(name):
+            raise ValueError(f"Expected name=value1,value2,...: {spec}")
+        grid[name] = [value.strip() for value in values.split(",") if value.strip()]
+        if not grid[name]:
+            raise ValueError(f"No values for {name}")
+    return grid
+
+
+def grid_combinations(grid: Dict[str, List[str]]) -> List[dict]:
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def explain_variant(sql: str, session, settings: dict, timeout: Optional[float] = None) -> dict:
+    result = {"settings": settings, "fingerprint": None, "total_cost": None,
+              "startup_cost": None, "forced": False, "error": None, "qep": None}
+    start = time.perf_counter()
+    try:
+        qep = get_qep(sql, session=session, timeout=timeout, settings=settings)
+        result["qep"] = qep
+        result["fingerprint"] = shape_fingerprint(qep)
+        result["total_cost"] = qep["Plan"]["Total Cost"]
+        result["startup_cost"] = qep["Plan"]["Startup Cost"]
+        result["forced"] = result["total_cost"] >= DISABLE_COST
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return result
+
+
+def setting_flips(variants: List[dict], grid: Dict[str, List[str]]) -> List[dict]:
+    """For each setting, how often changing only it changes the plan shape.
+
+    Variants are grouped by the values of every other setting; a group
+    flips when its variants don't all share one plan.
+    """
+    names = list(grid)
+    flips = []
+    for name in names:
+        groups: Dict[tuple, Dict[str, str]] = {}
+        for variant in variants:
+            if variant["error"]:
+                continue
+            key = tuple(variant["settings"][other] for other in names if other != name)
+            groups.setdefault(key, {})[variant["settings"][name]] = variant["fingerprint"]
+        compared = [group for group in groups.values() if len(group) > 1]
+        flipped = [group for group in compared if len(set(group.values())) > 1]
+        flips.append({
+            "setting": name,
+            "flips": len(flipped),
+            "compared": len(compared),
+            "share": round(len(flipped) / len(compared), 4) if compared else 0.0,
+        })
+    flips.sort(key=lambda flip: (flip["share"], flip["flips"]), reverse=True)
+    return flips
+
+
+def summarize_sweep(default: dict, variants: List[dict], grid: Dict[str, List[str]]) -> dict:
+    """Deduplicate plan shapes and compare the default plan with the cheapest.
+
+    Costs are the planner's own estimates under each variant. Settings like
+    random_page_cost change what a cost unit means, so "cheapest" is the
+    plan the planner liked best, not a measured runtime.
+    """
+    plans: Dict[str, dict] = {}
+    for variant in [default] + variants:
+        if variant["error"]:
+            continue
+        plan = plans.get(variant["fingerprint"])
+        if plan is None:
+            plan = plans[variant["fingerprint"]] = {
+                "fingerprint": variant["fingerprint"],
+                "variants": 0,
+                "min_cost": variant["total_cost"],
+                "max_cost": variant["total_cost"],
+                "example_settings": variant["settings"],
+                "pipe_syntax": generate_pipe_syntax(variant["qep"], show_cost=False),
+                "qep": variant["qep"],
+            }
+        plan["variants"] += 1
+        plan["min_cost"] = min(plan["min_cost"], variant["total_cost"])
+        plan["max_cost"] = max(plan["max_cost"], variant["total_cost"])
+
+    valid = [variant for variant in variants if not variant["error"]]
+    chosen = [variant for variant in valid if not variant["forced"]] or valid
+    cheapest = min(chosen, key=lambda variant: variant["total_cost"], default=None)
+
+    comparison = None
+    if cheapest is not None and not default["error"]:
+        comparison = {
+            "default_cost": default["total_cost"],
+            "cheapest_cost": cheapest["total_cost"],
+            "cost_delta": round(default["total_cost"] - cheapest["total_cost"], 2),
+            "cost_ratio": round(default["total_cost"] / cheapest["total_cost"], 4)
+            if cheapest["total_cost"] else None,
+            "same_plan": default["fingerprint"] == cheapest["fingerprint"],
+            "diff": None,
+        }
+        if not comparison["same_plan"]:
+            diff = diff_plans(build_tree_from_json(default["qep"]), build_tree_from_json(cheapest["qep"]))
+            comparison["diff"] = diff.summary()
+
+    # Plans are listed once each, so variants only keep their fingerprint
+    for variant in [default] + variants:
+        variant.pop("qep", None)
+    return {
+        "grid": grid,
+        "default": default,
+        "cheapest": cheapest,
+        "comparison": comparison,
+        "distinct_plans": sorted(plans.values(), key=lambda plan: plan["min_cost"]),
+        "flips": setting_flips(variants, grid),
+        "variants": variants,
+        "failed": len(variants) - len(valid),
+    }
+
+
+def run_sweep(sql: str, session, grid: Dict[str, List[str]], workers: int = 4,
+              timeout: Optional[float] = None) -> dict:
+    """Explain `sql` under every combination of `grid`, `workers` at a time.
+
+    Each variant runs on its own pooled connection inside a transaction
+    that is rolled back, so the settings never leak into other EXPLAINs.
+    """
+    if session.dbms != "postgresql":
+        raise ValueError("Planner setting sweeps need PostgreSQL")
+    combinations = grid_combinations(grid)
+    with ThreadPoolExecutor(workers) as executor:
+        default_future = executor.submit(explain_variant, sql, session, {}, timeout)
+        futures = [executor.submit(explain_variant, sql, session, settings, timeout)
+                   for settings in combinations]
+        default = default_future.result()
+        variants = [future.result() for future in futures]
+    return summarize_sweep(default, variants, grid)
+
+
+def print_summary(report: dict, out=sys.stderr):
+    variants = report["variants"]
+    print(f"{len(variants)} variants, {len(report['distinct_plans'])} distinct plans, "
+          f"{report['failed']} failed", file=out)
+    comparison = report["comparison"]
+    if comparison is not None:
+        if comparison["same_plan"]:
+            print(f"Default plan is the cheapest (cost {comparison['default_cost']})", file=out)
+        else:
+            print(f"Default plan costs {comparison['default_cost']}, cheapest "
+                  f"{comparison['cheapest_cost']} (x{comparison['cost_ratio']}) with "
+                  f"{report['cheapest']['settings']}", file=out)
+    for flip in report["flips"]:
+        print(f"  {flip['setting']:<36} flips the plan in {flip['flips']}/{flip['compared']}", file=out)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Explain one query under a grid of planner settings")
+    parser.add_argument("query", help=".sql file with one statement, - for stdin")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=V1,V2",
+                        help="Setting and values to sweep (repeatable), default: "
+                             + ", ".join(DEFAULT_GRID))
+    add_connection_arguments(parser)
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Concurrent EXPLAINs, also the number of connections")
+    parser.add_argument("--timeout", type=float, default=None, help="Statement timeout in seconds")
+    parser.add_argument("--include-plan", action="store_true", help="Keep the JSON plan of each distinct plan")
+    parser.add_argument("-o", "--output", default="-", help="JSON report file, - for stdout")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.workers < 1:
+        print("--workers must be at least 1", file=sys.stderr)
+        return 2
+    try:
+        grid = parse_grid(args.set) if args.set else DEFAULT_GRID
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if args.query == "-":
+        sql = sys.stdin.read()
+    else:
+        with open(args.query, "r", encoding="utf-8") as f:
+            sql = f.read()
+    sql = sql.strip().rstrip(";")
+
+    with DBSession(args.dbms, db_config_from_args(args), pool_size=args.workers,
+                   statement_timeout=args.timeout) as session:
+        report = run_sweep(sql, session, grid, args.workers)
+    if not args.include_plan:
+        for plan in report["distinct_plans"]:
+            plan.pop("qep")
+
+    print_summary(report)
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        json.dump(report, out, indent=2)
+        out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if report["default"]["error"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
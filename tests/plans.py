@@ -0,0 +1,34 @@
+"""Small plans shared by the tests."""
+
+
+def node(node_type: str, cost: float = 1.0, rows: int = 1, plans=None, **keys) -> dict:
+    plan = {"Node Type": node_type, "Startup Cost": 0.0, "Total Cost": cost, "Plan Rows": rows,
+            "Plan Width": 8, "Parallel Aware": False}
+    plan.update(keys)
+    if plans:
+        plan["Plans"] = plans
+    return plan
+
+
+def hash_join_plan(cost: float = 10.0) -> dict:
+    """orders o JOIN customer c ON o.o_custkey = c.c_custkey, as EXPLAIN (FORMAT JSON)."""
+    return {"Plan": node(
+        "Hash Join", cost, 5, plans=[
+            node("Seq Scan", 1.0, 5, **{"Relation Name": "orders", "Alias": "o"}),
+            node("Hash", 1.0, 3, plans=[
+                node("Seq Scan", 1.0, 3, **{"Relation Name": "customer", "Alias": "c"}),
+            ]),
+        ], **{"Join Type": "Inner", "Hash Cond": "(o.o_custkey = c.c_custkey)"},
+    )}
+
+
+def merge_join_plan(cost: float = 10.0) -> dict:
+    """The same query planned as a merge join."""
+    return {"Plan": node(
+        "Merge Join", cost, 5, plans=[
+            node("Sort", 2.0, 5, plans=[node("Seq Scan", 1.0, 5, **{"Relation Name": "orders", "Alias": "o"})],
+                 **{"Sort Key": ["o.o_custkey"]}),
+            node("Sort", 2.0, 3, plans=[node("Seq Scan", 1.0, 3, **{"Relation Name": "customer", "Alias": "c"})],
+                 **{"Sort Key": ["c.c_custkey"]}),
+        ], **{"Join Type": "Inner", "Merge Cond": "(o.o_custkey = c.c_custkey)"},
+    )}
@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+from executor import Operator, execute_pipeline, find_tables, parse_expression, sample_records
+from pipesyntax import build_pipeline
+from plans import node
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# Scans only read the columns the plan refers to, as VERBOSE plans list them
+ORDERS = {"Relation Name": "orders", "Alias": "o", "Output": ["o.o_orderkey", "o.o_custkey"]}
+CUSTOMER = {"Relation Name": "customer", "Alias": "c", "Output": ["c.c_custkey"]}
+
+
+def run(plan: dict, batch_rows: int = 2):
+    return execute_pipeline(build_pipeline({"Plan": plan}), find_tables(DATA), batch_rows=batch_rows)
+
+
+def join_plan(join_filter: str) -> dict:
+    return node("Hash Join", plans=[
+        node("Seq Scan", **ORDERS),
+        node("Hash", plans=[node("Seq Scan", **CUSTOMER)]),
+    ], **{"Join Type": "Inner", "Hash Cond": "(o.o_custkey = c.c_custkey)", "Join Filter": join_filter})
+
+
+def test_find_tables():
+    assert sorted(find_tables(DATA)) == ["customer", "nation", "orders"]
+
+
+def test_scan_filter():
+    result = run(node("Seq Scan", Filter="(o.o_orderdate < '1996-01-01'::date)", **ORDERS))
+    assert result.rows == 3
+    assert sorted(r["o.o_orderkey"] for r in sample_records(result.sample)) == [10, 12, 13]
+
+
+@pytest.mark.parametrize("batch_rows", [1, 2, 1000])
+def test_hash_join_with_residual(batch_rows):
+    result = run(join_plan("(o.o_totalprice > c.c_acctbal)"), batch_rows)
+    assert sorted(r["o.o_orderkey"] for r in sample_records(result.sample)) == [10, 12, 13]
+
+
+@pytest.mark.parametrize("batch_rows", [1, 1000])
+def test_unevaluable_residual_is_skipped_for_every_batch(batch_rows):
+    result = run(join_plan("((o.o_totalprice > c.c_acctbal) AND (foo(o.o_clerk) = 1))"), batch_rows)
+    assert result.rows == 3
+    join = next(op for op in result.operators.values() if op.node_type == "Hash Join")
+    assert join.skipped == ["(foo(o_clerk) = 1) (Function foo() isn't supported)"]
+
+
+def test_left_join_keeps_unmatched_rows():
+    plan = node("Hash Join", plans=[
+        node("Seq Scan", **CUSTOMER),
+        node("Hash", plans=[node("Seq Scan", Filter="(o.o_orderstatus = 'F')", **ORDERS)]),
+    ], **{"Join Type": "Left", "Hash Cond": "(c.c_custkey = o.o_custkey)"})
+    records = sample_records(run(plan).sample)
+    assert len(records) == 3
+    # Customer 2 has no 'F' order and gets NULLs (NaN)
+    matched = {r["c.c_custkey"]: r["o.o_orderkey"] for r in records}
+    assert (matched[1], matched[3]) == (11, 14)
+    assert matched[2] != matched[2]
+
+
+def test_aggregate_sort_limit():
+    out = ["o.o_custkey", "(sum(o.o_totalprice))", "(count(*))"]
+    scan = node("Seq Scan", Filter="(o.o_orderdate < '1996-01-01'::date)",
+                **dict(ORDERS, Output=["o.o_custkey", "o.o_totalprice"]))
+    aggregate = node("Aggregate", plans=[scan], Strategy="Hashed", Output=out[:1] + [name[1:-1] for name in out[1:]],
+                     **{"Group Key": ["o.o_custkey"]})
+    sort = node("Sort", plans=[aggregate], Output=out, **{"Sort Key": ["(sum(o.o_totalprice)) DESC"]})
+    result = run(node("Limit", rows=2, plans=[sort], Output=out))
+    assert result.rows == 2
+    assert [(r["o.o_custkey"], r["sum(o_totalprice)"], r["count(*)"]) for r in sample_records(result.sample)] == [
+        (3, 1000.0, 1), (2, 300.0, 1),
+    ]
+
+
+def test_csv_with_header():
+    result = run(node("Seq Scan", Filter="(n.n_name ~~ 'C%')", **{"Relation Name": "nation", "Alias": "n", "Output": ["n.n_nationkey"]}))
+    assert [r["n.n_nationkey"] for r in sample_records(result.sample)] == [3]
+
+
+def test_evaluable():
+    op = Operator(0, {}, [], 10)
+    conditions = [(text, parse_expression(text)) for text in (
+        "(o.o_totalprice > 1)", "(o.missing = 1)", "(lower(o.o_clerk) = 'x')", "(sum(o.o_totalprice) > 1)",
+    )]
+    usable = op.evaluable(conditions, ["o.o_totalprice", "o.o_clerk"])
+    assert [text for text, _ in usable] == ["(o.o_totalprice > 1)", "(lower(o.o_clerk) = 'x')"]
+    assert len(op.skipped) == 2
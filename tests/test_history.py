@@ -0,0 +1,69 @@
+import pytest
+
+from history import PlanHistory, plan_record
+from plans import hash_join_plan, merge_join_plan
+from preprocessing import build_tree_from_json
+
+SQL = "select * from orders o join customer c on o.o_custkey = c.c_custkey"
+
+
+def record(qep, sql=SQL, **kwargs):
+    return plan_record(sql, qep, build_tree_from_json(qep).get_cost(), **kwargs)
+
+
+@pytest.fixture
+def history(tmp_path):
+    with PlanHistory(str(tmp_path / "history.db"), threshold=0.2) as history:
+        yield history
+
+
+def test_first_plan_has_nothing_to_compare(history):
+    flag = history.record(record(hash_join_plan()))
+    assert flag["previous_id"] is None
+    assert not flag["flipped"] and not flag["regression"]
+
+
+def test_same_plan_again(history):
+    first = history.record(record(hash_join_plan()))
+    flag = history.record(record(hash_join_plan()))
+    assert flag["previous_id"] == first["id"]
+    assert not flag["flipped"] and not flag["regression"]
+    assert flag["cost_ratio"] == 1.0
+
+
+def test_costs_alone_are_no_flip(history):
+    history.record(record(hash_join_plan(10.0)))
+    flag = history.record(record(hash_join_plan(11.0)))
+    assert not flag["flipped"]
+    assert not flag["regression"]
+
+
+def test_flip(history):
+    history.record(record(hash_join_plan()))
+    flag = history.record(record(merge_join_plan()))
+    assert flag["flipped"]
+    assert not flag["regression"]
+
+
+def test_regression_over_threshold(history):
+    history.record(record(hash_join_plan(10.0)))
+    flag = history.record(record(hash_join_plan(12.5)))
+    assert flag["regression"]
+    assert flag["cost_ratio"] == 1.25
+    assert [plan["id"] for plan in history.flagged()] == [flag["id"]]
+
+
+def test_queries_are_compared_by_fingerprint(history):
+    history.record(record(hash_join_plan()))
+    # Formatting doesn't make another query, another literal does
+    assert history.record(record(merge_join_plan(), SQL.upper() + ";"))["flipped"]
+    assert history.record(record(merge_join_plan(), SQL + " where o.o_orderkey = 1"))["previous_id"] is None
+
+
+def test_record_many_compares_within_the_batch(history):
+    flags = history.record_many([record(hash_join_plan()), record(merge_join_plan(20.0))])
+    assert flags[1]["previous_id"] == flags[0]["id"]
+    assert flags[1]["flipped"] and flags[1]["regression"]
+    plans = history.history(flags[0]["query_fingerprint"])
+    assert [plan["id"] for plan in plans] == [flags[1]["id"], flags[0]["id"]]
+    assert len(history.nodes(flags[0]["id"])) == 4
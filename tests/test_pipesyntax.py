@@ -0,0 +1,64 @@
+import pytest
+
+from pipesyntax import TEXT_JOIN_RE, build_pipeline, render_text, text_plan
+from preprocessing import build_tree_from_json, parse_query_explanation_to_tree
+
+
+HASH_JOIN_TEXT = """\
+Hash Join  (cost=1.09..2.21 rows=5 width=8)
+  Hash Cond: (o.o_custkey = c.c_custkey)
+  ->  Seq Scan on orders o  (cost=0.00..1.05 rows=5 width=8)
+  ->  Hash  (cost=1.04..1.04 rows=4 width=4)
+        ->  Seq Scan on customer c  (cost=0.00..1.04 rows=4 width=4)
+              Filter: (c_acctbal > '0'::numeric)
+""".splitlines()
+
+HASH_JOIN_JSON = {"Plan": {
+    "Node Type": "Hash Join", "Join Type": "Inner", "Startup Cost": 1.09, "Total Cost": 2.21,
+    "Plan Rows": 5, "Plan Width": 8, "Hash Cond": "(o.o_custkey = c.c_custkey)",
+    "Plans": [
+        {"Node Type": "Seq Scan", "Relation Name": "orders", "Alias": "o", "Startup Cost": 0.0,
+         "Total Cost": 1.05, "Plan Rows": 5, "Plan Width": 8},
+        {"Node Type": "Hash", "Startup Cost": 1.04, "Total Cost": 1.04, "Plan Rows": 4, "Plan Width": 4,
+         "Plans": [
+             {"Node Type": "Seq Scan", "Relation Name": "customer", "Alias": "c", "Startup Cost": 0.0,
+              "Total Cost": 1.04, "Plan Rows": 4, "Plan Width": 4, "Filter": "(c_acctbal > '0'::numeric)"},
+         ]},
+    ],
+}}
+
+
+@pytest.mark.parametrize("label, node_type, join_type", [
+    ("Hash Join", "Hash", None),
+    ("Hash Left Join", "Hash", "Left"),
+    ("Merge Full Join", "Merge", "Full"),
+    ("Nested Loop", "Nested Loop", None),
+    ("Nested Loop Right Anti Join", "Nested Loop", "Right Anti"),
+])
+def test_text_join_labels(label, node_type, join_type):
+    join = TEXT_JOIN_RE.match(label)
+    assert join is not None
+    assert (join.group(1) or join.group(3)) == node_type
+    assert (join.group(2) or join.group(4)) == join_type
+
+
+@pytest.mark.parametrize("label", ["Hash", "Merge", "Merge Append", "Hash Left"])
+def test_text_non_join_labels(label):
+    assert TEXT_JOIN_RE.match(label) is None
+
+
+def test_text_hash_node_stays_a_hash():
+    tree = parse_query_explanation_to_tree(HASH_JOIN_TEXT)
+    node_types = [text_plan(node)["Node Type"] for node in tree.dfs()]
+    assert node_types == ["Hash Join", "Seq Scan", "Hash", "Seq Scan"]
+
+    text = render_text(build_pipeline(tree), show_cost=False)
+    assert "|> HASH" in text
+    assert "<missing join condition>" not in text
+    assert text.count("JOIN") == 1
+
+
+def test_text_and_json_plans_render_the_same():
+    from_text = render_text(build_pipeline(parse_query_explanation_to_tree(HASH_JOIN_TEXT)))
+    from_json = render_text(build_pipeline(build_tree_from_json(HASH_JOIN_JSON)))
+    assert from_text == from_json
@@ -0,0 +1,154 @@
+import pytest
+
+import plancache
+from mysqlplan import mysql_json_plan, table_aliases
+from plancache import PlanCache, normalize_sql, plan_relations, query_fingerprint, split_statements
+from plans import hash_join_plan
+from plansource import PlanSource
+
+
+class FakeSource(PlanSource):
+    """Answers like a database whose statistics the test changes."""
+
+    def __init__(self, qep=None):
+        self.qep = qep or hash_join_plan()
+        self.explained = 0
+        self.analyzed = 0
+
+    def explain(self, sql, timeout=None, **options):
+        self.explained += 1
+        return self.qep
+
+    def planner_settings(self):
+        return (("work_mem", "4MB"),)
+
+    def table_stats(self, relations):
+        return [[name, 100.0, 10, 10, self.analyzed] for name in relations]
+
+
+@pytest.mark.parametrize("a, b", [
+    ("SELECT *  FROM t", "select * from t"),
+    ("select * from t; ", "select * from t"),
+    ("select * -- the lot\nfrom t", "select * from t"),
+    ("select /* hint */ * from t", "select * from t"),
+])
+def test_normalize_sql_ignores_formatting(a, b):
+    assert normalize_sql(a) == normalize_sql(b)
+
+
+def test_normalize_sql_keeps_quoted_text():
+    assert normalize_sql("SELECT \"Name\" FROM t WHERE x = 'ABC'") == "select \"Name\" from t where x = 'ABC'"
+
+
+def test_normalize_sql_literals():
+    assert normalize_sql("select * from t where a = 1") != normalize_sql("select * from t where a = 2")
+    without = normalize_sql("SELECT * FROM t1 WHERE a = 1 AND b = 'x' AND c > 2.5", keep_literals=False)
+    assert without == "select * from t1 where a = ? and b = ? and c > ?"
+    assert query_fingerprint("select 1", keep_literals=False) == query_fingerprint("SELECT 2", keep_literals=False)
+
+
+def test_split_statements():
+    script = """
+        select 'a;b' from t;  -- one; not two
+        select "x;y" from u;
+        /* only a comment; */
+        select 3
+    """
+    # Comments stay with the statement after them
+    assert [normalize_sql(s) for s in split_statements(script)] == [
+        "select 'a;b' from t",
+        "select \"x;y\" from u",
+        "select 3",
+    ]
+
+
+def test_split_statements_drops_comment_only_pieces():
+    assert split_statements("select 1; -- done\n;  ;") == ["select 1"]
+
+
+def test_hit_skips_explain():
+    cache, source = PlanCache(), FakeSource()
+    cache.explain("select * from orders", source)
+    cache.explain("SELECT *\nFROM orders;", source)
+    assert source.explained == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_stats_change_invalidates():
+    cache, source = PlanCache(), FakeSource()
+    cache.explain("select 1", source)
+    # An ANALYZE of one of the plan's tables
+    source.analyzed += 1
+    cache.explain("select 1", source)
+    assert source.explained == 2
+    assert cache.invalidations == 1
+    cache.explain("select 1", source)
+    assert source.explained == 2
+
+
+def test_every_call_gets_its_own_tree():
+    cache, source = PlanCache(), FakeSource()
+    first = cache.explain("select 1", source)
+    second = cache.explain("select 1", source)
+    assert first.tree is not second.tree
+    first.tree.settings = {"work_mem": "4MB"}
+    assert not hasattr(second.tree, "settings")
+    assert not hasattr(cache.explain("select 1", source).tree, "settings")
+
+
+def test_hit_does_no_tree_or_pipeline_work(monkeypatch):
+    cache, source = PlanCache(), FakeSource()
+    cache.explain("select 1", source)
+    calls = []
+    monkeypatch.setattr(plancache, "build_tree_from_json", lambda qep: calls.append("tree"))
+    monkeypatch.setattr(plancache, "build_pipeline", lambda tree: calls.append("pipeline"))
+    entry = cache.explain("select 1", source)
+    assert calls == []
+    assert entry.pipeline is not None
+    entry.tree.get_cost()
+    assert calls == []
+
+
+def test_lru_eviction():
+    cache, source = PlanCache(max_entries=2), FakeSource()
+    for sql in ("select 1", "select 2", "select 1", "select 3"):
+        cache.explain(sql, source)
+    assert len(cache) == 2
+    cache.explain("select 1", source)
+    cache.explain("select 2", source)
+    assert source.explained == 4
+
+
+def test_disk_tier(tmp_path):
+    source = FakeSource()
+    PlanCache(disk_dir=str(tmp_path)).explain("select 1", source)
+    entry = PlanCache(disk_dir=str(tmp_path)).explain("select 1", source)
+    assert source.explained == 1
+    assert entry.tree.root.operation == "Hash Join"
+
+
+def test_mysql_stats_use_table_names_not_aliases():
+    sql = "select * from orders o join customer as c on o.o_custkey = c.c_custkey"
+    doc = {"query_block": {"nested_loop": [
+        {"table": {"table_name": "c", "access_type": "ALL", "rows_produced_per_join": 150,
+                   "cost_info": {"read_cost": "1.00", "eval_cost": "15.00", "prefix_cost": "16.00"}}},
+        {"table": {"table_name": "o", "access_type": "ref", "key": "o_custkey",
+                   "rows_produced_per_join": 1500,
+                   "cost_info": {"read_cost": "100.00", "eval_cost": "150.00", "prefix_cost": "266.00"}}},
+    ]}}
+    qep = mysql_json_plan(doc, table_aliases(sql))
+    assert plan_relations(qep) == ["customer", "orders"]
+
+    source = FakeSource(qep)
+    source.dbms = "mysql"
+    asked = []
+    table_stats = source.table_stats
+    source.table_stats = lambda relations: asked.append(relations) or table_stats(relations)
+    cache = PlanCache()
+    entry = cache.explain(sql, source)
+    assert asked[-1] == ["customer", "orders"]
+    assert "Seq Scan on customer c" in [node.operation for node in entry.tree.dfs()]
+    # An ANALYZE TABLE orders reaches the cached entry
+    source.analyzed += 1
+    cache.explain(sql, source)
+    assert cache.invalidations == 1
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from plans import hash_join_plan, merge_join_plan
+from plansource import (
+    ArchiveWriter, PlanArchive, PlanNotRecorded, PlanSource, ReplayPlanSource, explain_key, import_plan,
+    record_key, segment_name,
+)
+
+
+def test_segment_names_sort_in_creation_order():
+    names = [segment_name() for _ in range(200)]
+    assert sorted(names) == names
+    assert len(set(names)) == len(names)
+
+
+def test_plan_sources_must_answer_everything():
+    class ExplainOnly(PlanSource):
+        def explain(self, sql, timeout=None, **options):
+            return hash_join_plan()
+
+    with pytest.raises(TypeError):
+        ExplainOnly()
+
+
+def test_newest_segment_wins(tmp_path):
+    path = str(tmp_path)
+    # More than ten writers, so an unpadded counter would sort "-10" before "-2"
+    for cost in range(1, 13):
+        writer = ArchiveWriter(path)
+        import_plan(writer, "postgresql", "select 1", hash_join_plan(float(cost)))
+        writer.close()
+    with PlanArchive(path) as archive:
+        assert len(archive) == 1
+        record = archive.get(explain_key("postgresql", "select 1"))
+        assert record["result"]["Plan"]["Total Cost"] == 12.0
+
+
+def test_latest_after_a_key_is_recorded_again(tmp_path):
+    writer = ArchiveWriter(str(tmp_path))
+    writer.append(record_key("settings", "postgresql"), "settings", "postgresql", {"result": [["work_mem", "4MB"]]})
+    writer.append("other", "settings", "postgresql", {"result": [["work_mem", "8MB"]]})
+    writer.append(record_key("settings", "postgresql"), "settings", "postgresql", {"result": [["work_mem", "16MB"]]})
+    writer.close()
+    with PlanArchive(str(tmp_path)) as archive:
+        assert archive.latest("settings")["result"] == [["work_mem", "16MB"]]
+
+
+def test_half_written_index_line_is_skipped(tmp_path):
+    writer = ArchiveWriter(str(tmp_path))
+    import_plan(writer, "postgresql", "select 1", hash_join_plan())
+    writer.close()
+    [index] = [name for name in os.listdir(tmp_path) if name.endswith(".index")]
+    with open(tmp_path / index, "a", encoding="utf-8") as f:
+        f.write('{"key": "trunc')
+    with PlanArchive(str(tmp_path)) as archive:
+        assert len(archive) == 1
+
+
+def test_replay(tmp_path):
+    writer = ArchiveWriter(str(tmp_path))
+    import_plan(writer, "postgresql", "SELECT * FROM orders", hash_join_plan())
+    import_plan(writer, "postgresql", "SELECT * FROM orders", merge_join_plan(), analyze=True)
+    writer.close()
+    with ReplayPlanSource(str(tmp_path)) as source:
+        assert source.dbms == "postgresql"
+        # Matched after normalization, with and without ANALYZE apart
+        assert source.explain("select *\nfrom orders;")["Plan"]["Node Type"] == "Hash Join"
+        assert source.explain("select * from orders", analyze=True)["Plan"]["Node Type"] == "Merge Join"
+        with pytest.raises(PlanNotRecorded):
+            source.explain("select * from customer")
+        assert source.planner_settings() == ()
+        assert source.table_stats(["orders"]) == []
@@ -0,0 +1,49 @@
+from preprocessing import parse_query_explanation_to_tree
+
+ANALYZE_TEXT = """\
+                                   QUERY PLAN
+--------------------------------------------------------------------------------
+ Hash Left Join  (cost=1.09..2.21 rows=5 width=8) (actual time=0.05..0.09 rows=6 loops=1)
+   Hash Cond: (o.o_custkey = c.c_custkey)
+   ->  Seq Scan on orders o  (cost=0.00..1.05 rows=5 width=8) (actual time=0.01..0.02 rows=5 loops=1)
+   ->  Hash  (cost=1.04..1.04 rows=4 width=4) (actual time=0.02..0.02 rows=2 loops=1)
+         Buckets: 1024  Batches: 1  Memory Usage: 9kB
+         ->  Seq Scan on customer c  (cost=0.00..1.04 rows=4 width=4) (actual time=0.01..0.01 rows=2 loops=1)
+               Filter: (c_acctbal > '0'::numeric)
+               Rows Removed by Filter: 1
+ Planning Time: 0.100 ms
+ Execution Time: 0.200 ms
+(11 rows)
+""".splitlines()
+
+
+def test_text_plan_shape():
+    tree = parse_query_explanation_to_tree(ANALYZE_TEXT)
+    nodes = tree.dfs()
+    assert [node.operation for node in nodes] == [
+        "Hash Left Join", "Seq Scan on orders o", "Hash", "Seq Scan on customer c",
+    ]
+    join, orders, hash_node, customer = nodes
+    assert orders.parent is join and hash_node.parent is join
+    assert customer.parent is hash_node
+    assert (orders.relation, customer.relation) == ("orders", "customer")
+
+
+def test_text_plan_estimates_and_actuals():
+    join, _, hash_node, customer = parse_query_explanation_to_tree(ANALYZE_TEXT).dfs()
+    assert (join.startup_cost, join.total_cost, join.rows, join.width) == (1.09, 2.21, 5.0, 8.0)
+    assert join.analyzed and join.actual_rows == 6.0
+    assert hash_node.actual_rows == 2.0
+
+
+def test_text_plan_conditions_stay_with_their_node():
+    join, orders, hash_node, customer = parse_query_explanation_to_tree(ANALYZE_TEXT).dfs()
+    assert join.condition == ["Hash Cond: (o.o_custkey = c.c_custkey)"]
+    assert orders.condition == []
+    assert "Filter: (c_acctbal > '0'::numeric)" in customer.condition
+    assert not any("Filter" in condition for condition in hash_node.condition)
+
+
+def test_cursor_rows():
+    rows = [(line,) for line in ANALYZE_TEXT[2:]]
+    assert len(parse_query_explanation_to_tree(rows).dfs()) == 4